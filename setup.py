@@ -67,6 +67,8 @@ setup(
         'ZODB3 >=3.10.0b1',
         'setuptools',
         'keas.kmi >= 3.1.0',
+        'zc.lockfile',
+        'cryptography',
     ],
     extras_require=dict(
         test=[
@@ -74,7 +76,24 @@ setup(
             'zope.app.testing',
             'manuel',
             'mock',
+            'zstandard',
+            'lz4',
+        ],
+        zstd=[
+            'zstandard',
+        ],
+        lz4=[
+            'lz4',
+        ],
+        cryptography=[
+            'cryptography',
         ]),
+    entry_points={
+        'console_scripts': [
+            'encryptingstorage-convert ='
+            ' cipher.encryptingstorage.convert:main',
+        ],
+    },
     include_package_data=True,
     zip_safe=False,
 )
@@ -11,25 +11,45 @@
 # FOR A PARTICULAR PURPOSE.
 #
 ##############################################################################
+import collections
+import functools
+import logging
 import os
 import shutil
-import zlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import ZODB.interfaces
 from ZODB.blob import BlobFile
 from ZODB.POSException import POSKeyError
+from ZODB.serialize import referencesf
 from zope.interface import directlyProvides
 from zope.interface import implementer
 from zope.interface import providedBy
 
+from cipher.encryptingstorage import blob as chunked
+from cipher.encryptingstorage import cache
+from cipher.encryptingstorage import compression
 from cipher.encryptingstorage import encrypt_util
+from cipher.encryptingstorage import metrics
+from cipher.encryptingstorage import workers
+from cipher.encryptingstorage.compression import compress  # noqa: F401 API
+from cipher.encryptingstorage.compression import decompress
+from cipher.encryptingstorage.refs import RefsIndex
+from cipher.encryptingstorage.refs import pack_key
+from cipher.encryptingstorage.refs import record_key
+from cipher.encryptingstorage.refs import split_oids
+
+
+logger = logging.getLogger(__name__)
 
 
 @implementer(ZODB.interfaces.IStorageWrapper)
 class EncryptingStorage:
 
     copied_methods = (
-        'close', 'getName', 'getSize', 'history', 'isReadOnly',
+        'getName', 'getSize', 'history', 'isReadOnly',
         'lastTransaction', 'new_oid', 'sortKey',
         'tpc_abort', 'tpc_begin', 'tpc_finish', 'tpc_vote',
         'temporaryDirectory',
@@ -39,20 +59,80 @@ class EncryptingStorage:
     def __init__(self, base, *args, **kw):
         self.base = base
 
-        if (lambda encrypt=True: encrypt)(*args, **kw):
-            self._encrypt = True
-            self._transform = encrypt  # Refering to module func below!
+        options = (
+            lambda encrypt=True, decrypt_workers=0, compression='zlib',
+            compression_dictionaries=(), adaptive_compression=True,
+            blob_cache_dir=None, blob_cache_size=None, record_cache_size=None,
+            refs_index=None, pack_workers=0, pack_memory=None,
+            async_workers=None, compression_level=None,
+            compression_min_size=compression.MIN_SIZE, compress_records=None,
+            utility=None:
+            locals())(*args, **kw)
+
+        utility = options['utility']
+        if utility is None:
+            utility = encrypt_util.GlobalEncryptionUtility()
+        self.utility = utility
+
+        codec = options['compression']
+        if isinstance(codec, str):
+            codec = compression.getCodec(
+                codec, options['compression_level'],
+                dictionaries=options['compression_dictionaries'])
+            if options['adaptive_compression']:
+                codec = compression.AdaptiveCodec(codec)
+        self.codec = codec
+
+        self._encrypt = bool(options['encrypt'])
+        compressing = options['compress_records']
+        if compressing is None:
+            compressing = self._encrypt
+        self._transform = Transform(
+            codec if compressing else None, options['compression_min_size'],
+            self._encrypt, utility)
+
+        self._untransform = functools.partial(decrypt, utility=utility)
+        self._untransform_many = functools.partial(
+            decrypt_many, utility=utility)
+
+        if options['record_cache_size']:
+            self.record_cache = cache.RecordCache(options['record_cache_size'])
         else:
-            self._encrypt = False
-            self._transform = lambda data: data
+            self.record_cache = None
 
-        self._untransform = decrypt
+        if options['decrypt_workers']:
+            self._executor = ThreadPoolExecutor(
+                options['decrypt_workers'],
+                thread_name_prefix='cipher.encryptingstorage decrypt')
+        else:
+            self._executor = None
+        self._async_pool = workers.AsyncPool(
+            options['async_workers'],
+            thread_name_prefix='cipher.encryptingstorage async')
+        self.pack_workers = options['pack_workers']
+        self.pack_memory = options['pack_memory']
+
+        blob_dir = getattr(getattr(base, 'fshelper', None), 'base_dir', None)
+        if blob_dir is not None:
+            blob_cache_dir = options['blob_cache_dir']
+            if blob_cache_dir is None:
+                blob_cache_dir = os.path.join(blob_dir, os.path.pardir, 'tmp')
+            self.blob_cache = chunked.BlobCache(
+                os.path.abspath(blob_cache_dir), options['blob_cache_size'])
 
         for name in self.copied_methods:
             v = getattr(base, name, None)
             if v is not None:
                 setattr(self, name, v)
 
+        if options['refs_index']:
+            self.refs_index = RefsIndex(options['refs_index'], utility)
+            self._pending_refs = {}
+            self.tpc_finish = self._tpc_finish
+            self.tpc_abort = self._tpc_abort
+        else:
+            self.refs_index = None
+
         directlyProvides(self, providedBy(base))
 
         base.registerDB(self)
@@ -63,31 +143,179 @@ class EncryptingStorage:
     def __len__(self):
         return len(self.base)
 
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        self._async_pool.shutdown()
+        return self.base.close()
+
+    def _untransform_record(self, oid, serial, data):
+        record_cache = self.record_cache
+        if record_cache is None:
+            return self._untransform(data)
+        result = record_cache.get(oid, serial)
+        if result is None:
+            result = self._untransform(data)
+            record_cache.set(oid, serial, result)
+        return result
+
     def load(self, oid, version=''):
+        sink = metrics.sink
+        if sink is not None:
+            start = metrics.clock()
         data, serial = self.base.load(oid, version)
-        return self._untransform(data), serial
+        if sink is not None:
+            metrics.observe(sink, 'base_load', start, data)
+        return self._untransform_record(oid, serial, data), serial
 
     def loadBefore(self, oid, tid):
+        sink = metrics.sink
+        if sink is not None:
+            start = metrics.clock()
         r = self.base.loadBefore(oid, tid)
+        if sink is not None:
+            metrics.observe(sink, 'base_load', start, r and r[0])
         if r is not None:
             data, serial, after = r
-            return self._untransform(data), serial, after
+            return self._untransform_record(oid, serial, data), serial, after
         else:
             return r
 
+    def loadBeforeMany(self, oids, tid):
+        """Load the revisions of several objects current before `tid`.
+
+        Returns a dictionary mapping each oid to what `loadBefore` would
+        return for it.  The records are decrypted together, which amortizes
+        the per-record overhead.
+        """
+        oids = list(oids)
+        self.prefetch(oids, tid)
+        loadBefore = self.base.loadBefore
+        result = {oid: loadBefore(oid, tid) for oid in oids}
+        record_cache = self.record_cache
+        found = []
+        for oid, r in result.items():
+            if r is None:
+                continue
+            data = None
+            if record_cache is not None:
+                data = record_cache.get(oid, r[1])
+            if data is None:
+                found.append((oid, r))
+            else:
+                result[oid] = (data,) + r[1:]
+        datas = [r[0] for oid, r in found]
+        if self._executor is None:
+            datas = self._untransform_many(datas)
+        else:
+            datas = [data for batch in self._executor.map(
+                self._untransform_many, _batches(datas)) for data in batch]
+        for (oid, (_, serial, after)), data in zip(found, datas):
+            result[oid] = data, serial, after
+            if record_cache is not None:
+                record_cache.set(oid, serial, data)
+        return result
+
+    def prefetch(self, oids, tid):
+        """Ask the base storage to start fetching records, if it can.
+
+        Storages like ZEO then load the records in the background.
+        """
+        prefetch = getattr(self.base, 'prefetch', None)
+        if prefetch is not None:
+            prefetch(oids, tid)
+
     def loadSerial(self, oid, serial):
-        return self._untransform(self.base.loadSerial(oid, serial))
+        sink = metrics.sink
+        if sink is not None:
+            start = metrics.clock()
+        data = self.base.loadSerial(oid, serial)
+        if sink is not None:
+            metrics.observe(sink, 'base_load', start, data)
+        return self._untransform_record(oid, serial, data)
 
     def pack(self, pack_time, referencesf, gc=None):
         _untransform = self._untransform
+        collect = gc
+        if collect is None:
+            # FileStorage's pack-gc option, other storages always collect
+            # garbage.
+            collect = getattr(self.base, '_pack_gc', True)
+        # Without garbage collection, the references aren't needed.
+        known = self._known_references() if collect else {}
 
         def refs(p, oids=None):
+            if known and p[:2] == b'.e':
+                found = known.get(pack_key(p))
+                if found is not None:
+                    if oids is None:
+                        return split_oids(found)
+                    oids.extend(split_oids(found))
+                    return oids
             return referencesf(_untransform(p), oids)
         if gc is not None:
             return self.base.pack(pack_time, refs, gc)
         else:
             return self.base.pack(pack_time, refs)
 
+    def _known_references(self):
+        # The references of encrypted records that pack doesn't need to
+        # decrypt itself, by `pack_key`: those of the reference index, and
+        # with pack or decrypt workers, the others decrypted by the workers.
+        known = {}
+        if self.refs_index is not None:
+            known.update(self.refs_index.load())
+        if self.pack_workers:
+            # The workers get the utility from the initializer, it can't
+            # be pickled with the tasks.
+            with workers.executor(
+                    self.pack_workers, _init_pack_worker, (self.utility,)
+            ) as executor:
+                self._decrypt_references(known, executor, self.pack_workers)
+        elif self._executor is not None:
+            self._decrypt_references(
+                known, self._executor, self._executor._max_workers,
+                self.utility)
+        return known
+
+    def _decrypt_references(self, known, executor, max_workers,
+                            utility=None):
+        # Decrypt the references of the encrypted records missing from
+        # `known` in batches, until they take `pack_memory` bytes.
+        size = 0
+        limit = self.pack_memory
+        for _, references in workers.imap(
+                executor, _references, self._reference_batches(known, utility),
+                max_workers):
+            size += _update(known, references)
+            if limit is not None and size >= limit:
+                logger.info(
+                    'Pack references exceed %s bytes, the remaining'
+                    ' records are decrypted while packing', limit)
+                break
+
+    def _reference_batches(self, known, utility):
+        # The `_references` tasks of the encrypted records missing from
+        # `known`, for `workers.imap`.
+        batch = []
+        it = self.base.iterator()
+        try:
+            for trans in it:
+                for record in trans:
+                    data = record.data
+                    if (data and data[:2] == b'.e'
+                            and pack_key(data) not in known):
+                        batch.append(data)
+                if len(batch) >= _BATCH_SIZE:
+                    yield (batch, utility), None
+                    batch = []
+        finally:
+            close = getattr(it, 'close', None)
+            if close is not None:
+                close()
+        if batch:
+            yield (batch, utility), None
+
     def registerDB(self, db):
         self.db = db
         self._db_transform = db.transform_record_data
@@ -96,19 +324,94 @@ class EncryptingStorage:
     _db_transform = _db_untransform = lambda self, data: data
 
     def store(self, oid, serial, data, version, transaction):
-        return self.base.store(oid, serial, self._transform(data), version,
-                               transaction)
+        if self.refs_index is not None:
+            return self._store_noting_refs(
+                oid, serial, data, version, transaction)
+        return self._base_store(
+            oid, serial, self._transform(data), version, transaction)
+
+    def _store_noting_refs(self, oid, serial, data, version, transaction):
+        stored = self._transform(data)
+        self._note_refs(transaction, stored, data)
+        return self._base_store(oid, serial, stored, version, transaction)
+
+    def _base_store(self, oid, serial, data, version, transaction):
+        sink = metrics.sink
+        if sink is None:
+            return self.base.store(oid, serial, data, version, transaction)
+        start = metrics.clock()
+        result = self.base.store(oid, serial, data, version, transaction)
+        metrics.observe(sink, 'base_store', start, data)
+        return result
+
+    def _note_refs(self, transaction, stored, data):
+        # Keep the references of a record for the reference index, they
+        # are written when the transaction is committed.
+        if not data or data[:2] == b'.e':
+            return
+        key = record_key(stored)
+        if key is not None:
+            self._pending_refs.setdefault(transaction, []).append(
+                (key, referencesf(data)))
+
+    def _tpc_finish(self, transaction, *args):
+        tid = self.base.tpc_finish(transaction, *args)
+        records = self._pending_refs.pop(transaction, None)
+        if records:
+            if tid is None:
+                tid = self.base.lastTransaction()
+            try:
+                self.refs_index.append(tid, records)
+            except Exception:
+                # The transaction is committed already, and the index is
+                # only an optimization: packing decrypts the records of
+                # the transactions missing from it.
+                logger.exception(
+                    "Couldn't add the references of transaction %s to %s",
+                    tid.hex(), self.refs_index.path)
+        return tid
+
+    def _tpc_abort(self, transaction):
+        self._pending_refs.pop(transaction, None)
+        return self.base.tpc_abort(transaction)
 
     def restore(self, oid, serial, data, version, prev_txn, transaction):
+        stored = self._transform(data)
+        if self.refs_index is not None:
+            self._note_refs(transaction, stored, data)
+        return self.base.restore(
+            oid, serial, stored, version, prev_txn, transaction)
+
+    def restoreRaw(self, oid, serial, data, version, prev_txn, transaction):
+        """Restore a record as it was stored by an encrypting storage.
+
+        The record isn't transformed, it must be readable with the keys of
+        this storage.  See ``iterator(raw=True)``.
+        """
         return self.base.restore(
-            oid, serial, self._transform(data), version, prev_txn, transaction)
+            oid, serial, data, version, prev_txn, transaction)
 
     def openCommittedBlobFile(self, oid, serial, blob=None):
-        blob_filename = self.loadBlob(oid, serial)
-        if blob is None:
-            return open(blob_filename, 'rb')
-        else:
-            return BlobFile(blob_filename, 'r', blob)
+        # The decrypted file is opened if it's cached already (loading a
+        # blob caches it).  Otherwise, chunked blob files are decrypted
+        # while they are read, only the chunks that are read are
+        # decrypted.
+        filename = self.fshelper.getBlobFilename(oid, serial)
+        if os.path.exists(filename):
+            cached = self.blob_cache.cached(
+                os.path.relpath(filename, self.fshelper.base_dir))
+            if cached is not None:
+                try:
+                    return _open_blob_file(cached, blob)
+                except FileNotFoundError:
+                    # Evicted meanwhile.
+                    pass
+            with open(filename, 'rb') as f:
+                aead = _chunked_aead(f, self.utility, self._encrypt)
+            if aead is not None:
+                return chunked.open_decrypted(filename, aead, blob)
+
+        return _open_blob_file(self.loadBlob(oid, serial), blob)
 
     def loadBlob(self, oid, serial):
         """Return the filename where the blob file can be found.
@@ -116,35 +419,92 @@ class EncryptingStorage:
         filename = self.fshelper.getBlobFilename(oid, serial)
         if not os.path.exists(filename):
             raise POSKeyError("No blob file", oid, serial)
-        return decrypt_file(filename, self.fshelper.base_dir)
+        return self.blob_cache.get(
+            os.path.relpath(filename, self.fshelper.base_dir),
+            functools.partial(decrypt_blob, filename, utility=self.utility,
+                              strict=self._encrypt))
 
-    def iterator(self, start=None, stop=None):
-        return _Iterator(self.base.iterator(start, stop))
+    async def aload(self, oid, version=''):
+        """Like `load`, from a coroutine.
+
+        Loading and decrypting the record run in the threads of the
+        ``async-workers`` pool, without blocking the event loop.  While all
+        of them are busy, callers wait in the event loop.
+        """
+        return await self._async_pool.run(self.load, oid, version)
+
+    async def aloadBefore(self, oid, tid):
+        """Like `loadBefore`, from a coroutine, see `aload`."""
+        return await self._async_pool.run(self.loadBefore, oid, tid)
+
+    async def aloadBlob(self, oid, serial):
+        """Like `loadBlob`, from a coroutine, see `aload`."""
+        return await self._async_pool.run(self.loadBlob, oid, serial)
+
+    async def aopenCommittedBlobFile(self, oid, serial, blob=None):
+        """Open a committed blob file for reading from a coroutine.
+
+        Returns a ``blob.AsyncBlobReader`` of the file `openCommittedBlobFile`
+        returns, whose reads decrypt the chunks in the ``async-workers``
+        pool.
+        """
+        f = await self._async_pool.run(
+            self.openCommittedBlobFile, oid, serial, blob)
+        return chunked.AsyncBlobReader(f, self._async_pool)
+
+    def iterator(self, start=None, stop=None, raw=False):
+        """Iterate over the transactions of the base storage.
+
+        The records are decrypted, unless `raw` is true: then they are
+        returned as they are stored, for `restoreRaw`.
+        """
+        return _Iterator(
+            self.base.iterator(start, stop), self._executor, raw, self.utility)
 
     def storeBlob(self, oid, oldserial, data, blobfilename, version,
                   transaction):
 
         if self._encrypt:
-            encrypt_file(blobfilename)
+            encrypt_file(blobfilename, self.utility)
 
+        stored = self._transform(data)
+        if self.refs_index is not None:
+            self._note_refs(transaction, stored, data)
         return self.base.storeBlob(
-            oid, oldserial, self._transform(data), blobfilename, version,
-            transaction)
+            oid, oldserial, stored, blobfilename, version, transaction)
 
     def restoreBlob(self, oid, serial, data, blobfilename, prev_txn,
                     transaction):
         # Copies the original file to tmp/blobfilename
-        blobfilename = decrypt_file(blobfilename, self.fshelper.base_dir)
+        blobfilename = decrypt_file(
+            blobfilename, self.fshelper.base_dir, self.utility)
         # Now overwrite the file in tmp.
-        encrypt_file(blobfilename)
+        encrypt_file(blobfilename, self.utility)
 
         # And store it in the db.
         return self.base.restoreBlob(oid, serial, self._transform(data),
                                      blobfilename, prev_txn, transaction)
 
+    def loadBlobRaw(self, oid, serial):
+        """Return the filename of the blob file as it is stored.
+        """
+        return self.base.loadBlob(oid, serial)
+
+    def restoreBlobRaw(self, oid, serial, data, blobfilename, prev_txn,
+                       transaction):
+        """Restore a blob record and file as stored by an encrypting storage.
+
+        Neither the record nor the file are transformed, see `restoreRaw`.
+        The file is moved into the storage.
+        """
+        return self.base.restoreBlob(
+            oid, serial, data, blobfilename, prev_txn, transaction)
+
     def invalidateCache(self):
         """ For IStorageWrapper
         """
+        if self.record_cache is not None:
+            self.record_cache.clear()
         return self.db.invalidateCache()
 
     def invalidate(self, transaction_id, oids, version=''):
@@ -152,6 +512,8 @@ class EncryptingStorage:
         """
         # keep the version param to be compatible with ZEO/ZODB 4
         assert version == ''
+        if self.record_cache is not None:
+            self.record_cache.invalidate(oids)
         return self.db.invalidate(transaction_id, oids)
 
     def references(self, record, oids=None):
@@ -173,23 +535,49 @@ class EncryptingStorage:
         oid, tid, data, next = self.base.record_iternext(next)
         return oid, tid, self._untransform(data), next
 
-    def copyTransactionsFrom(self, other):
-        ZODB.blob.copyTransactionsFromTo(other, self)
+    def copyTransactionsFrom(self, other, raw=False):
+        """Copy all transactions of `other`.
 
-
-def compress(data):
-    if data and (len(data) > 20) and data[:2] != b'.z':
-        compressed = b'.z' + zlib.compress(data)
-        if len(compressed) < len(data):
-            return compressed
-    return data
-
-
-def decompress(data):
-    return data[:2] == b'.z' and zlib.decompress(data[2:]) or data
+        With `raw`, the records and blob files of the encrypting storage
+        `other` are copied as they are stored, without decrypting and
+        encrypting them again.  Both storages must use the same keys.
+        """
+        if not raw:
+            return ZODB.blob.copyTransactionsFromTo(other, self)
+        if not isinstance(other, EncryptingStorage):
+            raise ValueError('Only encrypting storages can be copied raw')
+        blobs = ZODB.interfaces.IBlobStorage.providedBy(other.base)
+        # Server storages iterate raw anyway.
+        it = _Iterator(other.base.iterator(), raw=True)
+        try:
+            for trans in it:
+                self.tpc_begin(trans, trans.tid, trans.status)
+                for record in trans:
+                    blobfilename = None
+                    if blobs and record.data:
+                        try:
+                            blobfilename = other.loadBlobRaw(
+                                record.oid, record.tid)
+                        except POSKeyError:
+                            pass
+                    if blobfilename is None:
+                        self.restoreRaw(record.oid, record.tid, record.data,
+                                        '', record.data_txn, trans)
+                        continue
+                    fd, name = tempfile.mkstemp(
+                        suffix='.tmp', dir=self.temporaryDirectory())
+                    os.close(fd)
+                    shutil.copyfile(blobfilename, name)
+                    self.restoreBlobRaw(record.oid, record.tid, record.data,
+                                        name, record.data_txn, trans)
+                self.tpc_vote(trans)
+                self.tpc_finish(trans)
+        finally:
+            it.close()
 
 
-def encrypt(data):
+def encrypt(data, codec=compression.DEFAULT_CODEC,
+            min_size=compression.MIN_SIZE, utility=None):
     try:
         if data[:2] == b'.e':
             return data
@@ -197,47 +585,179 @@ def encrypt(data):
         # a ZODB test passes None as data, be forgiving about that
         return data
 
+    if utility is None:
+        utility = encrypt_util.ENCRYPTION_UTILITY
+    sink = metrics.sink
+    if sink is not None:
+        return _encrypt_observed(sink, data, codec, min_size, utility)
+
     # 1. compress
-    data = compress(data)
+    parts = compression.compress_parts(data, codec, min_size)
+
+    # 2. encrypt here!!!  The codec tag and the compressed data are
+    # encrypted straight into the record, behind the marker.
+    return encrypt_util.encrypt_parts(utility, parts, b'.e')
+
+
+class Transform:
+    """Transform records for storing them: compress, then encrypt them.
+
+    `codec` compresses the records of more than `min_size` bytes, unless
+    it's None.  If `encrypt` is false, the records are only compressed.
+    Records that were encrypted already are stored as they are.  They are
+    encrypted with `utility`, by default the global encryption utility.
+    """
+
+    def __init__(self, codec=compression.DEFAULT_CODEC,
+                 min_size=compression.MIN_SIZE, encrypt=True, utility=None):
+        self.codec = codec
+        self.min_size = min_size
+        self.encrypt = encrypt
+        self.utility = utility
+
+    def __call__(self, data):
+        if self.encrypt:
+            return encrypt(data, self.codec, self.min_size, self.utility)
+        if self.codec is None or not data or data[:2] == b'.e':
+            return data
+        return compression.compress(data, self.codec, self.min_size)
 
-    # 2. encrypt here!!!
-    data = encrypt_util.ENCRYPTION_UTILITY.encryptBytes(data)
-    return b'.e' + data
+    def __repr__(self):
+        return '<%s codec=%r min_size=%s encrypt=%s>' % (
+            self.__class__.__name__, self.codec, self.min_size,
+            self.encrypt)
 
 
-def decrypt(data):
+def _encrypt_observed(sink, data, codec, min_size, utility):
+    start = metrics.clock()
+    parts = compression.compress_parts(data, codec, min_size)
+    metrics.observe(sink, 'compress', start, data)
+    start = metrics.clock()
+    data = encrypt_util.encrypt_parts(utility, parts, b'.e')
+    metrics.observe(sink, 'encrypt', start, parts[1])
+    return data
+
+
+def decrypt(data, utility=None):
     try:
         if data[:2] != b'.e':
-            # not an encrypted record, return as is
-            return data
+            # not an encrypted record, return it as is unless compressed
+            return bytes(decompress(data))
     except TypeError:
         return data
-    # 1. decrypt here!!!
-    data = encrypt_util.ENCRYPTION_UTILITY.decryptBytes(data[2:])
-
-    # 2. decompress
-    data = decompress(data)
+    if utility is None:
+        utility = encrypt_util.ENCRYPTION_UTILITY
+    sink = metrics.sink
+    if sink is not None:
+        return _decrypt_observed(sink, data, utility)
+
+    # 1. decrypt here!!!  Views skip the marker and the padding without
+    # copying the record.
+    data = encrypt_util.decrypt_buffer(utility, memoryview(data)[2:])
+
+    # 2. decompress; only an uncompressed record is copied out of its view.
+    return bytes(decompress(data))
+
+
+def _decrypt_observed(sink, data, utility):
+    start = metrics.clock()
+    decrypted = encrypt_util.decrypt_buffer(utility, memoryview(data)[2:])
+    metrics.observe(sink, 'decrypt', start, data)
+    start = metrics.clock()
+    data = bytes(decompress(decrypted))
+    metrics.observe(sink, 'decompress', start, decrypted)
     return data
 
 
-def encrypt_file(filename):
+def decrypt_many(datas, utility=None):
+    """Decrypt a sequence of records.
+
+    Returns the list of decrypted (or original) records, see `decrypt`.
+    The encrypted records are decrypted with a single call to the
+    encryption `utility`, by default the global one.
+    """
+    result = list(datas)
+    encrypted = []
+    for i, data in enumerate(result):
+        if data and data[:2] == b'.e':
+            encrypted.append(i)
+        elif data:
+            result[i] = bytes(decompress(data))
+    if encrypted:
+        sink = metrics.sink
+        if sink is not None:
+            start = metrics.clock()
+        datas = [memoryview(result[i])[2:] for i in encrypted]
+        if utility is None:
+            utility = encrypt_util.ENCRYPTION_UTILITY
+        decrypted = encrypt_util.decrypt_many(utility, datas)
+        if sink is not None:
+            metrics.observe_size(
+                sink, 'decrypt', start, sum(len(d) for d in datas))
+            start = metrics.clock()
+        for i, data in zip(encrypted, decrypted):
+            result[i] = bytes(decompress(data))
+        if sink is not None:
+            metrics.observe_size(
+                sink, 'decompress', start, sum(len(d) for d in decrypted))
+    return result
+
+
+# The encryption utility of the pack workers.
+_pack_worker = threading.local()
+
+
+def _init_pack_worker(utility):
+    _pack_worker.utility = utility
+
+
+def _references(datas, utility=None):
+    """Return the `pack_key` and the concatenated references of records."""
+    if utility is None:
+        utility = _pack_worker.utility
+    return [(pack_key(data), b''.join(referencesf(decrypted)))
+            for data, decrypted in zip(datas, decrypt_many(datas, utility))]
+
+
+def _update(known, references):
+    # Add references to `known`, return an estimate of the bytes added.
+    size = 0
+    for key, oids in references:
+        known[key] = oids
+        size += len(key) + len(oids) + _REFERENCES_OVERHEAD
+    return size
+
+
+def encrypt_file(filename, utility=None):
     """ Reads the file "filename" and overwrites it
     with its data encrypted.
 
+    When the encryption utility provides an authenticated cipher, the
+    file is encrypted in one pass into the chunked format of
+    `cipher.encryptingstorage.blob`, which can be decrypted as a stream.
+
     :param filename: File to encrypt and override.
+    :param utility: Encryption utility, by default the global one.
     """
 
+    if utility is None:
+        utility = encrypt_util.ENCRYPTION_UTILITY
+    key_id = encrypt_util.utility_key_id(utility)
+    aead = None if key_id is None else utility.aead(key_id)
     tmp_file = filename + '.enc'
     with open(filename, 'rb') as fsrc:
         with open(tmp_file, 'wb') as fdst:
-            fdst.write(b'.e')
-            encrypt_util.ENCRYPTION_UTILITY.encrypt_file(fsrc, fdst)
+            if aead is None:
+                fdst.write(b'.e')
+                utility.encrypt_file(fsrc, fdst)
+            else:
+                chunked.encrypt_stream(
+                    fsrc, fdst, aead, chunked.CHUNK_SIZE, key_id)
 
-    os.remove(filename)
-    os.rename(tmp_file, filename)
+    os.replace(tmp_file, filename)
 
 
-def decrypt_file(filename, blob_dir):
+def decrypt_file(filename, blob_dir, utility=None):
     """ Reads the import "filename" decrypts it
     and writes the decrypted data to a temp file in
     tmp directory parallel to the 'blobstorage'.
@@ -246,14 +766,17 @@ def decrypt_file(filename, blob_dir):
     ELSE it just returns the path in temp_dir.
 
     If the file isn't encrypted or decrpytion fails it just copies the
-    src.
+    src.  Chunked files that fail authentication raise a ValueError
+    instead.
+
+    Storages keep their decrypted blob files in a size-bounded
+    `cipher.encryptingstorage.blob.BlobCache` instead.
 
     :param filename: Encrypted file to read.
     :param blob_dir: Path to the blob storage.
+    :param utility: Encryption utility, by default the global one.
 
     :returns:   The path to the temporary file.
-
-    TODO: Currently theres no code that handles the deletion of the file.
     """
 
     temp_dir = os.path.join(blob_dir, os.path.pardir, 'tmp')
@@ -269,19 +792,63 @@ def decrypt_file(filename, blob_dir):
     if not os.path.exists(new_tmp_dir):
         os.makedirs(new_tmp_dir, 0o700)
 
+    try:
+        with open(tmp_filename, 'wb') as fdst:
+            decrypt_blob(filename, fdst, utility)
+    except ValueError:
+        # Don't leave a partially decrypted file behind.
+        os.remove(tmp_filename)
+        raise
+
+    return tmp_filename
+
+
+def decrypt_blob(filename, fdst, utility=None, strict=True):
+    """Write the decrypted content of the blob file "filename" to fdst.
+
+    Files that aren't chunked files are copied as they are, unless they
+    start with the b'.e' marker.  A chunked file with a key the utility
+    doesn't know raises `encrypt_util.DecryptionError`, unless `strict`
+    is false (for storages that don't encrypt, whose plain files may
+    start like chunked ones): it's copied as it is then.
+    """
+    if utility is None:
+        utility = encrypt_util.ENCRYPTION_UTILITY
     with open(filename, 'rb') as fsrc:
-        header = fsrc.read(2)
-        if header != b'.e':
+        aead = _chunked_aead(fsrc, utility, strict)
+        if aead is not None:
+            reader = chunked.DecryptingReader(fsrc, aead)
+            shutil.copyfileobj(reader, fdst, chunked.CHUNK_SIZE)
+
+        elif fsrc.read(2) != b'.e':
             # File isn't encrypted
             fsrc.seek(0)
-            with open(tmp_filename, 'wb') as fdst:
-                shutil.copyfileobj(fsrc, fdst)
+            shutil.copyfileobj(fsrc, fdst)
 
         else:
-            with open(tmp_filename, 'wb') as fdst:
-                encrypt_util.ENCRYPTION_UTILITY.decrypt_file(fsrc, fdst)
+            utility.decrypt_file(fsrc, fdst)
 
-    return tmp_filename
+
+def _open_blob_file(filename, blob):
+    if blob is None:
+        return open(filename, 'rb')
+    return BlobFile(filename, 'r', blob)
+
+
+def _chunked_aead(fileobj, utility, strict=True):
+    # Return the cipher to decrypt the chunked blob file `fileobj` with,
+    # None if it isn't a chunked file or `utility` doesn't encrypt.  An
+    # unknown key raises, unless not `strict`: the file is taken for a
+    # plain one starting like a chunked one then.
+    key_id = chunked.key_id(fileobj)
+    if key_id is None:
+        return None
+    try:
+        return encrypt_util.utility_aead(utility, key_id)
+    except encrypt_util.DecryptionError:
+        if strict:
+            raise
+        return None
 
 
 class ServerEncryptingStorage(EncryptingStorage):
@@ -294,26 +861,56 @@ class ServerEncryptingStorage(EncryptingStorage):
     copied_methods = EncryptingStorage.copied_methods + (
         'load', 'loadBefore', 'loadSerial', 'store', 'restore',
         'iterator', 'storeBlob', 'restoreBlob', 'record_iternext',
+        'prefetch',
     )
 
+    def loadBeforeMany(self, oids, tid):
+        """Like `EncryptingStorage.loadBeforeMany`, without decrypting."""
+        oids = list(oids)
+        self.prefetch(oids, tid)
+        loadBefore = self.base.loadBefore
+        return {oid: loadBefore(oid, tid) for oid in oids}
+
 
 class _Iterator:
     # A class that allows for proper closing of the underlying iterator
     # as well as avoiding any GC issues.
     # (https://github.com/zopefoundation/zc.zlibstorage/issues/4)
 
-    def __init__(self, base_it):
+    def __init__(self, base_it, executor=None, raw=False, utility=None):
         self._base_it = base_it
+        self._executor = executor
+        self._raw = raw
+        self._utility = utility
+        self._ahead = collections.deque()
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        return Transaction(next(self._base_it))
+        if self._raw:
+            # Records are passed on as they are stored.
+            return next(self._base_it)
+        executor = self._executor
+        if executor is None:
+            return Transaction(next(self._base_it), utility=self._utility)
+        # Keep a few transactions in flight, so that their records get
+        # decrypted while the consumer works on the current one.
+        ahead = self._ahead
+        while len(ahead) < _TRANSACTIONS_AHEAD:
+            try:
+                trans = next(self._base_it)
+            except StopIteration:
+                break
+            ahead.append(Transaction(trans, executor, self._utility))
+        if not ahead:
+            raise StopIteration
+        return ahead.popleft()
 
     next = __next__
 
     def close(self):
+        self._ahead.clear()
         try:
             base_close = self._base_it.close
         except AttributeError:
@@ -329,19 +926,50 @@ class _Iterator:
 
 class Transaction:
 
-    def __init__(self, trans):
+    def __init__(self, trans, executor=None, utility=None):
         self.__trans = trans
+        self.__utility = utility
+        if executor is None:
+            self.__batches = None
+        else:
+            # Read the records now, before the base iterator moves on, and
+            # decrypt them in batches in the background.
+            records = [r for r in trans]
+            self.__batches = [
+                (batch, executor.submit(
+                    decrypt_many, [r.data for r in batch], utility))
+                for batch in _batches(records)]
 
     def __iter__(self):
-        for r in self.__trans:
-            if r.data:
-                r.data = decrypt(r.data)
-            yield r
+        if self.__batches is None:
+            for r in self.__trans:
+                if r.data:
+                    r.data = decrypt(r.data, self.__utility)
+                yield r
+            return
+        for batch, datas in self.__batches:
+            for r, data in zip(batch, datas.result()):
+                r.data = data
+                yield r
 
     def __getattr__(self, name):
         return getattr(self.__trans, name)
 
 
+# Number of records decrypted by one task and number of transactions
+# decrypted ahead of the consumer when decrypting in parallel.
+_BATCH_SIZE = 64
+_TRANSACTIONS_AHEAD = 16
+
+# Estimated bytes taken by a record's entry in the references decrypted
+# for pack, besides its key and oids.
+_REFERENCES_OVERHEAD = 100
+
+
+def _batches(items, size=_BATCH_SIZE):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
 class ZConfig:
 
     _factory = EncryptingStorage
@@ -356,11 +984,31 @@ class ZConfig:
         if encrypt is None:
             encrypt = True
         cfg = self.config.config
+        utility = None
         if cfg is not None:
             # XXX: how to figure `here`?
-            encrypt_util.init_local_facility(
+            utility = encrypt_util.load_utility(
                 {'__file__': cfg, 'here': '.'})
-        return self._factory(base, encrypt)
+        dictionaries = []
+        for path in self.config.compression_dictionary:
+            with open(path, 'rb') as f:
+                dictionaries.append(f.read())
+        return self._factory(
+            base, encrypt, decrypt_workers=self.config.decrypt_workers,
+            compression=self.config.compression,
+            compression_dictionaries=dictionaries,
+            adaptive_compression=self.config.adaptive_compression,
+            blob_cache_dir=self.config.blob_cache_dir,
+            blob_cache_size=self.config.blob_cache_size,
+            record_cache_size=self.config.record_cache_size,
+            refs_index=self.config.refs_index,
+            pack_workers=self.config.pack_workers,
+            pack_memory=self.config.pack_memory,
+            async_workers=self.config.async_workers,
+            compression_level=self.config.compression_level,
+            compression_min_size=self.config.compression_min_size,
+            compress_records=self.config.compress,
+            utility=utility)
 
 
 class ZConfigServer(ZConfig):
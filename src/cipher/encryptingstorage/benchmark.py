@@ -0,0 +1,260 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Benchmarks of the record and blob transforms
+
+Run with::
+
+    python -m cipher.encryptingstorage.benchmark [--save FILE] [--compare FILE]
+
+Every benchmark reports operations and megabytes per second and the 99th
+percentile latency.  ``--save`` writes the results to a JSON file, and
+``--compare`` flags the benchmarks that got slower than in such a file by
+more than ``--threshold``; the exit status is 1 if any did.
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import ZODB.FileStorage
+import ZODB.MappingStorage
+import ZODB.utils
+from keas.kmi import testing
+from ZODB.Connection import TransactionMetaData
+
+import cipher.encryptingstorage
+from cipher.encryptingstorage import compression
+from cipher.encryptingstorage import encrypt_util
+
+
+SIZES = (50, 1000, 10000, 100000, 1 << 20)
+BLOB_SIZES = (1 << 20, 16 << 20)
+
+_WORDS = [b'persistent', b'object', b'catalog', b'index', b'title', b'Zope',
+          b'document', b'published', b'owner', b'2024-01-01', b'\x80\x03']
+
+
+def payload(size, kind):
+    """Return `size` bytes of ``compressible`` or ``random`` data."""
+    if kind == 'random':
+        return os.urandom(size)
+    rng = random.Random(size)
+    data = bytearray()
+    while len(data) < size:
+        data += rng.choice(_WORDS) + b' '
+    return bytes(data[:size])
+
+
+def measure(func, duration=0.2, min_ops=5, max_ops=100000):
+    """Call `func` repeatedly, return the latency of each call in seconds.
+    """
+    timer = time.perf_counter
+    times = []
+    end = timer() + duration
+    while len(times) < max_ops:
+        start = timer()
+        func()
+        stop = timer()
+        times.append(stop - start)
+        if stop > end and len(times) >= min_ops:
+            break
+    return times
+
+
+def summarize(times, size):
+    """Return ops/s, MB/s and the 99th percentile latency in ms."""
+    total = sum(times) or 1e-9
+    times = sorted(times)
+    p99 = times[min(len(times) - 1, int(len(times) * 0.99))]
+    return dict(
+        ops=len(times),
+        ops_per_sec=len(times) / total,
+        mb_per_sec=len(times) * size / total / (1 << 20),
+        p99_ms=p99 * 1000,
+    )
+
+
+@contextlib.contextmanager
+def utility(name, directory):
+    """Use the ``trivial`` or a ``real`` encryption utility."""
+    old = encrypt_util.ENCRYPTION_UTILITY
+    if name == 'real':
+        keys = os.path.join(directory, 'keys')
+        os.makedirs(keys, exist_ok=True)
+        kek = os.path.join(directory, 'key.kek')
+        with open(kek, 'wb') as f:
+            f.write(testing.KeyEncyptingKey)
+        encrypt_util.ENCRYPTION_UTILITY = encrypt_util.EncryptionUtility(
+            kek, testing.TestingKeyManagementFacility(keys))
+    else:
+        encrypt_util.ENCRYPTION_UTILITY = (
+            encrypt_util.TrivialEncryptionUtility())
+    try:
+        yield
+    finally:
+        encrypt_util.ENCRYPTION_UTILITY = old
+
+
+def bench_records(sizes):
+    codec = compression.DEFAULT_CODEC
+    for kind in ('compressible', 'random'):
+        for size in sizes:
+            data = payload(size, kind)
+            name = '%s/%s' % (kind, size)
+            yield 'compress/' + name, size, lambda: compression.compress(
+                data, codec)
+            encrypted = cipher.encryptingstorage.encrypt(data)
+            yield 'encrypt/' + name, size, lambda: (
+                cipher.encryptingstorage.encrypt(data))
+            yield 'decrypt/' + name, size, lambda: (
+                cipher.encryptingstorage.decrypt(encrypted))
+
+
+def bench_blobs(sizes, directory):
+    for size in sizes:
+        source = os.path.join(directory, 'blob-%s' % size)
+        with open(source, 'wb') as f:
+            f.write(payload(size, 'random'))
+        work = source + '.work'
+        encrypted = source + '.encrypted'
+        shutil.copyfile(source, encrypted)
+        cipher.encryptingstorage.encrypt_file(encrypted)
+
+        def encrypt_file():
+            shutil.copyfile(source, work)
+            cipher.encryptingstorage.encrypt_file(work)
+
+        def decrypt_file():
+            with open(work, 'wb') as f:
+                cipher.encryptingstorage.decrypt_blob(encrypted, f)
+
+        yield 'encrypt_file/%s' % size, size, encrypt_file
+        yield 'decrypt_file/%s' % size, size, decrypt_file
+
+
+def bench_storages(sizes, directory):
+    for base in ('MappingStorage', 'FileStorage'):
+        for size in sizes:
+            if base == 'FileStorage':
+                path = os.path.join(directory, 'data-%s.fs' % size)
+                storage = ZODB.FileStorage.FileStorage(path)
+            else:
+                storage = ZODB.MappingStorage.MappingStorage()
+            store = cipher.encryptingstorage.EncryptingStorage(storage)
+            data = payload(size, 'compressible')
+            oids = []
+
+            def store_record():
+                oid = store.new_oid()
+                t = TransactionMetaData()
+                store.tpc_begin(t)
+                store.store(oid, ZODB.utils.z64, data, '', t)
+                store.tpc_vote(t)
+                store.tpc_finish(t)
+                oids.append(oid)
+
+            def load_record():
+                store.load(oids[random.randrange(len(oids))])
+
+            yield 'store/%s/%s' % (base, size), size, store_record
+            yield 'load/%s/%s' % (base, size), size, load_record
+            store.close()
+
+
+def run(sizes=SIZES, blob_sizes=BLOB_SIZES, duration=0.2, out=sys.stdout):
+    """Run all benchmarks, return the results by benchmark name."""
+    results = {}
+    directory = tempfile.mkdtemp()
+    try:
+        for name in ('trivial', 'real'):
+            with utility(name, directory):
+                # The benchmarks are generated lazily, each one is run
+                # before the next one is set up.
+                benchmarks = itertools.chain(
+                    bench_records(sizes),
+                    bench_blobs(blob_sizes, directory),
+                    bench_storages(sizes, directory))
+                for benchmark, size, func in benchmarks:
+                    benchmark = '%s/%s' % (name, benchmark)
+                    result = summarize(measure(func, duration), size)
+                    results[benchmark] = result
+                    print(_format(benchmark, result), file=out)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def _format(name, result):
+    return '%-50s %12.1f ops/s %10.2f MB/s %10.3f ms p99' % (
+        name, result['ops_per_sec'], result['mb_per_sec'], result['p99_ms'])
+
+
+def compare(results, baseline, threshold=0.1):
+    """Return the names of the benchmarks slower than in `baseline`.
+
+    A benchmark is slower if it does fewer operations per second than
+    `threshold` allows.
+    """
+    return sorted(
+        name for name, result in results.items()
+        if name in baseline and result['ops_per_sec'] < (
+            baseline[name]['ops_per_sec'] * (1 - threshold)))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--save', metavar='FILE', help='Save the results to FILE')
+    parser.add_argument(
+        '--compare', metavar='FILE',
+        help='Compare the results with those saved in FILE')
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='Allowed slowdown when comparing (default: 0.1, 10%%)')
+    parser.add_argument(
+        '--duration', type=float, default=0.2,
+        help='Seconds to run each benchmark for (default: 0.2)')
+    parser.add_argument(
+        '--sizes', type=lambda s: [int(size) for size in s.split(',')],
+        default=SIZES, help='Comma separated record sizes')
+    parser.add_argument(
+        '--blob-sizes', type=lambda s: [int(size) for size in s.split(',')],
+        default=BLOB_SIZES, help='Comma separated blob sizes')
+    options = parser.parse_args(args)
+
+    results = run(options.sizes, options.blob_sizes, options.duration)
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        slower = compare(results, baseline, options.threshold)
+        for name in slower:
+            print('REGRESSION %s: %.1f ops/s, was %.1f ops/s' % (
+                name, results[name]['ops_per_sec'],
+                baseline[name]['ops_per_sec']))
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
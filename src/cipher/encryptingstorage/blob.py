@@ -0,0 +1,507 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Chunked, authenticated blob encryption
+
+A chunked blob file starts with a header::
+
+    b'.c'  version (1 byte)  chunk size (4 bytes)  key ID (4 bytes)
+    nonce prefix (8 bytes)
+
+followed by the chunks.  The key ID tells which key of the keyring the
+file was encrypted with (see ``encrypt_util.key_id``).  Every chunk holds
+`chunk size` bytes of the blob (the last one may hold less) encrypted with
+AES-GCM, followed by its 16 byte tag.  The nonce of a chunk is the nonce
+prefix followed by the chunk index, and the header plus a flag marking
+the last chunk are authenticated with every chunk.  Chunks thus can't be
+modified, reordered or dropped unnoticed, and every chunk can be
+decrypted on its own.
+"""
+import collections
+import io
+import os
+import re
+import struct
+import tempfile
+import threading
+import time
+import weakref
+
+import zc.lockfile
+
+
+MAGIC = b'.c'
+VERSION = 1
+CHUNK_SIZE = 1 << 16
+MAX_CHUNK_SIZE = 1 << 24
+TAG_SIZE = 16
+NO_KEY_ID = b'\0' * 4
+
+_header = struct.Struct('>2sBI4s8s')
+
+
+class ChunkedWriter:
+    """Encrypt the data written to it into the chunked format.
+
+    The data is written to `fileobj`; `close` must be called to write the
+    last chunk.  `key_id` is the ID of the key `aead` uses.
+    """
+
+    def __init__(self, fileobj, aead, chunk_size=CHUNK_SIZE,
+                 key_id=NO_KEY_ID):
+        self._file = fileobj
+        self._aead = aead
+        self._chunk_size = chunk_size
+        self._prefix = os.urandom(8)
+        self._header = _header.pack(
+            MAGIC, VERSION, chunk_size, key_id, self._prefix)
+        self._index = 0
+        self._buffer = bytearray()
+        fileobj.write(self._header)
+
+    def _write_chunk(self, data, last):
+        nonce = self._prefix + struct.pack('>I', self._index)
+        self._file.write(self._aead.encrypt(
+            nonce, bytes(data), self._header + (b'\1' if last else b'\0')))
+        self._index += 1
+
+    def write(self, data):
+        buffer = self._buffer
+        buffer += data
+        size = self._chunk_size
+        # Keep at least one byte back, the last chunk is written on close.
+        if len(buffer) > size:
+            end = (len(buffer) - 1) // size * size
+            view = memoryview(buffer)
+            for pos in range(0, end, size):
+                self._write_chunk(view[pos:pos + size], False)
+            view.release()
+            del buffer[:end]
+        return len(data)
+
+    def close(self):
+        if self._buffer is not None:
+            self._write_chunk(self._buffer, True)
+            self._buffer = None
+
+
+def encrypt_stream(fsrc, fdst, aead, chunk_size=CHUNK_SIZE,
+                   key_id=NO_KEY_ID):
+    """Encrypt everything read from `fsrc` into `fdst`."""
+    writer = ChunkedWriter(fdst, aead, chunk_size, key_id)
+    while True:
+        data = fsrc.read(chunk_size)
+        if not data:
+            break
+        writer.write(data)
+    writer.close()
+
+
+class DecryptingReader(io.RawIOBase):
+    """Raw file object decrypting a chunked blob file while reading it.
+
+    `fileobj` must be positioned at the start of the header.  The reader
+    is seekable; only the chunks that are read from are decrypted.  Wrap
+    it in an ``io.BufferedReader`` for efficient small reads.
+
+    :raises ValueError: when reading data that fails authentication.
+    """
+
+    def __init__(self, fileobj, aead):
+        self._file = fileobj
+        self._aead = aead
+        self._header = header = fileobj.read(_header.size)
+        if len(header) != _header.size:
+            raise ValueError('Truncated chunked blob header')
+        magic, version, chunk_size, _, self._prefix = _header.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Not a chunked blob file')
+        self._chunk_size = chunk_size
+        self._stored_chunk_size = chunk_size + TAG_SIZE
+        stored = os.fstat(fileobj.fileno()).st_size - _header.size
+        self._chunks = max(1, -(-stored // self._stored_chunk_size))
+        last = stored - (self._chunks - 1) * self._stored_chunk_size
+        if last < TAG_SIZE:
+            # Every chunk, including the last one, holds at least its tag.
+            raise ValueError('Truncated chunked blob file')
+        self.size = (self._chunks - 1) * chunk_size + last - TAG_SIZE
+        self._pos = 0
+        self._cached = (None, b'')
+        self._filename = getattr(fileobj, 'name', None)
+        # The name of a file is for reopening it: the encrypted file's
+        # would read the ciphertext.
+        self.name = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        elif whence != io.SEEK_SET:
+            raise ValueError('Invalid whence (%r)' % whence)
+        if offset < 0:
+            raise ValueError('Negative seek position %s' % offset)
+        self._pos = offset
+        return offset
+
+    def tell(self):
+        return self._pos
+
+    def _chunk(self, index):
+        cached_index, data = self._cached
+        if cached_index == index:
+            return data
+        self._file.seek(_header.size + index * self._stored_chunk_size)
+        stored = self._file.read(self._stored_chunk_size)
+        last = index == self._chunks - 1
+        try:
+            data = self._aead.decrypt(
+                self._prefix + struct.pack('>I', index), stored,
+                self._header + (b'\1' if last else b'\0'))
+        except ValueError:
+            raise ValueError(
+                'Chunk %s of %s failed authentication' % (
+                    index, self._filename or 'blob'))
+        self._cached = index, data
+        return data
+
+    def readinto(self, buffer):
+        pos = self._pos
+        if pos >= self.size:
+            return 0
+        index, offset = divmod(pos, self._chunk_size)
+        data = self._chunk(index)
+        n = min(len(buffer), len(data) - offset)
+        buffer[:n] = data[offset:offset + n]
+        self._pos = pos + n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+
+def key_id(fileobj):
+    """Return the key ID of a chunked blob file, None if it isn't one.
+
+    Plain files may start with the magic, too, so the whole header is
+    checked: the version and a chunk size a writer would use.  A truncated
+    file is still a chunked file, reading it fails.  `fileobj` keeps its
+    position, the start of the header.
+    """
+    pos = fileobj.tell()
+    try:
+        header = fileobj.read(_header.size)
+    finally:
+        fileobj.seek(pos)
+    if len(header) != _header.size:
+        return None
+    magic, version, chunk_size, key, _ = _header.unpack(header)
+    if (magic != MAGIC or version != VERSION
+            or not 0 < chunk_size <= MAX_CHUNK_SIZE):
+        return None
+    return key
+
+
+def is_chunked(fileobj):
+    """Tell whether `fileobj` is a chunked blob file, keeping its position.
+    """
+    return key_id(fileobj) is not None
+
+
+class DecryptedBlobFile(io.BufferedReader):
+    """A read-only blob file decrypting a chunked blob file on demand.
+
+    Like ``ZODB.blob.BlobFile``, the `blob` it was opened for, if any, is
+    told when the file is closed.  Unlike it, its ``name`` is None: there
+    is no file with the decrypted content to reopen.
+    """
+
+    def __init__(self, filename, aead, blob=None):
+        super().__init__(
+            DecryptingReader(open(filename, 'rb'), aead), CHUNK_SIZE)
+        self.blob = blob
+
+    def close(self):
+        if self.blob is not None:
+            self.blob.closed(self)
+        super().close()
+
+    def __reduce__(self):
+        raise TypeError("Pickling a BlobFile is not allowed")
+
+
+def open_decrypted(filename, aead, blob=None):
+    """Open a chunked blob file for reading its decrypted content."""
+    return DecryptedBlobFile(filename, aead, blob)
+
+
+class AsyncBlobReader:
+    """Read a blob file from coroutines.
+
+    Reads, seeks and closing run in the threads of `pool`, a
+    ``workers.AsyncPool``, so the chunks are decrypted without blocking the
+    event loop.  Iterating with ``async for`` reads the file in blocks of
+    `block_size` bytes.
+    """
+
+    def __init__(self, fileobj, pool, block_size=CHUNK_SIZE):
+        self.file = fileobj
+        self.block_size = block_size
+        self._pool = pool
+
+    async def read(self, size=-1):
+        return await self._pool.run(self.file.read, size)
+
+    async def seek(self, offset, whence=io.SEEK_SET):
+        return await self._pool.run(self.file.seek, offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    async def close(self):
+        await self._pool.run(self.file.close)
+
+    @property
+    def closed(self):
+        return self.file.closed
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        data = await self.read(self.block_size)
+        if not data:
+            raise StopAsyncIteration
+        return data
+
+
+# Names of the directories and files the blob layouts of ZODB use, like
+# ``0x00/0x2a/0x03c5.blob``, and the prefix of the temporary files of a
+# `BlobCache`.  Other files in the cache directory aren't the cache's.
+_oid_directory = re.compile(r'0x[0-9a-fA-F]+$')
+_blob_file = re.compile(r'0x[0-9a-fA-F]+\.blob$')
+_TEMPORARY_PREFIX = '.cipher-blob-cache-'
+
+
+def _is_temporary(name):
+    return name.startswith(_TEMPORARY_PREFIX) and name.endswith('.tmp')
+
+
+class _CachedPath(str):
+    # The path of a cached file, the file is kept while it's referenced.
+    __slots__ = ('__weakref__',)
+
+
+def _lock_file(path):
+    # Lock the directory of `path` against other processes.
+    lockfilename = os.path.join(os.path.dirname(path), '.lock')
+    n = 0
+    while 1:
+        try:
+            return zc.lockfile.LockFile(lockfilename)
+        except zc.lockfile.LockError:
+            time.sleep(0.01)
+            n += 1
+            if n > 60000:
+                raise
+
+
+class BlobCache:
+    """Size-bounded cache of decrypted blob files in `directory`.
+
+    Files are kept up to `size` bytes in total (no limit if None); the
+    least recently used files are removed first.  Files are written to a
+    temporary file and renamed when complete, so readers never see a
+    partially written file.  `stats` counts hits, misses and evictions.
+
+    Every file is written once: threads asking for a file that is being
+    written wait for it, and so do other processes sharing the directory.
+
+    The directory may be shared with other files: only blob files in oid
+    directories found in it when the cache is created are taken over,
+    and only temporary files the cache left behind are removed.
+
+    A file isn't evicted while the path returned for it is referenced:
+    blobs keep it as their committed file, and ZODB opens it directly
+    (when a blob is opened for appending, say).  It's removed once the
+    blobs are released and the cache is over its size again.  Neither
+    are files evicted that can't be removed right now (open on Windows,
+    say).
+    """
+
+    def __init__(self, directory, size=None):
+        self.directory = directory
+        self.size = size
+        self.bytes = 0
+        self.stats = dict(hits=0, misses=0, evictions=0)
+        # path -> size, least recently used first
+        self._files = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # path -> [lock, number of threads using it]
+        self._flights = {}
+        # path -> the _CachedPath returned for it, while it's referenced
+        self._handed_out = weakref.WeakValueDictionary()
+        self._scan()
+
+    def _scan(self):
+        files = []
+        for path, dirnames, names in os.walk(self.directory):
+            dirnames[:] = [name for name in dirnames
+                           if _oid_directory.match(name)]
+            if path == self.directory:
+                continue
+            temporary = [name for name in names if _is_temporary(name)]
+            if temporary:
+                self._remove_temporary(path, temporary)
+            for name in names:
+                if not _blob_file.match(name):
+                    continue
+                filename = os.path.join(path, name)
+                try:
+                    stat = os.stat(filename)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_atime, filename, stat.st_size))
+        for _, filename, size in sorted(files):
+            self._files[filename] = size
+            self.bytes += size
+        with self._lock:
+            self._evict()
+
+    def _remove_temporary(self, path, names):
+        # Remove files left behind by interrupted writes, unless another
+        # process is writing in the directory right now.
+        try:
+            lock = zc.lockfile.LockFile(os.path.join(path, '.lock'))
+        except zc.lockfile.LockError:
+            return
+        try:
+            for name in names:
+                try:
+                    os.remove(os.path.join(path, name))
+                except FileNotFoundError:
+                    pass
+        finally:
+            lock.close()
+
+    def get(self, name, write):
+        """Return the path of the cached file `name`.
+
+        If the file isn't cached, ``write(f)`` is called to write its
+        content to the open file `f` first.
+        """
+        path = os.path.join(self.directory, name)
+        cached = self._hit(path)
+        if cached is not None:
+            return cached
+
+        with self._lock:
+            flight = self._flights.get(path)
+            if flight is None:
+                flight = self._flights[path] = [threading.Lock(), 0]
+            flight[1] += 1
+        try:
+            with flight[0]:
+                # Another thread may have written it meanwhile.
+                cached = self._hit(path)
+                if cached is not None:
+                    return cached
+                directory = os.path.dirname(path)
+                os.makedirs(directory, 0o700, exist_ok=True)
+                lock = _lock_file(path)
+                try:
+                    if os.path.exists(path):
+                        # Written by another process.
+                        return self._add(
+                            path, os.path.getsize(path), 'hits')
+                    fd, tmp = tempfile.mkstemp(
+                        '.tmp', _TEMPORARY_PREFIX, directory)
+                    try:
+                        with os.fdopen(fd, 'wb') as f:
+                            write(f)
+                        size = os.path.getsize(tmp)
+                        os.replace(tmp, path)
+                    except BaseException:
+                        os.remove(tmp)
+                        raise
+                finally:
+                    lock.close()
+                return self._add(path, size, 'misses')
+        finally:
+            with self._lock:
+                flight[1] -= 1
+                if not flight[1]:
+                    del self._flights[path]
+
+    def cached(self, name):
+        """Return the path of the cached file `name`, None if not cached.
+        """
+        return self._hit(os.path.join(self.directory, name))
+
+    def _hit(self, path):
+        with self._lock:
+            if path in self._files and os.path.exists(path):
+                self._files.move_to_end(path)
+                self.stats['hits'] += 1
+                return self._hand_out(path)
+        return None
+
+    def _add(self, path, size, counter):
+        with self._lock:
+            self.stats[counter] += 1
+            self.bytes += size - self._files.pop(path, 0)
+            self._files[path] = size
+            result = self._hand_out(path)
+            self._evict()
+            return result
+
+    def _hand_out(self, path):
+        result = self._handed_out.get(path)
+        if result is None:
+            result = self._handed_out[path] = _CachedPath(path)
+        return result
+
+    def _evict(self):
+        if self.size is None or self.bytes <= self.size:
+            return
+        for path, size in list(self._files.items()):
+            if self.bytes <= self.size:
+                break
+            if path in self._handed_out:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            del self._files[path]
+            self.bytes -= size
+            self.stats['evictions'] += 1
+
+    def __len__(self):
+        return len(self._files)
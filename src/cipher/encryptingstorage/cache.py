@@ -0,0 +1,88 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Decrypted record cache
+"""
+import collections
+import threading
+
+
+class RecordCache:
+    """Cache of decrypted records shared by all connections of a storage.
+
+    Records are keyed by ``(oid, serial)``; a revision never changes, so
+    it only needs to be decrypted once.  The cache holds up to `size`
+    bytes of record data, the least recently used records are dropped
+    first.  `stats` counts hits, misses and evictions.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.bytes = 0
+        self.stats = dict(hits=0, misses=0, evictions=0)
+        # (oid, serial) -> data, least recently used first
+        self._records = collections.OrderedDict()
+        # oid -> serials of the oid in the cache
+        self._serials = {}
+        self._lock = threading.Lock()
+
+    def get(self, oid, serial):
+        """Return the cached record data, or None."""
+        key = oid, serial
+        with self._lock:
+            data = self._records.get(key)
+            if data is None:
+                self.stats['misses'] += 1
+            else:
+                self._records.move_to_end(key)
+                self.stats['hits'] += 1
+            return data
+
+    def set(self, oid, serial, data):
+        if data is None or len(data) > self.size:
+            return
+        key = oid, serial
+        with self._lock:
+            old = self._records.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old)
+            self._records[key] = data
+            self._serials.setdefault(oid, set()).add(serial)
+            self.bytes += len(data)
+            while self.bytes > self.size:
+                key, data = self._records.popitem(last=False)
+                self._forget(*key)
+                self.bytes -= len(data)
+                self.stats['evictions'] += 1
+
+    def _forget(self, oid, serial):
+        serials = self._serials[oid]
+        serials.discard(serial)
+        if not serials:
+            del self._serials[oid]
+
+    def invalidate(self, oids):
+        """Drop all cached revisions of `oids`."""
+        with self._lock:
+            for oid in oids:
+                for serial in self._serials.pop(oid, ()):
+                    self.bytes -= len(self._records.pop((oid, serial)))
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+            self._serials.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._records)
@@ -0,0 +1,368 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Compression codecs
+
+Every compressed record starts with the two byte tag of the codec that
+compressed it, so records compressed with different codecs can be mixed
+in one database.  Tags start with a ``.``, which a pickle can't start with.
+"""
+import functools
+import logging
+import random
+import threading
+import zlib
+
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class ZlibCodec:
+
+    name = 'zlib'
+    tag = b'.z'
+    available = True
+
+    def __init__(self, level=-1):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+    def __repr__(self):
+        return '<%s level=%s>' % (self.__class__.__name__, self.level)
+
+
+class ZstdCodec(ZlibCodec):
+    """Zstandard, needs the ``zstandard`` package."""
+
+    name = 'zstd'
+    tag = b'.s'
+    available = zstandard is not None
+
+    def __init__(self, level=3):
+        self.level = level
+        # Compression and decompression contexts aren't thread-safe.
+        self._local = threading.local()
+
+    def compress(self, data):
+        try:
+            compressor = self._local.compressor
+        except AttributeError:
+            compressor = self._local.compressor = zstandard.ZstdCompressor(
+                self.level)
+        return compressor.compress(data)
+
+    def decompress(self, data):
+        if zstandard is None:
+            raise ImportError(
+                'The zstandard package is needed to decompress this record')
+        try:
+            decompressor = self._local.decompressor
+        except AttributeError:
+            decompressor = self._local.decompressor = (
+                zstandard.ZstdDecompressor())
+        return decompressor.decompress(data)
+
+
+class ZstdDictCodec(ZstdCodec):
+    """Zstandard with a trained dictionary, needs the ``zstandard`` package.
+
+    Small records, like most persistent object pickles, hardly compress on
+    their own.  With a dictionary trained on similar records, they do.
+    The dictionary ID is part of every compressed record; all dictionaries
+    records were compressed with must be registered to read them.
+    """
+
+    tag = b'.d'
+
+    def __init__(self, dictionary, level=3):
+        super().__init__(level)
+        self.dictionary = registerDictionary(dictionary)
+
+    def compress(self, data):
+        try:
+            compressor = self._local.compressor
+        except AttributeError:
+            compressor = self._local.compressor = zstandard.ZstdCompressor(
+                self.level, dict_data=self.dictionary)
+        return compressor.compress(data)
+
+    def __repr__(self):
+        return '<%s level=%s dict_id=%s>' % (
+            self.__class__.__name__, self.level, self.dictionary.dict_id())
+
+
+class Lz4Codec(ZlibCodec):
+    """LZ4 frames, needs the ``lz4`` package."""
+
+    name = 'lz4'
+    tag = b'.l'
+    available = lz4 is not None
+
+    def __init__(self, level=0):
+        self.level = level
+
+    def compress(self, data):
+        return lz4.frame.compress(data, compression_level=self.level)
+
+    def decompress(self, data):
+        if lz4 is None:
+            raise ImportError(
+                'The lz4 package is needed to decompress this record')
+        return lz4.frame.decompress(data)
+
+
+CODECS = {codec.name: codec for codec in (ZlibCodec, ZstdCodec, Lz4Codec)}
+
+_dictionaries = {}
+_local = threading.local()
+
+
+def registerDictionary(dictionary):
+    """Make a zstd dictionary known for decompression.
+
+    `dictionary` is the dictionary data, as returned by `train_dictionary`.
+    Returns the ``zstandard.ZstdCompressionDict``.
+    """
+    if zstandard is None:
+        raise ImportError(
+            'The zstandard package is needed for compression dictionaries')
+    if not isinstance(dictionary, zstandard.ZstdCompressionDict):
+        dictionary = zstandard.ZstdCompressionDict(dictionary)
+    _dictionaries[dictionary.dict_id()] = dictionary
+    return dictionary
+
+
+def _decompress_with_dictionary(data):
+    if zstandard is None:
+        raise ImportError(
+            'The zstandard package is needed to decompress this record')
+    dict_id = zstandard.get_frame_parameters(data).dict_id
+    try:
+        decompressors = _local.decompressors
+    except AttributeError:
+        decompressors = _local.decompressors = {}
+    decompressor = decompressors.get(dict_id)
+    if decompressor is None:
+        try:
+            dictionary = _dictionaries[dict_id]
+        except KeyError:
+            raise ValueError(
+                'The compression dictionary %s is not registered' % dict_id)
+        decompressor = decompressors[dict_id] = zstandard.ZstdDecompressor(
+            dict_data=dictionary)
+    return decompressor.decompress(data)
+
+
+_decompressors = {codec.tag: codec().decompress for codec in CODECS.values()}
+_decompressors[ZstdDictCodec.tag] = _decompress_with_dictionary
+
+
+def getCodec(name='zlib', level=None, dictionaries=()):
+    """Return a codec instance for the codec called `name`.
+
+    The default level of the codec is used unless `level` is given.  When
+    the library needed by the codec isn't installed, zlib is used instead.
+
+    Zstd can use compression `dictionaries`: the first one compresses new
+    records, all of them are registered to read older records.
+    """
+    try:
+        factory = CODECS[name]
+    except KeyError:
+        raise ValueError('Unknown compression codec %r' % name)
+    if dictionaries and factory is not ZstdCodec:
+        raise ValueError('The %s codec does not support dictionaries' % name)
+    if not factory.available:
+        logger.warning(
+            'The %s compression codec is not available, using zlib', name)
+        return ZlibCodec()
+    if dictionaries:
+        for dictionary in dictionaries[1:]:
+            registerDictionary(dictionary)
+        factory = functools.partial(ZstdDictCodec, dictionaries[0])
+    return factory() if level is None else factory(level)
+
+
+class AdaptiveCodec:
+    """Wrap a codec to skip compressing payloads that won't shrink.
+
+    Already compressed data (images, archives, ...) doesn't compress, but
+    compressing it to find out costs as much as compressing anything else.
+    To avoid that, the outcome is remembered per pickled class (the start
+    of a ZODB record), and classes whose records almost never shrink are
+    only probed now and then.  Large payloads are probed by compressing a
+    few small samples first.
+
+    `stats` counts the records that were compressed, that were compressed
+    but hardly got smaller (incompressible) and that were skipped.
+    """
+
+    # Records at least this big are sampled before being compressed.
+    sample_threshold = 8192
+    sample_size = 512
+    # Payloads (or samples) whose compressed size is more than this share
+    # of the original are considered incompressible.
+    max_ratio = 0.9
+    # A class is skipped after this many probed records of which at most
+    # the given share were compressible.  After `reprobe` skipped records
+    # the class is probed again.
+    min_records = 8
+    min_compressible = 0.1
+    reprobe = 64
+    max_classes = 1000
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.name = codec.name
+        self.tag = codec.tag
+        self.decompress = codec.decompress
+        self.stats = dict(compressed=0, incompressible=0, skipped=0)
+        # class -> [probed, compressible, skipped since last probe]
+        self._classes = {}
+
+    def _incompressible(self, counts):
+        probed, compressible, skipped = counts
+        return (probed >= self.min_records
+                and compressible <= probed * self.min_compressible)
+
+    def compress(self, data):
+        size = len(data)
+        # ZODB records start with the pickled class: b'\x80\x03cmod\nName\n'
+        head = bytes(data[:200])
+        end = head.find(b'\n', head.find(b'\n') + 1)
+        key = head[:end] if end > 0 else None
+        counts = self._classes.get(key)
+        if counts is not None and self._incompressible(counts):
+            if counts[2] < self.reprobe:
+                counts[2] += 1
+                self.stats['skipped'] += 1
+                return data
+            counts[2] = 0
+
+        if size >= self.sample_threshold:
+            n = self.sample_size
+            middle = size // 2
+            sample = b''.join(
+                (data[:n], data[middle:middle + n], data[-n:]))
+            if len(zlib.compress(sample, 1)) > len(sample) * self.max_ratio:
+                self._count(key, False)
+                self.stats['skipped'] += 1
+                return data
+
+        compressed = self.codec.compress(data)
+        compressible = len(compressed) <= size * self.max_ratio
+        self._count(key, compressible)
+        self.stats['compressed' if compressible else 'incompressible'] += 1
+        return compressed
+
+    def _count(self, key, compressible):
+        if key is None:
+            return
+        counts = self._classes.get(key)
+        if counts is None:
+            if len(self._classes) >= self.max_classes:
+                self._classes.clear()
+            counts = self._classes[key] = [0, 0, 0]
+        elif compressible and self._incompressible(counts):
+            # The class changed its mind, forget about the past.
+            counts[:] = [0, 0, 0]
+        counts[0] += 1
+        counts[1] += compressible
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.codec)
+
+
+def train_dictionary(storage, size=16384, samples=10000):
+    """Train a zstd compression dictionary on the records of `storage`.
+
+    Up to `samples` records are picked at random from the records seen by
+    ``storage.iterator()``.  When `storage` is an encrypting storage, its
+    iterator yields the decrypted and decompressed records, as needed.
+    Returns the dictionary data; its ID is part of the data.
+    """
+    if zstandard is None:
+        raise ImportError(
+            'The zstandard package is needed for compression dictionaries')
+    sample = []
+    seen = 0
+    it = storage.iterator()
+    try:
+        for trans in it:
+            for record in trans:
+                if not record.data:
+                    continue
+                seen += 1
+                if len(sample) < samples:
+                    sample.append(record.data)
+                else:
+                    i = random.randrange(seen)
+                    if i < samples:
+                        sample[i] = record.data
+    finally:
+        close = getattr(it, 'close', None)
+        if close is not None:
+            close()
+    return zstandard.train_dictionary(size, sample).as_bytes()
+
+
+DEFAULT_CODEC = ZlibCodec()
+
+# Records of up to this many bytes aren't compressed.
+MIN_SIZE = 20
+
+
+def compress_parts(data, codec=DEFAULT_CODEC, min_size=MIN_SIZE):
+    """Compress `data`, return the codec tag and the compressed data.
+
+    The tag is empty and `data` returned as is if it doesn't shrink, has
+    no more than `min_size` bytes or `codec` is None.  The two are
+    returned separately so that they can be written out without
+    concatenating them first.
+    """
+    if (codec is not None and data and len(data) > min_size
+            and bytes(data[:2]) not in _decompressors):
+        compressed = codec.compress(data)
+        if len(compressed) + 2 < len(data):
+            return codec.tag, compressed
+    return b'', data
+
+
+def compress(data, codec=DEFAULT_CODEC, min_size=MIN_SIZE):
+    tag, data = compress_parts(data, codec, min_size)
+    return tag + data if tag else data
+
+
+def decompress(data):
+    """Decompress the bytes-like `data`, or return it as is.
+
+    The tag is skipped with a memoryview, the compressed data isn't copied.
+    """
+    decompress = _decompressors.get(bytes(data[:2]))
+    return data if decompress is None else decompress(memoryview(data)[2:])
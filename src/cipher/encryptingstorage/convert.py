@@ -0,0 +1,361 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Copy all transactions of a storage into another one
+
+Run with::
+
+    encryptingstorage-convert [--workers N] [--raw] [--incremental] CONFIG
+
+The configuration file names a ``<source>`` and a ``<destination>``
+storage, like the one of ``zodbconvert``::
+
+    %import cipher.encryptingstorage
+
+    <encryptingstorage source>
+      config encryption.conf
+      <filestorage>
+        path old/Data.fs
+        blob-dir old/blobs
+      </filestorage>
+    </encryptingstorage>
+
+    <encryptingstorage destination>
+      config encryption.conf
+      <filestorage>
+        path new/Data.fs
+        blob-dir new/blobs
+      </filestorage>
+    </encryptingstorage>
+
+Unlike ``copyTransactionsFrom``, records and blob files are decrypted and
+encrypted again in worker processes, while the transactions are written to
+the destination in their order.  Each storage uses its own encryption
+configuration, so a database can be copied to new keys.  With ``--raw``,
+the records and blob files are copied as they are stored instead, for
+destinations read with the same keys.
+"""
+import argparse
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import ZConfig
+import ZODB.blob
+import ZODB.interfaces
+import ZODB.utils
+from ZODB.POSException import POSKeyError
+
+import cipher.encryptingstorage
+from cipher.encryptingstorage import workers
+
+
+SCHEMA = """\
+<schema>
+  <import package="ZODB" />
+  <section type="ZODB.storage" name="source" attribute="source"
+           required="yes" />
+  <section type="ZODB.storage" name="destination" attribute="destination"
+           required="yes" />
+</schema>
+"""
+
+# Number of records recoded by one task.
+BATCH_SIZE = 256
+
+# The transform of the destination, its temporary directory and the
+# encryption utilities of the source and the destination, set in the
+# workers.
+_worker = threading.local()
+
+
+def _init_worker(transform, temp_dir, source_utility=None,
+                 destination_utility=None):
+    _worker.state = transform, temp_dir, source_utility, destination_utility
+
+
+def _recode(records):
+    """Decrypt and encrypt records for the destination.
+
+    `records` are pairs of record data and the name of the blob file of
+    the record in the source if it had one.  Returns triples of the new
+    record data, whether it's a blob record and the name of the blob file
+    written for the destination (or None).
+    """
+    transform, temp_dir, source_utility, destination_utility = _worker.state
+    result = []
+    for data, blob_filename in records:
+        if data is None:
+            result.append((None, False, None))
+            continue
+        data = cipher.encryptingstorage.decrypt(data, source_utility)
+        is_blob = ZODB.blob.is_blob_record(data)
+        filename = None
+        if (is_blob and blob_filename is not None and temp_dir is not None
+                and os.path.exists(blob_filename)):
+            filename = _recode_blob(
+                blob_filename, temp_dir, transform is not None,
+                source_utility, destination_utility)
+        if transform is not None:
+            data = transform(data)
+        result.append((data, is_blob, filename))
+    return result
+
+
+def _recode_blob(filename, temp_dir, encrypt, source_utility,
+                 destination_utility):
+    fd, name = tempfile.mkstemp(suffix='.tmp', dir=temp_dir)
+    with os.fdopen(fd, 'wb') as f:
+        cipher.encryptingstorage.decrypt_blob(filename, f, source_utility)
+    if encrypt:
+        cipher.encryptingstorage.encrypt_file(name, destination_utility)
+    return name
+
+
+def _base(storage):
+    if isinstance(storage, cipher.encryptingstorage.EncryptingStorage):
+        return storage.base
+    return storage
+
+
+class Converter:
+    """Copy the transactions of `source` to the empty `destination`.
+
+    Records are read from the base storage of `source` and written to the
+    base storage of `destination` (when they are encrypting storages) with
+    ``restore`` and ``restoreBlob``, so transaction ids and metadata are
+    kept.  In between, the records and blob files are decrypted and
+    transformed for `destination` by `workers` processes (threads where
+    processes can't be forked), in batches of `batch_size` records.  With
+    `raw`, they are copied as they are.
+
+    The transactions after the last one of `destination` are copied if
+    `incremental` is true.  Progress is printed to `out` every `progress`
+    seconds; `stats` counts transactions, records, blobs and bytes.
+    """
+
+    def __init__(self, source, destination, workers=None, raw=False,
+                 batch_size=BATCH_SIZE, incremental=False, out=None,
+                 progress=10):
+        self.source = source
+        self.destination = destination
+        self.workers = workers or os.cpu_count() or 1
+        self.raw = raw
+        self.batch_size = batch_size
+        self.incremental = incremental
+        self.out = out
+        self.progress = progress
+        self.stats = dict(transactions=0, records=0, blobs=0, bytes=0)
+        if raw:
+            encrypting = [
+                isinstance(storage, cipher.encryptingstorage.EncryptingStorage)
+                for storage in (source, destination)]
+            if encrypting[0] != encrypting[1]:
+                raise ValueError(
+                    'Records can only be copied raw between storages that'
+                    ' are both encrypting or both not encrypting')
+
+    def run(self):
+        """Copy the transactions, return `stats`."""
+        source = _base(self.source)
+        destination = _base(self.destination)
+        start = None
+        last = destination.lastTransaction()
+        if last != ZODB.utils.z64:
+            if not self.incremental:
+                raise ValueError('The destination storage is not empty')
+            start = ZODB.utils.p64(ZODB.utils.u64(last) + 1)
+        self._start = self._reported = time.monotonic()
+        iterator = source.iterator(start)
+        try:
+            if self.raw:
+                for trans in iterator:
+                    records = [(r.oid, r.tid, r.data, r.data_txn)
+                               for r in trans]
+                    self._write(trans, records, self._raw(records))
+            else:
+                self._pipeline(iterator)
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+        self._report()
+        return self.stats
+
+    def _pipeline(self, iterator):
+        destination = _base(self.destination)
+        temp_dir = None
+        if ZODB.interfaces.IBlobStorage.providedBy(destination):
+            temp_dir = destination.temporaryDirectory()
+        transform = None
+        if getattr(self.destination, '_encrypt', False):
+            transform = self.destination._transform
+        worker = (transform, temp_dir, getattr(self.source, 'utility', None),
+                  getattr(self.destination, 'utility', None))
+        with workers.executor(self.workers, _init_worker, worker) as executor:
+            for transactions, results in workers.imap(
+                    executor, _recode, self._batches(iterator),
+                    self.workers):
+                self._drain(transactions, results)
+
+    def _batches(self, iterator):
+        # The `_recode` tasks, each with the transactions whose records it
+        # recodes (the last one may continue in the next task).
+        fshelper = getattr(_base(self.source), 'fshelper', None)
+        batch = []
+        transactions = []
+        for trans in iterator:
+            records = [(r.oid, r.tid, r.data, r.data_txn) for r in trans]
+            transactions.append((trans, records))
+            for oid, tid, data, _ in records:
+                blob_filename = None
+                if fshelper is not None and data:
+                    blob_filename = fshelper.getBlobFilename(oid, tid)
+                batch.append((data, blob_filename))
+            if len(batch) >= self.batch_size:
+                yield (batch,), transactions
+                batch = []
+                transactions = []
+        if transactions:
+            yield (batch,), transactions
+
+    def _drain(self, transactions, results):
+        results = iter(results)
+        for trans, records in transactions:
+            self._write(trans, records, [
+                self._blob(oid, tid, *next(results))
+                for oid, tid, _, _ in records])
+
+    def _blob(self, oid, tid, data, is_blob, filename):
+        # Blobs of storages without a blob directory are recoded here.
+        if is_blob and filename is None:
+            try:
+                source_filename = self.source.loadBlob(oid, tid)
+            except (POSKeyError, AttributeError):
+                pass
+            else:
+                destination = _base(self.destination)
+                if not ZODB.interfaces.IBlobStorage.providedBy(destination):
+                    raise ValueError(
+                        "The destination storage doesn't support blobs")
+                fd, filename = tempfile.mkstemp(
+                    suffix='.tmp', dir=destination.temporaryDirectory())
+                os.close(fd)
+                shutil.copyfile(source_filename, filename)
+                if getattr(self.destination, '_encrypt', False):
+                    cipher.encryptingstorage.encrypt_file(
+                        filename, self.destination.utility)
+        return data, filename
+
+    def _raw(self, records):
+        source = _base(self.source)
+        destination = _base(self.destination)
+        result = []
+        for oid, tid, data, _ in records:
+            filename = None
+            if data is not None:
+                try:
+                    source_filename = source.loadBlob(oid, tid)
+                except (POSKeyError, AttributeError):
+                    pass
+                else:
+                    fd, filename = tempfile.mkstemp(
+                        suffix='.tmp', dir=destination.temporaryDirectory())
+                    os.close(fd)
+                    shutil.copyfile(source_filename, filename)
+            result.append((data, filename))
+        return result
+
+    def _write(self, trans, records, results):
+        destination = _base(self.destination)
+        stats = self.stats
+        destination.tpc_begin(trans, trans.tid, trans.status)
+        for (oid, tid, data, data_txn), (new_data, filename) in zip(
+                records, results):
+            stats['records'] += 1
+            stats['bytes'] += len(data or b'')
+            if filename is not None:
+                stats['blobs'] += 1
+                stats['bytes'] += os.path.getsize(filename)
+                destination.restoreBlob(
+                    oid, tid, new_data, filename, data_txn, trans)
+            else:
+                destination.restore(oid, tid, new_data, '', data_txn, trans)
+        destination.tpc_vote(trans)
+        destination.tpc_finish(trans)
+        stats['transactions'] += 1
+        if (self.out is not None
+                and time.monotonic() - self._reported >= self.progress):
+            self._report()
+
+    def _report(self):
+        now = self._reported = time.monotonic()
+        if self.out is None:
+            return
+        stats = self.stats
+        seconds = max(now - self._start, 1e-9)
+        print('%d transactions, %d records, %d blobs, %.1f MB: '
+              '%.1f transactions/s, %.1f records/s, %.2f MB/s' % (
+                  stats['transactions'], stats['records'], stats['blobs'],
+                  stats['bytes'] / (1 << 20),
+                  stats['transactions'] / seconds,
+                  stats['records'] / seconds,
+                  stats['bytes'] / seconds / (1 << 20)),
+              file=self.out)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        'config', help='Configuration file with a source and a destination'
+        ' storage')
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help='Number of worker processes (default: the number of CPUs)')
+    parser.add_argument(
+        '--raw', action='store_true',
+        help='Copy records and blob files without decrypting them')
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='Copy the transactions after the last one of the destination')
+    parser.add_argument(
+        '--batch-size', type=int, default=BATCH_SIZE,
+        help='Records recoded by one task (default: %s)' % BATCH_SIZE)
+    parser.add_argument(
+        '--progress', type=float, default=10,
+        help='Seconds between progress reports (default: 10)')
+    options = parser.parse_args(args)
+
+    schema = ZConfig.loadSchemaFile(io.StringIO(SCHEMA))
+    config, _ = ZConfig.loadConfig(schema, options.config)
+    source = config.source.open()
+    try:
+        destination = config.destination.open()
+        try:
+            Converter(
+                source, destination, options.workers, options.raw,
+                options.batch_size, options.incremental, sys.stdout,
+                options.progress).run()
+        finally:
+            destination.close()
+    finally:
+        source.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -11,15 +11,70 @@
 # FOR A PARTICULAR PURPOSE.
 #
 ##############################################################################
+import collections
+import hmac
+import http.client
+import logging
 import os
 import shutil
+import threading
+import time
 from configparser import RawConfigParser
+from hashlib import md5
+from hashlib import sha256
+from urllib.parse import urlparse
 
 import zope.component
 import zope.interface
+from Crypto.Cipher import AES
 from keas.kmi import facility
 from keas.kmi.interfaces import IKeyHolder
 
+from cipher.encryptingstorage import metrics
+
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers import Cipher
+    from cryptography.hazmat.primitives.ciphers import aead as native_aead
+    from cryptography.hazmat.primitives.ciphers import algorithms
+    from cryptography.hazmat.primitives.ciphers import modes
+except ImportError:
+    native_aead = None
+
+
+logger = logging.getLogger(__name__)
+
+# Encrypted records in the authenticated format start with this version
+# byte (after the b'.e' marker), followed by the key ID and the nonce.
+SEALED = b'\x01'
+KEY_ID_SIZE = 4
+NONCE_SIZE = 12
+TAG_SIZE = 16
+RECORD_FORMATS = ('gcm', 'cbc')
+
+_record_aad = b'.e' + SEALED
+
+# Records are written in the authenticated format by default, whichever
+# package computes AES-GCM: ``cryptography`` (a dependency) or, where it
+# can't be imported, ``pycryptodome``, which is much slower for small
+# records.
+DEFAULT_RECORD_FORMAT = 'gcm'
+
+
+class DecryptionError(ValueError):
+    """An encrypted record failed authentication."""
+
+
+def is_sealed(data):
+    """Tell whether an encrypted record may be in the authenticated format.
+
+    `data` is the record without the b'.e' marker.  A record in the legacy
+    format may start like an authenticated one, too.
+    """
+    return data[:1] == SEALED and len(data) >= (
+        1 + KEY_ID_SIZE + NONCE_SIZE + TAG_SIZE)
+
 
 class IEncryptionUtility(zope.interface.Interface):
 
@@ -33,7 +88,36 @@ class IEncryptionUtility(zope.interface.Interface):
         """Returns the encrypted data uses str, without utf-8 conversion"""
 
     def decryptBytes(data):
-        """Returns the decrypted data uses str, without utf-8 conversion"""
+        """Returns the decrypted data uses str, without utf-8 conversion
+
+        Data that isn't encrypted is returned as is, but data in an
+        authenticated format that fails authentication raises
+        `DecryptionError`.
+        """
+
+    def decryptMany(datas):
+        """Returns a list of the decrypted data of a sequence of records
+
+        This is equivalent to calling `decryptBytes` for every record, but
+        amortizes the per-call overhead.  The records may be any bytes-like
+        objects, the decrypted data may be returned as memoryviews.
+        """
+
+    def encryptParts(parts, header=b''):
+        """Returns `header` followed by the encrypted concatenated `parts`
+
+        The parts are bytes-like objects.  This is equivalent to
+        ``header + encryptBytes(b''.join(parts))``, without copying the
+        data more than once: the result may be the bytearray the parts were
+        encrypted into.
+        """
+
+    def decryptBuffer(data):
+        """Returns the decrypted data of the bytes-like object `data`
+
+        This is equivalent to `decryptBytes`, but the decrypted data may be
+        returned as a memoryview, so that it doesn't need to be copied.
+        """
 
     def encrypt_file(fsrc, fdst):
         """Reads the plain data from fsrc and
@@ -42,6 +126,65 @@ class IEncryptionUtility(zope.interface.Interface):
     def decrypt_file(fsrc, fdst):
         """Reads from fsrc and writes the encrypted data to fdst."""
 
+    def aead(key_id=None):
+        """Returns an authenticated cipher for a key, or None
+
+        The cipher is the one of the key with the ID `key_id`, by default
+        the current key.  It has the interface of ``cryptography``'s
+        ``AESGCM``: ``encrypt(nonce, data, associated_data)`` and
+        ``decrypt(nonce, data, associated_data)``.  None is returned if the
+        utility doesn't encrypt.  An unknown `key_id` raises
+        `DecryptionError`.
+        """
+
+    def keyId():
+        """Returns the ID of the current key, or None if not encrypting"""
+
+
+# Utilities implementing only the methods of `IEncryptionUtility` up to
+# ``decrypt_file`` are still supported: the functions below fall back to
+# them, and such utilities write records and blob files in the legacy
+# formats.
+
+def encrypt_parts(utility, parts, header=b''):
+    """Return ``utility.encryptParts(parts, header)``."""
+    encrypt = getattr(utility, 'encryptParts', None)
+    if encrypt is None:
+        return header + utility.encryptBytes(b''.join(parts))
+    return encrypt(parts, header)
+
+
+def decrypt_buffer(utility, data):
+    """Return ``utility.decryptBuffer(data)``."""
+    decrypt = getattr(utility, 'decryptBuffer', None)
+    if decrypt is None:
+        return utility.decryptBytes(bytes(data))
+    return decrypt(data)
+
+
+def decrypt_many(utility, datas):
+    """Return ``utility.decryptMany(datas)``."""
+    decrypt = getattr(utility, 'decryptMany', None)
+    if decrypt is None:
+        return [utility.decryptBytes(bytes(data)) for data in datas]
+    return decrypt(datas)
+
+
+def utility_aead(utility, key_id=None):
+    """Return ``utility.aead(key_id)``, None if the utility has no aead."""
+    aead = getattr(utility, 'aead', None)
+    if aead is None:
+        return None
+    return aead(key_id)
+
+
+def utility_key_id(utility):
+    """Return ``utility.keyId()``, None if the utility has no key IDs."""
+    key_id = getattr(utility, 'keyId', None)
+    if key_id is None:
+        return None
+    return key_id()
+
 
 class TrivialEncryptionUtility:
 
@@ -57,19 +200,483 @@ class TrivialEncryptionUtility:
     def decryptBytes(self, data):
         return data
 
+    def decryptMany(self, datas):
+        return list(datas)
+
+    def encryptParts(self, parts, header=b''):
+        return b''.join([header, *parts])
+
+    def decryptBuffer(self, data):
+        return data
+
     def encrypt_file(self, fsrc, fdst):
         shutil.copyfileobj(fsrc, fdst)
 
     def decrypt_file(self, fsrc, fdst):
         shutil.copyfileobj(fsrc, fdst)
 
+    def aead(self, key_id=None):
+        return None
+
+    def keyId(self):
+        return None
+
+
+def kek_hash(key):
+    """Return the hash under which a key encrypting key is known.
+
+    This is the same lookup key ``keas.kmi`` uses for the DEK storage.
+    """
+    return md5(key).hexdigest()
+
+
+def key_id(key):
+    """Return the compact ID of a key encrypting key.
+
+    Authenticated records and chunked blob files carry the ID of the key
+    they were encrypted with.  It's the start of `kek_hash`, which isn't a
+    secret either.
+    """
+    return bytes.fromhex(kek_hash(key))[:KEY_ID_SIZE]
+
+
+class AESGCM:
+    """AES-GCM with the interface of ``cryptography``'s ``AESGCM``.
+
+    The tag is appended to the ciphertext.  Decryption raises ValueError
+    if the data or the associated data were tampered with.
+    """
+
+    tag_size = 16
+
+    def __init__(self, key):
+        self._key = key
+
+    def encrypt(self, nonce, data, associated_data):
+        cipher = AES.new(self._key, AES.MODE_GCM, nonce=nonce)
+        if associated_data:
+            cipher.update(associated_data)
+        text, tag = cipher.encrypt_and_digest(data)
+        return text + tag
+
+    def decrypt(self, nonce, data, associated_data):
+        cipher = AES.new(self._key, AES.MODE_GCM, nonce=nonce)
+        if associated_data:
+            cipher.update(associated_data)
+        return cipher.decrypt_and_verify(
+            data[:-self.tag_size], data[-self.tag_size:])
+
+    def seal(self, nonce, parts, associated_data, header=b''):
+        """Return `header`, `nonce` and the encrypted `parts` and tag.
+
+        The parts are encrypted straight into the output buffer.
+        """
+        start = len(header) + len(nonce)
+        out = bytearray(start + sum(len(part) for part in parts)
+                        + self.tag_size)
+        out[:start] = header + nonce
+        view = memoryview(out)
+        cipher = AES.new(self._key, AES.MODE_GCM, nonce=nonce)
+        if associated_data:
+            cipher.update(associated_data)
+        pos = start
+        for part in parts:
+            if len(part):
+                cipher.encrypt(part, output=view[pos:pos + len(part)])
+                pos += len(part)
+        view[pos:] = cipher.digest()
+        return out
+
+
+class NativeAESGCM:
+    """AES-GCM of the ``cryptography`` package.
+
+    It keeps the expanded key between calls, which makes it much faster
+    than `AESGCM` for small records.  Like `AESGCM`, decryption raises
+    ValueError if the data were tampered with.
+    """
+
+    tag_size = TAG_SIZE
+
+    # Records of several parts from this size on are encrypted part by
+    # part rather than joined first.
+    stream_size = 1 << 16
+
+    def __init__(self, key):
+        self._key = key
+        self._aead = native_aead.AESGCM(key)
+        self.encrypt = self._aead.encrypt
+
+    def decrypt(self, nonce, data, associated_data):
+        try:
+            return self._aead.decrypt(nonce, data, associated_data)
+        except InvalidTag:
+            raise ValueError('MAC check failed')
+
+    def seal(self, nonce, parts, associated_data, header=b''):
+        """Return `header`, `nonce` and the encrypted `parts` and tag.
+
+        Large records are encrypted straight into the output buffer.
+        """
+        size = sum(len(part) for part in parts)
+        if len(parts) > 1 and size >= self.stream_size:
+            return self._seal_parts(nonce, parts, associated_data, header)
+        data = parts[0] if len(parts) == 1 else b''.join(parts)
+        encrypt_into = getattr(self._aead, 'encrypt_into', None)
+        if encrypt_into is None:
+            # Older versions of cryptography
+            return b''.join((header, nonce,
+                             self._aead.encrypt(nonce, data, associated_data)))
+        start = len(header) + len(nonce)
+        out = bytearray(start + size + self.tag_size)
+        out[:start] = header + nonce
+        encrypt_into(nonce, data, associated_data, memoryview(out)[start:])
+        return out
+
+    def _seal_parts(self, nonce, parts, associated_data, header):
+        start = len(header) + len(nonce)
+        size = sum(len(part) for part in parts)
+        out = bytearray(start + size + self.tag_size)
+        out[:start] = header + nonce
+        view = memoryview(out)
+        encryptor = Cipher(
+            algorithms.AES(self._key), modes.GCM(nonce)).encryptor()
+        if associated_data:
+            encryptor.authenticate_additional_data(associated_data)
+        pos = start
+        for part in parts:
+            if len(part):
+                # The output may take up to a block more than the part, the
+                # tag's room is free until the end.
+                pos += encryptor.update_into(part, view[pos:])
+        encryptor.finalize()
+        view[pos:] = encryptor.tag
+        return out
+
+
+def aesgcm(key):
+    """Return an AES-GCM cipher for `key`, native if available."""
+    if native_aead is None:
+        return AESGCM(key)
+    return NativeAESGCM(key)
+
+
+class CipherContext:
+    """Ready-to-use cipher state for one key encrypting key.
+
+    ``keas.kmi`` looks up and unwraps the data encryption key on every
+    ``encrypt``/``decrypt`` call.  The context resolves it once and then
+    only creates the (cheap) per-record cipher object.  The ciphertext of
+    `encrypt` is identical to the one of ``facility.encrypt``; `seal`
+    produces records in the authenticated format.  `decrypt` reads both.
+    """
+
+    def __init__(self, facility, key):
+        self.hash = kek_hash(key)
+        self.id = key_id(key)
+        self._aad = _record_aad + self.id
+        self._key = facility._bytesToKey(facility.getEncryptionKey(key))
+        self._factory = facility.CipherFactory
+        self._mode = facility.CipherMode
+        self._iv = facility.initializationVector
+        self._aead = self._records = None
+
+    def _derive(self, label):
+        return aesgcm(hmac.new(self._key, label, sha256).digest())
+
+    @property
+    def aead(self):
+        """Authenticated cipher using a key derived from the DEK."""
+        aead = self._aead
+        if aead is None:
+            aead = self._aead = self._derive(b'cipher.encryptingstorage aead')
+        return aead
+
+    @property
+    def records(self):
+        """Authenticated cipher for records, with a key of its own."""
+        records = self._records
+        if records is None:
+            records = self._records = self._derive(
+                b'cipher.encryptingstorage records')
+        return records
+
+    def seal(self, parts, header=b''):
+        """Encrypt the concatenated `parts` in the authenticated format.
+
+        The record is `header`, the version byte, the key ID, a random
+        nonce and the AES-GCM ciphertext with its tag.
+        """
+        return self.records.seal(
+            os.urandom(NONCE_SIZE), parts, self._aad,
+            header + SEALED + self.id)
+
+    def unseal(self, data):
+        """Decrypt a record in the authenticated format.
+
+        :raises DecryptionError: if the record was tampered with.
+        """
+        data = memoryview(data)
+        start = 1 + KEY_ID_SIZE
+        nonce = bytes(data[start:start + NONCE_SIZE])
+        try:
+            return self.records.decrypt(
+                nonce, data[start + NONCE_SIZE:], self._aad)
+        except ValueError:
+            raise DecryptionError('Record failed authentication')
+
+    def _cipher(self):
+        return self._factory.new(key=self._key, mode=self._mode, IV=self._iv)
+
+    def encrypt(self, data):
+        return bytes(self.encryptParts((data,)))
+
+    def encryptParts(self, parts, header=b''):
+        """Encrypt the concatenated `parts` behind `header`.
+
+        The parts are encrypted straight into the output buffer, only the
+        (at most 16 byte) pieces of blocks spanning parts and the padding
+        are copied on the way.
+        """
+        size = sum(len(part) for part in parts)
+        n = 16 - size % 16
+        out = bytearray(len(header) + size + n)
+        out[:len(header)] = header
+        view = memoryview(out)
+        pos = len(header)
+        cipher = self._cipher()
+        pending = bytearray()
+        for part in parts:
+            part = memoryview(part).cast('B')
+            if pending:
+                take = min(16 - len(pending), len(part))
+                pending += part[:take]
+                part = part[take:]
+                if len(pending) < 16:
+                    continue
+                cipher.encrypt(pending, output=view[pos:pos + 16])
+                pos += 16
+                pending.clear()
+            end = len(part) - len(part) % 16
+            if end:
+                cipher.encrypt(part[:end], output=view[pos:pos + end])
+                pos += end
+            pending += part[end:]
+        pending += bytes((n,)) * n
+        cipher.encrypt(pending, output=view[pos:])
+        return out
+
+    def decrypt(self, data):
+        """Decrypt `data`, like ``facility.decrypt``.
+
+        Legacy records starting with the version byte, as the ciphertext of
+        `encrypt` may, are read too, see `decryptBuffer`.
+
+        :raises ValueError: if it can't decrypt the data.
+        """
+        return bytes(self.decryptBuffer(data, legacy=True))
+
+    def decryptBuffer(self, data, keyring=None, legacy=False):
+        """Decrypt the bytes-like `data`, return the text or a view of it.
+
+        Records in the authenticated format are decrypted with the key of
+        `keyring` they name, if a keyring is given.  Records naming a key
+        that isn't known raise `DecryptionError`.  Records in the legacy
+        format may start with the version byte of the authenticated format,
+        too: with `legacy`, records naming an unknown key are tried in the
+        legacy format instead.  (A record of an unknown key may then be
+        returned as garbage, there's no telling them apart.)
+
+        :raises DecryptionError: if it's an authenticated record that was
+            tampered with or names an unknown key.
+        :raises ValueError: if it can't decrypt the data otherwise.
+        """
+        if is_sealed(data):
+            id = bytes(data[1:1 + KEY_ID_SIZE])
+            if keyring is None and id == self.id:
+                return self.unseal(data)
+            if keyring is not None and id in keyring:
+                return keyring.unseal(data)
+            if not legacy or len(data) % 16:
+                raise DecryptionError('Unknown key ID %s' % id.hex())
+        return self._decryptLegacy(data)
+
+    def _decryptLegacy(self, data):
+        text = self._cipher().decrypt(data)
+        n = text[-1] if text else 0
+        if not 0 < n <= 16 or text[-n:] != bytes((n,)) * n:
+            raise ValueError("Input is not padded or padding is corrupt")
+        return memoryview(text)[:-n]
+
+    def decryptMany(self, datas, keyring=None, legacy=False):
+        """Decrypt several records with a single cipher object.
+
+        CBC decryption of the records one after the other with the same
+        cipher object only differs from decrypting them one by one in the
+        first block of each record, which got chained to the last block of
+        the previous record instead of the IV.  That is undone afterwards.
+        The records are decrypted into one buffer and returned as
+        memoryviews of it.  Records that can't be decrypted are returned as
+        None.
+
+        Records starting with the version byte of the authenticated format
+        are decrypted one by one with `decryptBuffer`, `keyring` and
+        `legacy`.
+
+        :raises DecryptionError: if one of them was tampered with.
+        """
+        datas = list(datas)
+        sealed = {}
+        for i, data in enumerate(datas):
+            if data and is_sealed(data):
+                sealed[i] = self.decryptBuffer(data, keyring, legacy)
+        if sealed:
+            # Decrypt the remaining records in a batch.
+            rest = [data for i, data in enumerate(datas) if i not in sealed]
+            rest = iter(self.decryptMany(rest))
+            return [sealed[i] if i in sealed else next(rest)
+                    for i in range(len(datas))]
+
+        sizes = [len(data) if data and not len(data) % 16 else 0
+                 for data in datas]
+        view = memoryview(bytearray(sum(sizes)))
+        cipher = self._cipher()
+        iv = int.from_bytes(self._iv, 'big')
+        result = []
+        append = result.append
+        pos = 0
+        previous = None
+        for data, size in zip(datas, sizes):
+            if not size:
+                append(None)
+                continue
+            record = view[pos:pos + size]
+            pos += size
+            cipher.decrypt(data, output=record)
+            if previous is not None:
+                first = int.from_bytes(record[:16], 'big') ^ previous ^ iv
+                record[:16] = first.to_bytes(16, 'big')
+            previous = int.from_bytes(data[-16:], 'big')
+            n = record[-1]
+            if 0 < n <= 16 and record[-n:] == bytes((n,)) * n:
+                append(record[:-n])
+            else:
+                append(None)
+        return result
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.hash)
+
+
+class Keyring:
+    """The key encrypting keys data is decrypted with, by key ID.
+
+    Authenticated records and chunked blob files carry the ID of the key
+    they were encrypted with, so the cipher context to decrypt them with
+    is looked up instead of trying one key after the other.  Contexts are
+    created when first used and then cached.
+    """
+
+    def __init__(self, facility, keys=()):
+        self.facility = facility
+        # key ID -> key, in the order they were added
+        self._keys = collections.OrderedDict()
+        # key ID -> context
+        self._contexts = {}
+        for key in keys:
+            self.add(key)
+
+    def add(self, key):
+        """Add `key` unless it's known already, return its ID.
+
+        :raises ValueError: if another key has the same ID.
+        """
+        id = key_id(key)
+        known = self._keys.setdefault(id, key)
+        if known != key:
+            raise ValueError(
+                'Key %s has the same ID as a key in the keyring'
+                % kek_hash(key))
+        return id
+
+    def remove(self, key):
+        """Remove `key` and its context."""
+        id = key_id(key)
+        if self._keys.get(id) == key:
+            del self._keys[id]
+            self._contexts.pop(id, None)
+
+    def keys(self):
+        """Return the keys in the order they were added."""
+        return list(self._keys.values())
+
+    def __contains__(self, id):
+        return id in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def context(self, id):
+        """Return the cipher context of the key with the ID `id`.
+
+        :raises DecryptionError: if there's no such key.
+        """
+        context = self._contexts.get(id)
+        if context is None:
+            key = self._keys.get(id)
+            if key is None:
+                raise DecryptionError('Unknown key ID %s' % id.hex())
+            context = self._contexts[id] = CipherContext(self.facility, key)
+        return context
+
+    def unseal(self, data):
+        """Decrypt a record in the authenticated format with its key.
+
+        :raises DecryptionError: if the key is unknown or the record was
+            tampered with.
+        """
+        return self.context(bytes(data[1:1 + KEY_ID_SIZE])).unseal(data)
+
+    def invalidate(self, key=None):
+        """Drop the cached context of `key`, or all of them."""
+        if key is None:
+            self._contexts.clear()
+        else:
+            self._contexts.pop(key_id(key), None)
+
 
 zope.interface.implementer(IEncryptionUtility, IKeyHolder)
 
 
 class EncryptionUtility(TrivialEncryptionUtility):
+    """Encrypt records with the data encryption key of a KMI facility.
+
+    New records are written in the authenticated AES-GCM format, or in the
+    legacy CBC format of ``keas.kmi`` if `record_format` is ``'cbc'``.  It
+    defaults to `DEFAULT_RECORD_FORMAT`.  Records in both formats are read,
+    but legacy records that start like authenticated ones (with the version
+    byte) only with `legacy_records`: otherwise they are taken for records
+    of an unknown key.  It defaults to whether the legacy format is
+    written.
 
-    def __init__(self, kek_path, facility):
+    Authenticated records and blobs are read with the key of the `keyring`
+    they were written with: the current key, the `previous_keys` (key
+    encrypting keys, most recent first) or keys added to the keyring.
+    Legacy records can only be read with the current key.
+    """
+
+    _context = None
+
+    def __init__(self, kek_path, facility, record_format=None,
+                 previous_keys=(), legacy_records=None):
+        if record_format is None:
+            record_format = DEFAULT_RECORD_FORMAT
+        if record_format not in RECORD_FORMATS:
+            raise ValueError('Unknown record format %r' % record_format)
+        self.record_format = record_format
+        if legacy_records is None:
+            legacy_records = record_format == 'cbc'
+        self.legacy_records = legacy_records
         self.facility = facility
         if os.path.exists(kek_path):
             with open(kek_path, 'rb') as file:
@@ -78,16 +685,101 @@ class EncryptionUtility(TrivialEncryptionUtility):
             self.key = self.facility.generate()
             with open(kek_path, 'wb') as file:
                 file.write(self.key)
+        self.keyring = Keyring(facility, reversed(list(previous_keys)))
+        self.keyring.add(self.key)
+
+    @property
+    def previous(self):
+        """The other keys of the keyring, most recently added first."""
+        return [key for key in reversed(self.keyring.keys())
+                if key != self.key]
+
+    def context(self, key=None):
+        """Return the cached cipher context for `key`.
+
+        `key` defaults to the current key encrypting key, other keys must
+        be in the keyring.  The data encryption key is only resolved when
+        no context is cached yet.
+        """
+        if key is None:
+            context = self._context
+            if context is None:
+                context = self._context = self.keyring.context(
+                    key_id(self.key))
+            return context
+        return self.keyring.context(key_id(key))
+
+    def rotate(self, key):
+        """Switch to a new key encrypting key.
+
+        The old key stays in the keyring, so authenticated records written
+        with it stay readable until they are re-encrypted.  Contexts of
+        previously used keys stay cached until `invalidate` is called.
+        """
+        self.keyring.add(key)
+        self.key = key
+        self._context = None
+
+    def invalidate(self, key=None):
+        """Drop cached cipher contexts.
+
+        Only the context of `key` is dropped if it is given, all of them
+        otherwise.  The data encryption key is then resolved again on next
+        use.
+        """
+        self.keyring.invalidate(key)
+        self._context = None
 
     def encryptBytes(self, data):
-        return self.facility.encrypt(self.key, data)
+        return bytes(self.encryptParts((data,)))
 
     def decryptBytes(self, data):
+        return bytes(self.decryptBuffer(data))
+
+    def encryptParts(self, parts, header=b''):
+        context = self._context
+        if context is None:
+            context = self.context()
+        if self.record_format == 'gcm':
+            return context.seal(parts, header)
+        return context.encryptParts(parts, header)
+
+    def decryptBuffer(self, data):
+        context = self._context
+        if context is None:
+            context = self.context()
         try:
-            return self.facility.decrypt(self.key, data)
+            return context.decryptBuffer(
+                data, self.keyring, self.legacy_records)
+        except DecryptionError:
+            raise
         except ValueError:
             return data
 
+    def decryptMany(self, datas):
+        context = self._context
+        if context is None:
+            context = self.context()
+        datas = list(datas)
+        texts = context.decryptMany(
+            datas, self.keyring, self.legacy_records)
+        return [data if text is None else text
+                for data, text in zip(datas, texts)]
+
+    def aead(self, key_id=None):
+        if key_id is not None:
+            return self.keyring.context(key_id).aead
+        context = self._context
+        if context is None:
+            context = self.context()
+        return context.aead
+
+    def keyId(self):
+        context = self._context
+        if context is None:
+            context = self.context()
+        return context.id
+
     def encrypt_file(self, fsrc, fdst):
         return self.facility.encrypt_file(self.key, fsrc, fdst)
 
@@ -100,14 +792,203 @@ class EncryptionUtility(TrivialEncryptionUtility):
             shutil.copyfileobj(fsrc, fdst)
 
 
+class KeyCache:
+    """Bounded cache of data encryption keys with TTL eviction.
+
+    `lookup` is called with the key encrypting key to fetch the data
+    encryption key when it isn't cached.  Failed lookups are cached for
+    `negative_ttl` seconds, so that a missing key or a flapping key server
+    isn't asked again for every record.  Once an entry is older than
+    `refresh_ahead` (a fraction of `ttl`), it is refreshed in a background
+    thread while the cached value keeps being served.  If an expired entry
+    can't be refreshed, the stale value is served rather than failing.
+    """
+
+    def __init__(self, lookup, size=100, ttl=3600, negative_ttl=60,
+                 refresh_ahead=0.8):
+        self.lookup = lookup
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh_ahead = refresh_ahead
+        self.hits = self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        hash = kek_hash(key)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(hash)
+            if entry is not None:
+                self._entries.move_to_end(hash)
+                stamp, value, error = entry
+                if error is not None:
+                    if now < stamp + self.negative_ttl:
+                        self.hits += 1
+                        raise error
+                elif now < stamp + self.ttl:
+                    self.hits += 1
+                    if (now >= stamp + self.ttl * self.refresh_ahead
+                            and hash not in self._refreshing):
+                        self._refreshing.add(hash)
+                        thread = threading.Thread(
+                            target=self._refresh, args=(hash, key),
+                            name='cipher.encryptingstorage key refresh')
+                        thread.daemon = True
+                        thread.start()
+                    return value
+            self.misses += 1
+
+        try:
+            value = self.lookup(key)
+        except Exception as error:
+            if entry is not None and entry[2] is None:
+                logger.warning(
+                    'Key lookup failed, using stale key %s: %s', hash, error)
+                return entry[1]
+            self._set(hash, None, error)
+            raise
+        self._set(hash, value)
+        return value
+
+    def _refresh(self, hash, key):
+        try:
+            self._set(hash, self.lookup(key))
+        except Exception:
+            logger.exception('Background refresh of key %s failed', hash)
+        finally:
+            with self._lock:
+                self._refreshing.discard(hash)
+
+    def _set(self, hash, value, error=None):
+        with self._lock:
+            self._entries[hash] = (time.time(), value, error)
+            self._entries.move_to_end(hash)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(kek_hash(key), None)
+
+
+class CachingKeyManagementFacility(facility.LocalKeyManagementFacility):
+    """Local facility asking a KMI server for keys through a `KeyCache`.
+
+    Unlike ``keas.kmi``'s facility, a key server error response is not
+    taken for the key, and ``http://`` URLs are supported.
+    """
+
+    request_timeout = 10
+
+    def __init__(self, url, **cache_options):
+        super().__init__(url)
+        self.cache = KeyCache(self._fetchEncryptionKey, **cache_options)
+        if urlparse(url).scheme == 'http':
+            self.httpConnFactory = http.client.HTTPConnection
+
+    def _request(self, path, body, headers):
+        conn = self.httpConnFactory(
+            urlparse(self.url).netloc, timeout=self.request_timeout)
+        try:
+            conn.request('POST', path, body, headers)
+            response = conn.getresponse()
+            data = response.read()
+            response.close()
+        finally:
+            conn.close()
+        if response.status == 404:
+            raise KeyError(kek_hash(body))
+        if response.status != 200:
+            raise OSError('KMI server error %s %s' % (
+                response.status, response.reason))
+        return data
+
+    def _fetchEncryptionKey(self, key):
+        sink = metrics.sink
+        if sink is not None:
+            start = metrics.clock()
+        data = self._request('/key', key, {'content-type': 'text/plain'})
+        if sink is not None:
+            metrics.observe(sink, 'kmi_fetch', start, data)
+        return data
+
+    def getEncryptionKey(self, key):
+        """Given the key encrypting key, get the encryption key."""
+        return self.cache.get(key)
+
+
 ENCRYPTION_UTILITY = TrivialEncryptionUtility()
 
 
+class GlobalEncryptionUtility:
+    """Delegate to the global encryption utility.
+
+    The global utility is looked up on every use, so storages created
+    without a utility of their own use the one `init_local_facility` sets,
+    even after they were opened.  The methods used for every record and
+    blob are defined here, so that calling them doesn't take a failed
+    attribute lookup first; they work with global utilities providing only
+    the original methods, like the helper functions above.
+    """
+
+    def encryptParts(self, parts, header=b''):
+        return encrypt_parts(ENCRYPTION_UTILITY, parts, header)
+
+    def decryptBuffer(self, data):
+        return decrypt_buffer(ENCRYPTION_UTILITY, data)
+
+    def decryptMany(self, datas):
+        return decrypt_many(ENCRYPTION_UTILITY, datas)
+
+    def encryptBytes(self, data):
+        return ENCRYPTION_UTILITY.encryptBytes(data)
+
+    def decryptBytes(self, data):
+        return ENCRYPTION_UTILITY.decryptBytes(data)
+
+    def encrypt_file(self, fsrc, fdst):
+        return ENCRYPTION_UTILITY.encrypt_file(fsrc, fdst)
+
+    def decrypt_file(self, fsrc, fdst):
+        return ENCRYPTION_UTILITY.decrypt_file(fsrc, fdst)
+
+    def aead(self, key_id=None):
+        return utility_aead(ENCRYPTION_UTILITY, key_id)
+
+    def keyId(self):
+        return utility_key_id(ENCRYPTION_UTILITY)
+
+    def __getattr__(self, name):
+        return getattr(ENCRYPTION_UTILITY, name)
+
+    def __repr__(self):
+        return '<%s of %r>' % (self.__class__.__name__, ENCRYPTION_UTILITY)
+
+
 def init_local_facility(conf):
-    config = RawConfigParser()
-    config.readfp(open(conf['__file__']))
+    """Set the global encryption utility to the one configured by `conf`.
 
+    See `load_utility`.
+    """
     global ENCRYPTION_UTILITY
+    ENCRYPTION_UTILITY = load_utility(conf)
+
+
+def load_utility(conf):
+    """Return the encryption utility configured by the file named by the
+    ``__file__`` of `conf`.  Relative paths are resolved from ``here``.
+    """
+    config = RawConfigParser()
+    config.readfp(open(conf['__file__']))
 
     enabled = False
     if config.has_option('encryptingstorage:encryption', 'enabled'):
@@ -117,25 +998,58 @@ def init_local_facility(conf):
         kek_path = config.get('encryptingstorage:encryption', 'kek-path')
 
         if config.has_option('encryptingstorage:encryption', 'kmi-server'):
-            kmf = facility.LocalKeyManagementFacility(
-                config.get('encryptingstorage:encryption', 'kmi-server'))
+            cache_options = {}
+            for option, name, get in (
+                    ('key-cache-size', 'size', config.getint),
+                    ('key-cache-ttl', 'ttl', config.getfloat),
+                    ('key-cache-negative-ttl', 'negative_ttl',
+                     config.getfloat),
+                    ('key-cache-refresh-ahead', 'refresh_ahead',
+                     config.getfloat)):
+                if config.has_option('encryptingstorage:encryption', option):
+                    cache_options[name] = get(
+                        'encryptingstorage:encryption', option)
+            kmf = CachingKeyManagementFacility(
+                config.get('encryptingstorage:encryption', 'kmi-server'),
+                **cache_options)
         else:
             kmf = facility.KeyManagementFacility(
                 config.get('encryptingstorage:encryption', 'dek-storage-path'))
 
-        if kek_path.startswith('/'):
-            path = kek_path
-        else:
-            path = os.path.join(conf['here'], kek_path)
+        def resolve(kek_path):
+            if kek_path.startswith('/'):
+                return kek_path
+            return os.path.join(conf['here'], kek_path)
+
+        record_format = None
+        if config.has_option('encryptingstorage:encryption', 'record-format'):
+            record_format = config.get(
+                'encryptingstorage:encryption', 'record-format')
 
-        ENCRYPTION_UTILITY = EncryptionUtility(path, kmf)
+        legacy_records = None
+        if config.has_option('encryptingstorage:encryption', 'legacy-records'):
+            legacy_records = config.getboolean(
+                'encryptingstorage:encryption', 'legacy-records')
+
+        previous_keys = []
+        if config.has_option(
+                'encryptingstorage:encryption', 'previous-kek-paths'):
+            for previous in config.get(
+                    'encryptingstorage:encryption',
+                    'previous-kek-paths').split():
+                with open(resolve(previous), 'rb') as file:
+                    previous_keys.append(file.read())
 
         # encryptingstorage specific:
         # just don't provide utilities, who knows what will be defined
         # by the main app
 
-        # provideUtility(ENCRYPTION_UTILITY, IKeyHolder)
+        # provideUtility(utility, IKeyHolder)
         # provideUtility(kmf)
 
+        return EncryptionUtility(
+            resolve(kek_path), kmf, record_format, previous_keys,
+            legacy_records)
+
     else:
-        ENCRYPTION_UTILITY = TrivialEncryptionUtility()
+        return TrivialEncryptionUtility()
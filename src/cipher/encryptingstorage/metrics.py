@@ -0,0 +1,130 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Latency and throughput instrumentation
+
+Instrumentation is off until a sink is set with `setSink`.  A sink is a
+callable taking a metric name and a value, like a statsd client method.
+For every instrumented operation, two values are reported:
+
+``cipher.encryptingstorage.<operation>.ms``
+  the time the operation took in milliseconds,
+
+``cipher.encryptingstorage.<operation>.bytes``
+  the number of bytes it processed (its input, or the loaded record for
+  ``base_load`` and the key for ``kmi_fetch``).
+
+The operations are ``base_load`` and ``base_store`` (the calls to the
+wrapped storage), ``compress``, ``encrypt``, ``decrypt`` and
+``decompress`` of records and ``kmi_fetch`` (fetching a key from a KMI
+server).
+"""
+import math
+import threading
+import time
+
+
+PREFIX = 'cipher.encryptingstorage.'
+
+# The current sink, None when instrumentation is off.
+sink = None
+
+clock = time.perf_counter
+
+
+def setSink(new_sink):
+    """Report metrics to `new_sink`, turn instrumentation off if None."""
+    global sink
+    sink = new_sink
+
+
+def observe(sink, operation, start, data):
+    """Report the time since `start` and the size of `data`."""
+    observe_size(sink, operation, start, len(data) if data else 0)
+
+
+def observe_size(sink, operation, start, size):
+    """Report the time since `start` and `size` bytes."""
+    sink(PREFIX + operation + '.ms', (clock() - start) * 1000)
+    sink(PREFIX + operation + '.bytes', size)
+
+
+class Histogram:
+    """Summary of observed values.
+
+    Values are counted in buckets growing by powers of two, so percentiles
+    are approximate (the upper bound of the bucket they fall in).
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = self.max = None
+        self._buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        bucket = math.frexp(value)[1] if value > 0 else None
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def percentile(self, q):
+        """Return (an upper bound of) the `q` percentile, 0 <= q <= 100."""
+        if not self.count:
+            return 0
+        rank = self.count * q / 100
+        seen = 0
+        buckets = sorted(self._buckets.items(),
+                         key=lambda item: -math.inf if item[0] is None
+                         else item[0])
+        for bucket, count in buckets:
+            seen += count
+            if seen >= rank:
+                if bucket is None:
+                    return 0
+                return min(math.ldexp(1, bucket), self.max)
+        return self.max
+
+    def snapshot(self):
+        return dict(count=self.count, total=self.total, mean=self.mean,
+                    min=self.min, max=self.max,
+                    p50=self.percentile(50), p99=self.percentile(99))
+
+
+class InMemorySink:
+    """Sink keeping a `Histogram` per metric name."""
+
+    def __init__(self):
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, name, value):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(value)
+
+    def snapshot(self):
+        """Return the summaries of all histograms by metric name."""
+        with self._lock:
+            return {name: histogram.snapshot()
+                    for name, histogram in self.histograms.items()}
@@ -0,0 +1,287 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Online re-encryption
+
+After the key encrypting key was rotated, or the record format changed,
+records and blobs stay encrypted the way they were written.  A
+`Reencryption` rewrites the current revision of every object with the
+current key and format, in small transactions, while the database is in
+use::
+
+    job = Reencryption(storage, checkpoint='reencrypt.json', rate=10 << 20)
+    job.run()
+
+Progress is saved to the checkpoint file after every transaction, so an
+interrupted job continues where it stopped.  Older revisions keep their
+encryption until the database is packed.
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import ZODB.blob
+import ZODB.utils
+from ZODB.Connection import TransactionMetaData
+from ZODB.POSException import ConflictError
+
+from cipher.encryptingstorage import blob as chunked
+from cipher.encryptingstorage import compression
+from cipher.encryptingstorage import encrypt_util
+
+
+logger = logging.getLogger(__name__)
+
+
+class Throttle:
+    """Limit an amount (of bytes, say) per second to `rate`.
+
+    Every call accounts for an amount and sleeps while the calls are ahead
+    of the rate.  Idle time isn't saved up for bursts.
+    """
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.clock = clock
+        self.sleep = sleep
+        self._time = None
+
+    def __call__(self, amount):
+        now = self.clock()
+        start = now if self._time is None else max(self._time, now)
+        self._time = start + amount / self.rate
+        if self._time > now:
+            self.sleep(self._time - now)
+
+
+class Checkpoint:
+    """Progress of a re-encryption, saved to the JSON file `path`.
+
+    `next` is the ``record_iternext`` cursor of the first object not done
+    yet, `done` tells whether all objects were done.  Without a path,
+    progress is only kept in memory.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.next = None
+        self.done = False
+        self.stats = dict(
+            records=0, blobs=0, bytes=0, transactions=0, conflicts=0,
+            skipped=0)
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.next = (None if state['next'] is None
+                         else bytes.fromhex(state['next']))
+            self.done = state['done']
+            self.stats.update(state['stats'])
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(dict(
+                next=None if self.next is None else self.next.hex(),
+                done=self.done,
+                stats=self.stats,
+            ), f)
+        os.replace(tmp, self.path)
+
+
+class Reencryption:
+    """Re-encrypt the current revisions of all objects of `storage`.
+
+    `storage` is an `EncryptingStorage` whose encryption utility reads the
+    old key (see ``EncryptionUtility.rotate``).  Records in the legacy CBC
+    format can only be told apart from garbage with the current key, so
+    they need to be re-encrypted in the authenticated format before the
+    key is rotated.  A record that can't be decrypted stops the job with a
+    ValueError rather than being rewritten as is.  Objects are rewritten in
+    transactions of `batch_size` objects.  `rate` limits the bytes of
+    records and blobs rewritten per second, and `pause` adds seconds to
+    wait between transactions, to leave room for other commits.
+
+    Objects changed by other transactions while being rewritten are
+    skipped, they were written with the current key already.  So are
+    objects whose record, and blob file, are in the authenticated format
+    with the current key; they are counted as ``skipped`` in the stats.
+    """
+
+    retries = 3
+
+    def __init__(self, storage, checkpoint=None, batch_size=100, rate=None,
+                 pause=0):
+        self.storage = storage
+        if not isinstance(checkpoint, Checkpoint):
+            checkpoint = Checkpoint(checkpoint)
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.throttle = Throttle(rate) if rate else None
+        self.pause = pause
+
+    @property
+    def stats(self):
+        return self.checkpoint.stats
+
+    def run(self, batches=None):
+        """Rewrite up to `batches` transactions, by default all of them.
+
+        Returns whether all objects are done.
+        """
+        checkpoint = self.checkpoint
+        n = 0
+        while not checkpoint.done and (batches is None or n < batches):
+            if n and self.pause:
+                time.sleep(self.pause)
+            self.step()
+            n += 1
+        return checkpoint.done
+
+    def step(self):
+        """Rewrite the next batch of objects in one transaction."""
+        checkpoint = self.checkpoint
+        storage = self.storage
+        next = checkpoint.next
+        key = self._current_key()
+        records = []
+        if next is not None or len(storage):
+            for _ in range(self.batch_size):
+                oid, tid, data, next = storage.base.record_iternext(next)
+                current = key is not None and self._sealed_with(key, data)
+                data = self._decrypt(oid, data)
+                if current and data and ZODB.blob.is_blob_record(data):
+                    current = self._blob_sealed_with(key, oid, tid)
+                if current:
+                    checkpoint.stats['skipped'] += 1
+                else:
+                    records.append((oid, tid, data))
+                if next is None:
+                    break
+        size = self._commit(records) if records else 0
+        checkpoint.next = next
+        checkpoint.done = next is None
+        checkpoint.save()
+        if next is None:
+            logger.info('Re-encryption done: %s', checkpoint.stats)
+        if self.throttle is not None and size:
+            self.throttle(size)
+
+    def _current_key(self):
+        # The ID of the key records are rewritten with in the authenticated
+        # format, None if they aren't written in that format.
+        storage = self.storage
+        utility = storage.utility
+        if (not storage._encrypt
+                or getattr(utility, 'record_format', None) == 'cbc'):
+            return None
+        return encrypt_util.utility_key_id(utility)
+
+    def _sealed_with(self, key, data):
+        # Whether a stored record is authenticated with the key `key`.
+        return (data and data[:2] == b'.e'
+                and encrypt_util.is_sealed(memoryview(data)[2:])
+                and data[3:3 + encrypt_util.KEY_ID_SIZE] == key)
+
+    def _blob_sealed_with(self, key, oid, tid):
+        with open(self.storage.loadBlobRaw(oid, tid), 'rb') as f:
+            return chunked.key_id(f) == key
+
+    def _decrypt(self, oid, data):
+        # Like `decrypt`, but records that can't be decrypted are an error
+        # instead of being passed on as they are.
+        if not data or data[:2] != b'.e':
+            return data
+        utility = self.storage.utility
+        encrypted = memoryview(data)[2:]
+        if getattr(utility, 'previous', None):
+            # After a key rotation, only authenticated records name their
+            # key; decrypting a legacy record with the wrong key may go
+            # unnoticed.
+            text = None
+            if encrypt_util.is_sealed(encrypted):
+                try:
+                    text = utility.keyring.unseal(encrypted)
+                except encrypt_util.DecryptionError:
+                    pass
+        else:
+            text = encrypt_util.decrypt_buffer(utility, encrypted)
+            if (text is encrypted
+                    and encrypt_util.utility_aead(utility) is not None):
+                text = None
+        if text is None:
+            raise ValueError(
+                "Can't decrypt record %s with the current or previous keys"
+                % ZODB.utils.oid_repr(oid))
+        return bytes(compression.decompress(text))
+
+    def _commit(self, records):
+        stats = self.checkpoint.stats
+        for attempt in range(self.retries):
+            t = TransactionMetaData(description='Re-encrypt records')
+            storage = self.storage
+            storage.tpc_begin(t)
+            try:
+                size = blobs = 0
+                for oid, tid, data in records:
+                    size += len(data or b'')
+                    if data and ZODB.blob.is_blob_record(data):
+                        size += self._storeBlob(oid, tid, data, t)
+                        blobs += 1
+                    else:
+                        storage.store(oid, tid, data, '', t)
+                storage.tpc_vote(t)
+            except ConflictError:
+                storage.tpc_abort(t)
+                stats['conflicts'] += 1
+                records = self._unchanged(records)
+                if not records:
+                    return 0
+                continue
+            except BaseException:
+                storage.tpc_abort(t)
+                raise
+            oids = [oid for oid, _, _ in records]
+            storage.tpc_finish(t, lambda tid: self._invalidate(tid, oids))
+            stats['records'] += len(records)
+            stats['blobs'] += blobs
+            stats['bytes'] += size
+            stats['transactions'] += 1
+            return size
+        raise ConflictError(
+            'Could not re-encrypt records after %s attempts' % self.retries)
+
+    def _storeBlob(self, oid, tid, data, t):
+        # The storage encrypts the decrypted copy and moves it in place.
+        storage = self.storage
+        fd, filename = tempfile.mkstemp(dir=storage.temporaryDirectory())
+        os.close(fd)
+        shutil.copyfile(storage.loadBlob(oid, tid), filename)
+        size = os.path.getsize(filename)
+        storage.storeBlob(oid, tid, data, filename, '', t)
+        return size
+
+    def _unchanged(self, records):
+        # The records that weren't changed since they were read.
+        base = self.storage.base
+        return [(oid, tid, data) for oid, tid, data in records
+                if ZODB.utils.load_current(base, oid)[1] == tid]
+
+    def _invalidate(self, tid, oids):
+        # Other connections must not keep using the old serials.
+        if getattr(self.storage, 'db', None) is not None:
+            self.storage.invalidate(tid, oids)
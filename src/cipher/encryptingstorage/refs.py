@@ -0,0 +1,166 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Reference index of encrypted records
+
+Packing needs the oids every record references, which normally means
+decrypting, decompressing and parsing every record.  A `RefsIndex` is a
+file next to the database recording them when the records are stored, so
+that packing can look them up instead.
+
+The file is a sequence of entries, one per committed transaction::
+
+    length (4 bytes)  tid (8 bytes)  key ID (4 bytes)  nonce (12 bytes)
+    encrypted references and tag
+
+The references of a transaction are encrypted with AES-GCM using the key
+the blob files are encrypted with, so the file only tells the number and
+size of the entries.  They list the records of the transaction by their
+record key (the key ID and nonce of a record in the authenticated format,
+which are unique) and the oids each of them references.  Records without
+such a key aren't indexed.
+"""
+import hashlib
+import logging
+import os
+import struct
+import threading
+
+from cipher.encryptingstorage import encrypt_util
+
+
+logger = logging.getLogger(__name__)
+
+# Length of the record keys: the key ID and the nonce of a record.
+KEY_SIZE = encrypt_util.KEY_ID_SIZE + encrypt_util.NONCE_SIZE
+
+_aad = b'.r'
+_entry_header = struct.Struct('>I8s4s12s')
+_count = struct.Struct('>I')
+_record_start = len(b'.e' + encrypt_util.SEALED)
+
+
+def record_key(data):
+    """Return the key of a stored record in the index, None if it has none.
+    """
+    if data and data[:_record_start] == b'.e' + encrypt_util.SEALED:
+        if encrypt_util.is_sealed(memoryview(data)[2:]):
+            return bytes(data[_record_start:_record_start + KEY_SIZE])
+    return None
+
+
+def pack_key(data):
+    """Return a key identifying a stored record while packing.
+
+    Records in the authenticated format are identified by their record
+    key, others by a digest of their data.
+    """
+    key = record_key(data)
+    if key is None:
+        key = hashlib.blake2b(data, digest_size=KEY_SIZE + 1).digest()
+    return key
+
+
+def split_oids(oids):
+    """Split the concatenated 8 byte `oids` into a list."""
+    return [oids[i:i + 8] for i in range(0, len(oids), 8)]
+
+
+class RefsIndex:
+    """Append-only file of the references of the records stored.
+
+    It's written by `EncryptingStorage` when `path` is given as its
+    ``refs_index`` (the ``refs-index`` option) and read when packing.  The
+    entries are encrypted with `utility`, by default the global encryption
+    utility.  An entry is only written once its transaction is committed; a
+    missing or unreadable entry (say, of a transaction committed while the
+    storage was used without the index, or written with a key that's gone)
+    means the records of the transaction are decrypted while packing.
+    """
+
+    def __init__(self, path, utility=None):
+        self.path = path
+        self.utility = utility
+        self._lock = threading.Lock()
+
+    def append(self, tid, records):
+        """Add the references of the records of the transaction `tid`.
+
+        `records` is a sequence of the record key and the list of
+        referenced oids of each record.  Nothing is written if the
+        encryption utility doesn't encrypt.
+        """
+        utility = self.utility
+        if utility is None:
+            utility = encrypt_util.ENCRYPTION_UTILITY
+        key_id = encrypt_util.utility_key_id(utility)
+        if not records or key_id is None:
+            return
+        payload = b''.join(
+            key + _count.pack(len(oids)) + b''.join(oids)
+            for key, oids in records)
+        nonce = os.urandom(encrypt_util.NONCE_SIZE)
+        sealed = utility.aead(key_id).encrypt(
+            nonce, payload, _aad + tid + key_id)
+        entry = _entry_header.pack(
+            _entry_header.size - 4 + len(sealed), tid, key_id, nonce)
+        with self._lock:
+            with open(self.path, 'ab') as f:
+                f.write(entry + sealed)
+
+    def load(self):
+        """Return a dictionary of the concatenated oids by record key.
+
+        Entries that can't be decrypted are skipped with a warning, as is a
+        truncated last entry.
+        """
+        result = {}
+        if not os.path.exists(self.path):
+            return result
+        utility = self.utility
+        if utility is None:
+            utility = encrypt_util.ENCRYPTION_UTILITY
+        with open(self.path, 'rb') as f:
+            while True:
+                header = f.read(_entry_header.size)
+                if not header:
+                    break
+                if len(header) < _entry_header.size:
+                    logger.warning('Truncated entry in %s', self.path)
+                    break
+                length, tid, key_id, nonce = _entry_header.unpack(header)
+                sealed = f.read(length - (_entry_header.size - 4))
+                if len(sealed) < length - (_entry_header.size - 4):
+                    logger.warning('Truncated entry in %s', self.path)
+                    break
+                try:
+                    payload = utility.aead(key_id).decrypt(
+                        nonce, sealed, _aad + tid + key_id)
+                except (ValueError, AttributeError):
+                    logger.warning(
+                        "Can't decrypt the references of transaction %s"
+                        " in %s", tid.hex(), self.path)
+                    continue
+                self._parse(payload, result)
+        return result
+
+    def _parse(self, payload, result):
+        view = memoryview(payload)
+        pos = 0
+        while pos < len(view):
+            key = bytes(view[pos:pos + KEY_SIZE])
+            pos += KEY_SIZE
+            n, = _count.unpack(view[pos:pos + 4])
+            pos += 4
+            result[key] = bytes(view[pos:pos + 8 * n])
+            pos += 8 * n
@@ -0,0 +1,100 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Testing support
+"""
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+from keas.kmi import testing
+
+from cipher.encryptingstorage import encrypt_util
+
+
+def encryption_utility(directory='.'):
+    """Return an `encrypt_util.EncryptionUtility` for tests.
+
+    It uses the test key encrypting key of ``keas.kmi``, written to
+    ``key.kek`` in `directory`, and a testing key management facility
+    keeping its keys in the ``keys`` subdirectory.  Pass it as the
+    ``utility`` of the storages under test.
+    """
+    keys = os.path.join(directory, 'keys')
+    os.makedirs(keys, exist_ok=True)
+    kek_path = os.path.join(directory, 'key.kek')
+    with open(kek_path, 'wb') as f:
+        f.write(testing.KeyEncyptingKey)
+    return encrypt_util.EncryptionUtility(
+        kek_path, testing.TestingKeyManagementFacility(keys))
+
+
+class FakeKMIServer:
+    """A local KMI server speaking the ``keas.kmi`` REST protocol over HTTP.
+
+    Keys are served from the `master` key management facility.  Requests
+    are counted in `requests`; `delay` slows every response down and
+    setting `fail` makes the server answer with a 503 error.
+    """
+
+    delay = 0
+    fail = False
+
+    def __init__(self, master):
+        self.master = master
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                server.requests.append(self.path)
+                if server.delay:
+                    time.sleep(server.delay)
+                if server.fail:
+                    return self._respond(503, b'Unavailable')
+                if self.path == '/new':
+                    return self._respond(200, server.master.generate())
+                try:
+                    key = server.master.getEncryptionKey(body)
+                except KeyError:
+                    return self._respond(404, b'Key not found')
+                self._respond(200, key)
+
+            def _respond(self, status, data):
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:%s/' % self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
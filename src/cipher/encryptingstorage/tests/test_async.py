@@ -0,0 +1,128 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Coroutine API tests"""
+import asyncio
+import os
+import threading
+import time
+import unittest
+
+import transaction
+import ZODB.blob
+import ZODB.FileStorage
+from persistent.mapping import PersistentMapping
+from zope.testing import setupstack
+
+import cipher.encryptingstorage
+from cipher.encryptingstorage import blob
+from cipher.encryptingstorage import testing
+
+
+class TestAsync(unittest.TestCase):
+
+    def setUp(self):
+        setupstack.setUpDirectory(self)
+        self.storage = cipher.encryptingstorage.EncryptingStorage(
+            ZODB.FileStorage.FileStorage('data.fs', blob_dir='blobs'),
+            async_workers=2, utility=testing.encryption_utility())
+        self.db = ZODB.DB(self.storage)
+        conn = self.db.open()
+        conn.root.mapping = PersistentMapping(value=1)
+        self.data = os.urandom(3 * blob.CHUNK_SIZE + 100)
+        conn.root.blob = ZODB.blob.Blob(self.data)
+        transaction.commit()
+        self.oid = conn.root.mapping._p_oid
+        self.blob_oid = conn.root.blob._p_oid
+        self.serial = self.storage.load(self.blob_oid)[1]
+        conn.root.mapping['value'] = 2
+        transaction.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.db.close()
+        setupstack.tearDown(self)
+
+    def test_load(self):
+        storage = self.storage
+        self.assertEqual(storage._async_pool.workers, 2)
+        threads = []
+        load = storage.base.load
+
+        def base_load(*args):
+            threads.append(threading.current_thread().name)
+            return load(*args)
+        storage.base.load = base_load
+
+        async def main():
+            return await asyncio.gather(
+                storage.aload(self.oid),
+                storage.aloadBefore(self.oid, storage.lastTransaction()))
+
+        loaded, before = asyncio.run(main())
+        del storage.base.load
+        self.assertEqual(loaded, storage.load(self.oid))
+        self.assertEqual(before, storage.loadBefore(
+            self.oid, storage.lastTransaction()))
+        self.assertTrue(threads[0].startswith('cipher.encryptingstorage'))
+
+    def test_backpressure(self):
+        storage = self.storage
+        queue = storage._async_pool.executor._work_queue
+        queued = []
+        load = storage.base.load
+
+        def base_load(*args):
+            time.sleep(0.01)
+            queued.append(queue.qsize())
+            return load(*args)
+        storage.base.load = base_load
+
+        async def main():
+            return await asyncio.gather(
+                *[storage.aload(self.oid) for i in range(10)])
+
+        loaded = asyncio.run(main())
+        del storage.base.load
+        self.assertEqual(loaded, [storage.load(self.oid)] * 10)
+        self.assertEqual(len(queued), 10)
+        self.assertLessEqual(max(queued), 1)
+
+    def test_blob(self):
+        storage = self.storage
+
+        async def main():
+            filename = await storage.aloadBlob(self.blob_oid, self.serial)
+            with open(filename, 'rb') as f:
+                self.assertEqual(f.read(), self.data)
+            f = await storage.aopenCommittedBlobFile(
+                self.blob_oid, self.serial)
+            async with f:
+                blocks = [block async for block in f]
+                await f.seek(blob.CHUNK_SIZE - 10)
+                self.assertEqual(f.tell(), blob.CHUNK_SIZE - 10)
+                data = await f.read(20)
+            self.assertTrue(f.closed)
+            return blocks, data
+
+        blocks, data = asyncio.run(main())
+        self.assertEqual(b''.join(blocks), self.data)
+        self.assertEqual(len(blocks), 4)
+        self.assertEqual(
+            data, self.data[blob.CHUNK_SIZE - 10:blob.CHUNK_SIZE + 10])
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestAsync),
+    ))
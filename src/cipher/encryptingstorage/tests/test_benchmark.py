@@ -0,0 +1,74 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Benchmark tests"""
+import io
+import json
+import unittest
+
+import mock
+from zope.testing import setupstack
+
+from cipher.encryptingstorage import benchmark
+from cipher.encryptingstorage import encrypt_util
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        setupstack.setUpDirectory(self)
+
+    def tearDown(self):
+        setupstack.tearDown(self)
+
+    def test_run(self):
+        utility = encrypt_util.ENCRYPTION_UTILITY
+        out = io.StringIO()
+        results = benchmark.run([50], [1000], 0.001, out)
+        self.assertIs(encrypt_util.ENCRYPTION_UTILITY, utility)
+        self.assertEqual(len(results), 2 * (6 + 2 + 4))
+        result = results['real/decrypt/random/50']
+        self.assertEqual(
+            sorted(result), ['mb_per_sec', 'ops', 'ops_per_sec', 'p99_ms'])
+        self.assertGreaterEqual(result['ops'], 5)
+        self.assertIn('real/load/FileStorage/50', out.getvalue())
+
+    def test_summarize(self):
+        result = benchmark.summarize([0.001] * 99 + [0.1], 1 << 20)
+        self.assertEqual(result['ops'], 100)
+        self.assertAlmostEqual(result['ops_per_sec'], 100 / 0.199)
+        self.assertAlmostEqual(result['mb_per_sec'], 100 / 0.199)
+        self.assertAlmostEqual(result['p99_ms'], 100)
+
+    def test_compare(self):
+        baseline = dict(a=dict(ops_per_sec=100), b=dict(ops_per_sec=100))
+        results = dict(a=dict(ops_per_sec=95), b=dict(ops_per_sec=80),
+                       c=dict(ops_per_sec=1))
+        self.assertEqual(benchmark.compare(results, baseline), ['b'])
+        self.assertEqual(benchmark.compare(results, baseline, 0.25), [])
+
+    def test_main(self):
+        results = dict(a=dict(ops_per_sec=100, mb_per_sec=1, p99_ms=1))
+        with mock.patch.object(benchmark, 'run', return_value=results):
+            self.assertEqual(benchmark.main(['--save', 'base.json']), 0)
+            with open('base.json') as f:
+                self.assertEqual(json.load(f), results)
+            results['a'] = dict(ops_per_sec=50, mb_per_sec=1, p99_ms=2)
+            with mock.patch('sys.stdout', io.StringIO()) as out:
+                self.assertEqual(
+                    benchmark.main(['--compare', 'base.json']), 1)
+            self.assertIn('REGRESSION a', out.getvalue())
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestBenchmark)
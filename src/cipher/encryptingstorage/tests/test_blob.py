@@ -0,0 +1,610 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Blob encryption tests"""
+import functools
+import io
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+import transaction
+import ZODB.blob
+import ZODB.config
+import ZODB.FileStorage
+from keas.kmi import facility
+from zope.testing import setupstack
+
+import cipher.encryptingstorage
+from cipher.encryptingstorage import blob
+from cipher.encryptingstorage import encrypt_util
+from cipher.encryptingstorage import testing
+
+
+class BlobTestBase(unittest.TestCase):
+
+    def setUp(self):
+        setupstack.setUpDirectory(self)
+        self.utility = testing.encryption_utility()
+        self.aead = self.utility.aead()
+
+    def tearDown(self):
+        setupstack.tearDown(self)
+
+    def _encrypt(self, data, chunk_size=blob.CHUNK_SIZE):
+        f = io.BytesIO()
+        blob.encrypt_stream(io.BytesIO(data), f, self.aead, chunk_size)
+        with open('blob.c', 'wb') as fp:
+            fp.write(f.getvalue())
+        return 'blob.c'
+
+    def _decrypt(self, filename):
+        with blob.open_decrypted(filename, self.aead) as f:
+            return f.read()
+
+
+class TestChunkedFormat(BlobTestBase):
+
+    def test_roundtrip(self):
+        for size in (0, 1, 99, 100, 101, 1000):
+            data = os.urandom(size)
+            filename = self._encrypt(data, 100)
+            self.assertEqual(self._decrypt(filename), data)
+            chunks = max(1, -(-size // 100))
+            self.assertEqual(
+                os.path.getsize(filename), 19 + size + chunks * 16)
+
+    def test_key_id(self):
+        f = io.BytesIO()
+        blob.encrypt_stream(
+            io.BytesIO(b'data'), f, self.aead, key_id=self.utility.keyId())
+        f.seek(0)
+        self.assertEqual(blob.key_id(f), self.utility.keyId())
+        self.assertEqual(f.tell(), 0)
+        self.assertIsNone(blob.key_id(io.BytesIO(b'.e' + b'\0' * 100)))
+        # Plain files starting with the magic aren't chunked files.
+        self.assertIsNone(blob.key_id(io.BytesIO(
+            b'.container {\n  margin: 0 auto;\n  width: 960px;\n}\n')))
+        data = f.getvalue()
+        for bad in (data[:2] + b'\2' + data[3:],
+                    data[:3] + b'\0\0\0\0' + data[7:],
+                    data[:3] + b'\x7f\0\0\0' + data[7:],
+                    data[:10]):
+            self.assertIsNone(blob.key_id(io.BytesIO(bad)))
+        self.assertTrue(blob.is_chunked(io.BytesIO(data)))
+        # Truncated files are chunked files, reading them fails.
+        self.assertTrue(blob.is_chunked(io.BytesIO(data[:-10])))
+
+    def test_writer_buffers_small_writes(self):
+        data = os.urandom(1000)
+        with open('blob.c', 'wb') as f:
+            writer = blob.ChunkedWriter(f, self.aead, 64)
+            for i in range(0, 1000, 7):
+                writer.write(data[i:i + 7])
+            writer.close()
+        self.assertEqual(self._decrypt('blob.c'), data)
+
+    def test_encrypted(self):
+        data = b'secret data ' * 1000
+        with open(self._encrypt(data), 'rb') as f:
+            encrypted = f.read()
+        self.assertEqual(encrypted[:3], b'.c\x01')
+        self.assertNotIn(b'secret', encrypted)
+
+    def test_random_access(self):
+        data = os.urandom(1000)
+        filename = self._encrypt(data, 100)
+        decrypted = []
+        decrypt = self.aead.decrypt
+        with mock.patch.object(
+                self.aead, 'decrypt',
+                lambda nonce, *args: decrypted.append(nonce[-1]) or decrypt(
+                    nonce, *args)):
+            with blob.open_decrypted(filename, self.aead) as f:
+                self.assertTrue(f.seekable())
+                f.seek(550)
+                self.assertEqual(f.read(20), data[550:570])
+                self.assertEqual(f.tell(), 570)
+                f.seek(-10, os.SEEK_END)
+                self.assertEqual(f.read(), data[-10:])
+                buffer = bytearray(30)
+                f.seek(190)
+                self.assertEqual(f.readinto(buffer), 30)
+                self.assertEqual(buffer, data[190:220])
+                f.seek(2000)
+                self.assertEqual(f.read(), b'')
+                self.assertRaises(ValueError, f.seek, -1)
+        # Only the chunks that were read were decrypted.
+        self.assertEqual(decrypted, [5, 9, 1, 2])
+
+    def _check_tampered(self, filename):
+        with blob.open_decrypted(filename, self.aead) as f:
+            self.assertRaises(ValueError, f.read)
+
+    def test_modified_chunk(self):
+        filename = self._encrypt(os.urandom(1000), 100)
+        with open(filename, 'r+b') as f:
+            f.seek(500)
+            byte = f.read(1)
+            f.seek(500)
+            f.write(bytes((byte[0] ^ 1,)))
+        self._check_tampered(filename)
+
+    def test_truncated(self):
+        filename = self._encrypt(os.urandom(1000), 100)
+        with open(filename, 'r+b') as f:
+            # Drop the last chunk.
+            f.truncate(19 + 9 * 116)
+        self._check_tampered(filename)
+
+    def test_reordered_chunks(self):
+        filename = self._encrypt(os.urandom(1000), 100)
+        with open(filename, 'rb') as f:
+            header = f.read(19)
+            first, second = f.read(116), f.read(116)
+            rest = f.read()
+        with open(filename, 'wb') as f:
+            f.write(header + second + first + rest)
+        self._check_tampered(filename)
+
+    def test_other_key(self):
+        filename = self._encrypt(b'data')
+        self.aead = encrypt_util.AESGCM(b'k' * 32)
+        self._check_tampered(filename)
+
+
+class TestStorageBlobs(BlobTestBase):
+
+    def _open(self):
+        return ZODB.DB(cipher.encryptingstorage.EncryptingStorage(
+            ZODB.FileStorage.FileStorage('data.fs', blob_dir='blobs'),
+            utility=self.utility))
+
+    def _store(self, data):
+        db = self._open()
+        conn = db.open()
+        conn.root.b = ZODB.blob.Blob(data)
+        transaction.commit()
+        conn.close()
+        db.close()
+        [filename] = [
+            os.path.join(path, name)
+            for path, _, names in os.walk('blobs')
+            for name in names if name.endswith('.blob')]
+        return filename
+
+    def _read(self):
+        db = self._open()
+        conn = db.open()
+        with conn.root.b.open() as f:
+            data = f.read()
+        conn.close()
+        db.close()
+        return data
+
+    def test_roundtrip(self):
+        data = os.urandom(200000)
+        filename = self._store(data)
+        with open(filename, 'rb') as f:
+            self.assertEqual(f.read(2), b'.c')
+        self.assertEqual(self._read(), data)
+
+    def test_openCommittedBlobFile(self):
+        data = os.urandom(200000)
+        self._store(data)
+        db = self._open()
+        storage = db.storage
+        conn = db.open()
+        b = conn.root.b
+        serial = storage.load(b._p_oid)[1]
+        # Blobs that aren't cached are decrypted while they are read.
+        with mock.patch.object(
+                cipher.encryptingstorage, 'decrypt_blob') as decrypt_blob:
+            with storage.openCommittedBlobFile(b._p_oid, serial) as f:
+                self.assertIsInstance(f, blob.DecryptedBlobFile)
+                # There's no decrypted file to reopen.
+                self.assertIsNone(f.name)
+                f.seek(150000)
+                self.assertEqual(f.read(100), data[150000:150100])
+        self.assertFalse(decrypt_blob.called)
+        self.assertEqual(len(storage.blob_cache), 0)
+
+        # Loading the blob caches it, the cached file is opened then.
+        b._p_activate()
+        self.assertEqual(len(storage.blob_cache), 1)
+        with mock.patch.object(blob, 'DecryptingReader') as reader:
+            with b.open() as f:
+                self.assertIsInstance(f, ZODB.blob.BlobFile)
+                self.assertEqual(f.name, b.committed())
+                f.seek(150000)
+                self.assertEqual(f.read(100), data[150000:150100])
+                self.assertEqual(len(b.readers), 1)
+            with b.open('c') as f:
+                self.assertEqual(f.read(), data)
+        self.assertFalse(reader.called)
+        self.assertEqual(b.readers, [])
+        self.assertEqual(storage.blob_cache.stats['misses'], 1)
+        conn.close()
+        db.close()
+
+    def test_loadBlob(self):
+        self._store(b'data')
+        db = self._open()
+        conn = db.open()
+        with open(conn.root.b.committed(), 'rb') as f:
+            self.assertEqual(f.read(), b'data')
+        self.assertEqual(db.storage.blob_cache.stats['misses'], 1)
+        conn.close()
+        db.close()
+
+    def test_evicted_while_loaded(self):
+        db = ZODB.DB(cipher.encryptingstorage.EncryptingStorage(
+            ZODB.FileStorage.FileStorage('data.fs', blob_dir='blobs'),
+            utility=self.utility, blob_cache_size=150000))
+        conn = db.open()
+        conn.root.a = ZODB.blob.Blob(b'a' * 100000)
+        conn.root.b = ZODB.blob.Blob(b'b' * 100000)
+        transaction.commit()
+        conn.cacheMinimize()
+        # The cached file of the first blob stays while the blob uses it.
+        conn.root.a._p_activate()
+        conn.root.b._p_activate()
+        self.assertTrue(os.path.exists(conn.root.a._p_blob_committed))
+        with conn.root.a.open('a') as f:
+            f.write(b'c')
+        transaction.commit()
+        with conn.root.a.open() as f:
+            self.assertEqual(f.read(), b'a' * 100000 + b'c')
+        conn.close()
+        db.close()
+
+    def test_legacy_blobs(self):
+        # Blobs written before the chunked format are still readable.
+        with mock.patch.object(self.utility, 'aead', return_value=None):
+            filename = self._store(b'legacy data')
+        with open(filename, 'rb') as f:
+            self.assertEqual(f.read(2), b'.e')
+        self.assertEqual(self._read(), b'legacy data')
+
+    def test_plain_blobs_starting_like_chunked(self):
+        css = b'.container {\n  margin: 0 auto;\n}\n' * 100
+        db = ZODB.DB(cipher.encryptingstorage.EncryptingStorage(
+            ZODB.FileStorage.FileStorage('data.fs', blob_dir='blobs'),
+            encrypt=False))
+        conn = db.open()
+        conn.root.b = ZODB.blob.Blob(css)
+        transaction.commit()
+        with open(conn.root.b.committed(), 'rb') as f:
+            self.assertEqual(f.read(), css)
+        conn.close()
+        db.close()
+        # The blob stays readable once encryption is turned on.
+        self.assertEqual(self._read(), css)
+
+    def test_unknown_key(self):
+        # A chunked file with a key that's gone isn't taken for a plain one.
+        filename = self._store(b'data' * 1000)
+        db = self._open()
+        conn = db.open()
+        b = conn.root.b
+        b._p_activate()
+        db.storage.blob_cache = blob.BlobCache('cache')
+        with mock.patch.object(
+                self.utility, 'aead',
+                side_effect=encrypt_util.DecryptionError):
+            self.assertRaises(
+                encrypt_util.DecryptionError,
+                db.storage.loadBlob, b._p_oid, b._p_serial)
+            self.assertRaises(
+                encrypt_util.DecryptionError,
+                db.storage.openCommittedBlobFile, b._p_oid, b._p_serial)
+        conn.close()
+        db.close()
+
+        utility = self.utility
+        utility.rotate(
+            facility.KeyManagementFacility.generate(utility.facility))
+        for key in utility.previous:
+            utility.keyring.remove(key)
+        self.assertRaises(
+            encrypt_util.DecryptionError,
+            cipher.encryptingstorage.decrypt_blob, filename, io.BytesIO(),
+            utility)
+        # Storages that don't encrypt take it for a plain file.
+        f = io.BytesIO()
+        cipher.encryptingstorage.decrypt_blob(filename, f, utility, False)
+        with open(filename, 'rb') as g:
+            self.assertEqual(f.getvalue(), g.read())
+
+    def test_truncated_blob(self):
+        filename = self._store(b'data' * 1000)
+        os.chmod(filename, 0o600)
+        for size in (4000, 30):
+            with open(filename, 'r+b') as f:
+                f.truncate(size)
+            self.assertRaises(
+                ValueError, cipher.encryptingstorage.decrypt_blob, filename,
+                io.BytesIO(), self.utility)
+
+    def test_tampered_blob(self):
+        filename = self._store(b'data' * 1000)
+        os.chmod(filename, 0o600)
+        with open(filename, 'r+b') as f:
+            f.seek(100)
+            f.write(b'evil')
+        db = self._open()
+        conn = db.open()
+        self.assertRaises(ValueError, lambda: conn.root.b.open())
+        # No partially decrypted file is left behind.
+        self.assertEqual(
+            [name for _, _, names in os.walk('tmp') for name in names
+             if name != '.lock'], [])
+        conn.close()
+        db.close()
+
+
+class TestBlobCache(unittest.TestCase):
+
+    def setUp(self):
+        setupstack.setUpDirectory(self)
+
+    def tearDown(self):
+        setupstack.tearDown(self)
+
+    def _get(self, cache, name, size=100):
+        # A copy of the path, so that the file isn't kept.
+        return str(cache.get(name, lambda f: f.write(b'x' * size)))
+
+    def test_hits_and_misses(self):
+        cache = blob.BlobCache('cache')
+        path = self._get(cache, os.path.join('0x01', '0x02.blob'))
+        self.assertEqual(path, os.path.join('cache', '0x01', '0x02.blob'))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'x' * 100)
+        self.assertEqual(self._get(cache, os.path.join('0x01', '0x02.blob')),
+                         path)
+        self.assertEqual(
+            cache.stats, dict(hits=1, misses=1, evictions=0))
+        self.assertEqual(cache.bytes, 100)
+
+    def test_lru_eviction(self):
+        cache = blob.BlobCache('cache', 250)
+        a = self._get(cache, 'a')
+        b = self._get(cache, 'b')
+        self._get(cache, 'a')
+        c = self._get(cache, 'c')
+        # b was the least recently used.
+        self.assertFalse(os.path.exists(b))
+        self.assertTrue(os.path.exists(a) and os.path.exists(c))
+        self.assertEqual(cache.bytes, 200)
+        self.assertEqual(cache.stats['evictions'], 1)
+
+        # Files bigger than the cache are kept until the next one.
+        big = self._get(cache, 'big', 1000)
+        self.assertEqual(sorted(os.listdir('cache')), ['.lock', 'big'])
+        self._get(cache, 'd')
+        self.assertFalse(os.path.exists(big))
+
+    def test_in_use(self):
+        cache = blob.BlobCache('cache', 250)
+        # The files are kept while the paths returned are referenced.
+        a = cache.get('a', lambda f: f.write(b'x' * 100))
+        b = self._get(cache, 'b')
+        c = self._get(cache, 'c')
+        self.assertTrue(os.path.exists(a) and os.path.exists(c))
+        self.assertFalse(os.path.exists(b))
+        self.assertIs(cache.get('a', None), a)
+        self.assertIs(cache.cached('a'), a)
+        # Once released, it's evicted like the others.
+        path = str(a)
+        del a
+        self._get(cache, 'd')
+        self.assertFalse(os.path.exists(c))
+        self._get(cache, 'e')
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(cache.bytes, 200)
+        self.assertEqual(cache.stats['evictions'], 3)
+
+    def test_unremovable(self):
+        cache = blob.BlobCache('cache', 150)
+        a = self._get(cache, 'a')
+        with mock.patch('os.remove', side_effect=PermissionError):
+            self._get(cache, 'b')
+        self.assertTrue(os.path.exists(a))
+        self.assertEqual(cache.bytes, 200)
+        self.assertEqual(cache.stats['evictions'], 0)
+        # It's removed later.
+        self._get(cache, 'c')
+        self.assertFalse(os.path.exists(a))
+
+    def test_failed_write(self):
+        cache = blob.BlobCache('cache')
+
+        def write(f):
+            f.write(b'partial')
+            raise ValueError('failed')
+        self.assertRaises(ValueError, cache.get, 'a', write)
+        self.assertEqual(os.listdir('cache'), ['.lock'])
+        self.assertEqual(len(cache), 0)
+
+    def test_existing_files(self):
+        cache = blob.BlobCache('cache')
+        a = self._get(cache, os.path.join('0x01', '0x0a.blob'))
+        b = self._get(cache, os.path.join('0x01', '0x0b.blob'))
+        fd, partial = tempfile.mkstemp(
+            '.tmp', blob._TEMPORARY_PREFIX, os.path.join('cache', '0x01'))
+        os.close(fd)
+        # Files of others sharing the directory are left alone.
+        others = [os.path.join('cache', name) for name in (
+            'session-data.db', 'upload.tmp', os.path.join('0x01', 'c.tmp'),
+            os.path.join('0x01', 'notes.txt'),
+            os.path.join('uploads', '0x02.blob'))]
+        os.mkdir(os.path.join('cache', 'uploads'))
+        for name in others:
+            with open(name, 'wb') as f:
+                f.write(b'y' * 1000)
+        cache = blob.BlobCache('cache', 150)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.bytes, 100)
+        self.assertFalse(os.path.exists(partial))
+        self.assertTrue(os.path.exists(a) or os.path.exists(b))
+        for name in others:
+            self.assertTrue(os.path.exists(name))
+
+    def test_storage(self):
+        store = ZODB.config.storageFromString("""
+            %import cipher.encryptingstorage
+            <encryptingstorage>
+                blob-cache-dir decrypted
+                blob-cache-size 1MB
+                <filestorage>
+                    path data.fs
+                    blob-dir blobs
+                </filestorage>
+            </encryptingstorage>
+            """)
+        self.assertEqual(
+            store.blob_cache.directory, os.path.abspath('decrypted'))
+        self.assertEqual(store.blob_cache.size, 1 << 20)
+        store.close()
+
+        store = cipher.encryptingstorage.EncryptingStorage(
+            ZODB.FileStorage.FileStorage('data.fs', blob_dir='blobs'))
+        self.assertEqual(store.blob_cache.directory, os.path.abspath('tmp'))
+        self.assertIsNone(store.blob_cache.size)
+        store.close()
+
+        # The default directory is shared with others.
+        os.mkdir('tmp')
+        with open(os.path.join('tmp', 'session-data.db'), 'wb') as f:
+            f.write(b'x' * 2000)
+        store = cipher.encryptingstorage.EncryptingStorage(
+            ZODB.FileStorage.FileStorage('data.fs', blob_dir='blobs'),
+            blob_cache_size=1000)
+        self.assertEqual(len(store.blob_cache), 0)
+        self.assertTrue(os.path.exists(os.path.join('tmp', 'session-data.db')))
+        store.close()
+
+
+SIZE = 1 << 20
+
+
+def _slow_write(f, log=None):
+    if log is not None:
+        with open(log, 'a') as fp:
+            fp.write('%s\n' % os.getpid())
+    for i in range(16):
+        time.sleep(0.005)
+        f.write(b'x' * (SIZE // 16))
+
+
+def _get_in_process(directory, log):
+    path = blob.BlobCache(directory).get(
+        'a', functools.partial(_slow_write, log=log))
+    if os.path.getsize(path) != SIZE:
+        raise AssertionError('Incomplete file')
+
+
+class TestBlobCacheConcurrency(unittest.TestCase):
+
+    def setUp(self):
+        setupstack.setUpDirectory(self)
+
+    def tearDown(self):
+        setupstack.tearDown(self)
+
+    def test_threads(self):
+        cache = blob.BlobCache('cache')
+        names = ['%s.blob' % i for i in range(4)] * 8
+        writes = []
+        sizes = []
+        start = threading.Barrier(len(names))
+
+        def write(name, f):
+            writes.append(name)
+            _slow_write(f)
+
+        def get(name):
+            start.wait()
+            path = cache.get(name, functools.partial(write, name))
+            sizes.append(os.path.getsize(path))
+
+        threads = [threading.Thread(target=get, args=(name,))
+                   for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Every file was written once and nobody saw a partial file.
+        self.assertEqual(sorted(writes), sorted(set(names)))
+        self.assertEqual(sizes, [SIZE] * len(names))
+        self.assertEqual(cache.stats['misses'], 4)
+        self.assertEqual(cache.stats['hits'], len(names) - 4)
+        self.assertEqual(cache._flights, {})
+
+    def test_failed_write_is_retried(self):
+        cache = blob.BlobCache('cache')
+        start = threading.Barrier(4)
+        failures = []
+
+        def write(f):
+            if not failures:
+                failures.append(1)
+                raise ValueError('failed')
+            _slow_write(f)
+
+        def get():
+            start.wait()
+            try:
+                cache.get('a', write)
+            except ValueError:
+                pass
+
+        threads = [threading.Thread(target=get) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(os.path.getsize(os.path.join('cache', 'a')), SIZE)
+        self.assertEqual(cache.stats['misses'], 1)
+
+    def test_processes(self):
+        context = multiprocessing.get_context('spawn')
+        processes = [
+            context.Process(
+                target=_get_in_process, args=('cache', 'writes.log'))
+            for i in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertEqual(
+            [process.exitcode for process in processes], [0] * 4)
+        with open('writes.log') as f:
+            self.assertEqual(len(f.readlines()), 1)
+        self.assertEqual(sorted(os.listdir('cache')), ['.lock', 'a'])
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestChunkedFormat),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestStorageBlobs),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestBlobCache),
+        unittest.defaultTestLoader.loadTestsFromTestCase(
+            TestBlobCacheConcurrency),
+    ))
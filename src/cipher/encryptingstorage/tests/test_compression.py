@@ -0,0 +1,438 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Compression codec tests"""
+import os
+import pickle
+import tracemalloc
+import unittest
+import zlib
+
+import mock
+import transaction
+import ZODB.config
+import ZODB.FileStorage
+import ZODB.MappingStorage
+from zope.testing import setupstack
+
+import cipher.encryptingstorage
+from cipher.encryptingstorage import compression
+from cipher.encryptingstorage import encrypt_util
+from cipher.encryptingstorage import testing
+
+
+DATA = b'Some compressible record data. ' * 20
+
+
+class TestCodecs(unittest.TestCase):
+
+    def _check_roundtrip(self, name, tag):
+        codec = compression.getCodec(name)
+        if not codec.available:
+            self.skipTest('%s is not installed' % name)
+        compressed = compression.compress(DATA, codec)
+        self.assertEqual(compressed[:2], tag)
+        self.assertLess(len(compressed), len(DATA))
+        self.assertEqual(compression.decompress(compressed), DATA)
+
+    def test_zlib(self):
+        self._check_roundtrip('zlib', b'.z')
+
+    def test_zstd(self):
+        self._check_roundtrip('zstd', b'.s')
+
+    def test_lz4(self):
+        self._check_roundtrip('lz4', b'.l')
+
+    def test_levels(self):
+        fast = compression.compress(DATA, compression.getCodec('zlib', 1))
+        best = compression.compress(DATA, compression.getCodec('zlib', 9))
+        self.assertEqual(fast, b'.z' + zlib.compress(DATA, 1))
+        self.assertEqual(best, b'.z' + zlib.compress(DATA, 9))
+
+    def test_legacy_zlib_records(self):
+        self.assertEqual(
+            compression.decompress(b'.z' + zlib.compress(DATA)), DATA)
+
+    def test_no_double_compression(self):
+        data = b'.s' + b'x' * 80
+        self.assertEqual(compression.compress(data), data)
+
+    def test_small_and_incompressible(self):
+        self.assertEqual(compression.compress(b'x' * 20), b'x' * 20)
+        data = bytes(range(256))
+        self.assertEqual(compression.compress(data), data)
+        self.assertEqual(compression.decompress(data), data)
+
+    def test_unknown_codec(self):
+        self.assertRaises(ValueError, compression.getCodec, 'rot13')
+
+    def test_fallback_when_missing(self):
+        with mock.patch.object(compression.ZstdCodec, 'available', False):
+            with mock.patch.object(compression.logger, 'warning') as warning:
+                codec = compression.getCodec('zstd', 19)
+        self.assertIsInstance(codec, compression.ZlibCodec)
+        self.assertEqual(codec.level, -1)
+        self.assertTrue(warning.called)
+
+    def test_decompress_when_missing(self):
+        codec = compression.getCodec('lz4')
+        if not codec.available:
+            self.skipTest('lz4 is not installed')
+        compressed = compression.compress(DATA, codec)
+        with mock.patch.object(compression, 'lz4', None):
+            self.assertRaises(
+                ImportError, compression.decompress, compressed)
+
+
+class TestAdaptiveCodec(unittest.TestCase):
+
+    def _record(self, class_name, state):
+        # The start of a ZODB record: the pickled class.
+        return b'\x80\x03cmod\n%s\nq\x00.' % class_name.encode() + state
+
+    def setUp(self):
+        self.codec = compression.AdaptiveCodec(compression.getCodec('zlib'))
+        self.calls = 0
+        compress = self.codec.codec.compress
+
+        def counting_compress(data):
+            self.calls += 1
+            return compress(data)
+        self.codec.codec.compress = counting_compress
+
+    def test_compressible(self):
+        record = self._record('Text', DATA)
+        compressed = compression.compress(record, self.codec)
+        self.assertEqual(compression.decompress(compressed), record)
+        self.assertEqual(
+            self.codec.stats,
+            dict(compressed=1, incompressible=0, skipped=0))
+
+    def test_incompressible_classes_are_skipped(self):
+        for i in range(200):
+            record = self._record('Image', os.urandom(1000))
+            self.assertEqual(compression.compress(record, self.codec), record)
+        stats = self.codec.stats
+        self.assertEqual(stats['incompressible'], self.calls)
+        self.assertEqual(stats['incompressible'] + stats['skipped'], 200)
+        # Only the first few records and the reprobes were compressed.
+        self.assertEqual(self.calls, 8 + 2)
+
+        # Other classes are still compressed.
+        compression.compress(self._record('Text', DATA), self.codec)
+        self.assertEqual(stats['compressed'], 1)
+
+    def test_class_becomes_compressible(self):
+        for i in range(10):
+            compression.compress(
+                self._record('Blob', os.urandom(1000)), self.codec)
+        for i in range(128):
+            compression.compress(self._record('Blob', DATA), self.codec)
+        # The reprobes notice that the class compresses now.
+        self.assertGreater(self.codec.stats['compressed'], 64)
+
+    def test_large_payloads_are_sampled(self):
+        data = os.urandom(100000)
+        self.assertEqual(compression.compress(data, self.codec), data)
+        self.assertEqual(self.calls, 0)
+        self.assertEqual(self.codec.stats['skipped'], 1)
+
+        data = DATA * 100
+        self.assertLess(len(compression.compress(data, self.codec)), 1000)
+        self.assertEqual(self.calls, 1)
+
+    def test_storage(self):
+        store = cipher.encryptingstorage.EncryptingStorage(
+            ZODB.MappingStorage.MappingStorage())
+        self.assertIsInstance(store.codec, compression.AdaptiveCodec)
+        store = cipher.encryptingstorage.EncryptingStorage(
+            ZODB.MappingStorage.MappingStorage(), adaptive_compression=False)
+        self.assertIsInstance(store.codec, compression.ZlibCodec)
+
+
+def _pickles(count):
+    return [
+        pickle.dumps(
+            {'title': 'Document %d' % i, 'id': i, 'state': 'published',
+             'owner': 'user%d' % (i % 50), 'tags': ['news', 'events']}, 3)
+        for i in range(count)]
+
+
+class TestDictionaryCompression(unittest.TestCase):
+
+    def setUp(self):
+        if not compression.ZstdCodec.available:
+            self.skipTest('zstandard is not installed')
+        setupstack.setUpDirectory(self)
+
+    def tearDown(self):
+        setupstack.tearDown(self)
+
+    def _train(self):
+        db = ZODB.DB(cipher.encryptingstorage.EncryptingStorage(
+            ZODB.FileStorage.FileStorage('data.fs')))
+        conn = db.open()
+        for i, data in enumerate(_pickles(500)):
+            conn.root()[i] = conn.root().__class__(data=data)
+            if not i % 50:
+                transaction.commit()
+        transaction.commit()
+        conn.close()
+        dictionary = compression.train_dictionary(db.storage, 4096)
+        db.close()
+        return dictionary
+
+    def test_small_records(self):
+        dictionary = self._train()
+        codec = compression.getCodec('zstd', dictionaries=[dictionary])
+        record = _pickles(1000)[-1]
+        plain = compression.compress(record, compression.getCodec('zstd'))
+        compressed = compression.compress(record, codec)
+        self.assertEqual(compressed[:2], b'.d')
+        self.assertLess(len(compressed), len(plain) // 2)
+        self.assertEqual(compression.decompress(compressed), record)
+
+    def test_unknown_dictionary(self):
+        dictionary = self._train()
+        compressed = compression.compress(
+            _pickles(1)[0], compression.getCodec(
+                'zstd', dictionaries=[dictionary]))
+        with mock.patch.object(compression, '_dictionaries', {}):
+            with mock.patch.object(compression, '_local',
+                                   compression.threading.local()):
+                self.assertRaises(
+                    ValueError, compression.decompress, compressed)
+
+    def test_dictionaries_need_zstd(self):
+        self.assertRaises(
+            ValueError, compression.getCodec, 'zlib', dictionaries=[b'x'])
+
+    def test_config(self):
+        with open('records.dict', 'wb') as f:
+            f.write(self._train())
+        store = ZODB.config.storageFromString("""
+            %import cipher.encryptingstorage
+            <encryptingstorage>
+                compression zstd
+                compression-dictionary records.dict
+                <mappingstorage>
+                </mappingstorage>
+            </encryptingstorage>
+            """)
+        record = _pickles(1)[0]
+        data = store._transform(record)
+        self.assertEqual(data[:4], b'.e.d')
+        self.assertEqual(store._untransform(data), record)
+        store.close()
+
+
+class TestStorageCompression(unittest.TestCase):
+
+    def setUp(self):
+        setupstack.setUpDirectory(self)
+
+    def tearDown(self):
+        setupstack.tearDown(self)
+
+    def _open(self, **kw):
+        return ZODB.DB(cipher.encryptingstorage.EncryptingStorage(
+            ZODB.FileStorage.FileStorage('data.fs'), **kw))
+
+    def test_mixed_codecs(self):
+        names = 'zlib', 'lz4', 'zstd'
+        for name in names:
+            db = self._open(compression=name)
+            conn = db.open()
+            conn.root()[name] = conn.root().__class__(data=DATA)
+            transaction.commit()
+            conn.close()
+            db.close()
+
+        db = self._open()
+        conn = db.open()
+        self.assertEqual(
+            {name: conn.root()[name]['data'] for name in names},
+            {name: DATA for name in names})
+        conn.close()
+        db.close()
+
+    def test_config(self):
+        store = ZODB.config.storageFromString("""
+            %import cipher.encryptingstorage
+            <encryptingstorage>
+                compression lz4
+                <mappingstorage>
+                </mappingstorage>
+            </encryptingstorage>
+            """)
+        data = store._transform(DATA)
+        if compression.Lz4Codec.available:
+            # Without an encryption configuration, the "encryption" is
+            # trivial and we can see the codec tag.
+            self.assertEqual(data[:4], b'.e.l')
+        self.assertEqual(store._untransform(data), DATA)
+        store.close()
+
+    def test_level_and_min_size(self):
+        store = ZODB.config.storageFromString("""
+            %import cipher.encryptingstorage
+            <encryptingstorage>
+                compression-level 9
+                compression-min-size 1KB
+                adaptive-compression off
+                <mappingstorage>
+                </mappingstorage>
+            </encryptingstorage>
+            """)
+        self.assertEqual(store.codec.level, 9)
+        self.assertEqual(store._transform.min_size, 1024)
+        self.assertEqual(store._transform(DATA)[:4], b'.e' + DATA[:2])
+        data = store._transform(DATA * 2)
+        self.assertEqual(data[:4], b'.e.z')
+        self.assertEqual(data[4:], zlib.compress(DATA * 2, 9))
+        self.assertEqual(store._untransform(data), DATA * 2)
+        store.close()
+
+    def test_compress_without_encryption(self):
+        db = self._open(encrypt=False, compress_records=True)
+        data = db.storage._transform(DATA)
+        self.assertEqual(data[:2], b'.z')
+        conn = db.open()
+        conn.root()['data'] = DATA
+        transaction.commit()
+        conn.close()
+        db.close()
+        db = self._open(encrypt=False)
+        self.assertEqual(db.storage._transform(DATA), DATA)
+        conn = db.open()
+        self.assertEqual(conn.root()['data'], DATA)
+        conn.close()
+        db.close()
+
+    def test_encrypt_without_compression(self):
+        store = ZODB.config.storageFromString("""
+            %import cipher.encryptingstorage
+            <encryptingstorage>
+                compress off
+                <mappingstorage>
+                </mappingstorage>
+            </encryptingstorage>
+            """)
+        data = store._transform(DATA)
+        self.assertEqual(data[:4], b'.e' + DATA[:2])
+        self.assertEqual(store._untransform(data), DATA)
+        store.close()
+
+
+class TestRecordCopies(unittest.TestCase):
+    """Records are copied at most once on the way in and out.
+
+    The peak of the memory allocated while transforming a record shows how
+    many copies of it were alive at the same time.  The codecs are chosen
+    not to allocate more than their output: adaptive compression skips
+    random data and zstd records know their decompressed size.
+    """
+
+    size = 4 << 20
+
+    def setUp(self):
+        setupstack.setUpDirectory(self)
+        self.utility = testing.encryption_utility()
+        self.utility.context()
+
+    def tearDown(self):
+        setupstack.tearDown(self)
+
+    def _peak(self, func, *args):
+        tracemalloc.start()
+        try:
+            result = func(*args)
+            return result, tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def _encrypt(self, data, codec=None):
+        if codec is None:
+            codec = compression.AdaptiveCodec(compression.ZlibCodec())
+        return cipher.encryptingstorage.encrypt(
+            data, codec, utility=self.utility)
+
+    def _decrypt(self, data):
+        return cipher.encryptingstorage.decrypt(data, self.utility)
+
+    def test_incompressible(self):
+        data = os.urandom(self.size)
+        encrypted, peak = self._peak(self._encrypt, data)
+        # Only the buffer it was encrypted into, which is the output.
+        self.assertLess(peak, self.size * 1.5)
+        decrypted, peak = self._peak(self._decrypt, encrypted)
+        self.assertEqual(decrypted, data)
+        # The output and the decrypted text it was copied from.
+        self.assertLess(peak, self.size * 2.5)
+
+    def test_compressible(self):
+        data = DATA * (self.size // len(DATA))
+        encrypted, peak = self._peak(
+            self._encrypt, data, compression.ZstdCodec())
+        self.assertLess(len(encrypted), self.size // 10)
+        # zstd's output buffer, sized for the worst case.
+        self.assertLess(peak, self.size * 1.5)
+        decrypted, peak = self._peak(self._decrypt, encrypted)
+        self.assertEqual(decrypted, data)
+        # Only the output is record-sized.
+        self.assertLess(peak, self.size * 1.5)
+
+    def test_decrypt_many(self):
+        datas = [os.urandom(self.size // 2), os.urandom(self.size // 2)]
+        encrypted = [self._encrypt(data) for data in datas]
+        decrypted, peak = self._peak(
+            cipher.encryptingstorage.decrypt_many, encrypted, self.utility)
+        self.assertEqual(decrypted, datas)
+        self.assertLess(peak, self.size * 2.5)
+
+    def test_trivial_utility(self):
+        self.utility = encrypt_util.TrivialEncryptionUtility()
+        data = os.urandom(self.size)
+        encrypted, peak = self._peak(self._encrypt, data)
+        self.assertEqual(encrypted, b'.e' + data)
+        self.assertLess(peak, self.size * 1.5)
+        decrypted, peak = self._peak(self._decrypt, encrypted)
+        self.assertEqual(decrypted, data)
+        self.assertLess(peak, self.size * 1.5)
+
+    def test_encryptParts(self):
+        context = self.utility.context()
+        for sizes in ((), (0,), (2, 14), (2, 13), (5, 40, 3, 0, 16), (33,)):
+            parts = [os.urandom(size) for size in sizes]
+            encrypted = context.encryptParts(parts, b'.e')
+            self.assertEqual(
+                encrypted, b'.e' + context.encrypt(b''.join(parts)))
+            self.assertEqual(
+                context.decrypt(encrypted[2:]), b''.join(parts))
+        # The ciphertext is the one keas.kmi produces.
+        self.assertEqual(
+            context.encrypt(DATA), self.utility.facility.encrypt(
+                self.utility.key, DATA))
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestCodecs),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestAdaptiveCodec),
+        unittest.defaultTestLoader.loadTestsFromTestCase(
+            TestDictionaryCompression),
+        unittest.defaultTestLoader.loadTestsFromTestCase(
+            TestStorageCompression),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestRecordCopies),
+    ))
@@ -0,0 +1,169 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Database conversion tests"""
+import io
+import unittest
+
+import mock
+import transaction
+import ZODB.blob
+import ZODB.FileStorage
+from persistent.mapping import PersistentMapping
+from zope.testing import setupstack
+
+import cipher.encryptingstorage
+from cipher.encryptingstorage import convert
+from cipher.encryptingstorage import encrypt_util
+from cipher.encryptingstorage import testing
+
+
+class TestConverter(unittest.TestCase):
+
+    def setUp(self):
+        setupstack.setUpDirectory(self)
+        self.utility = testing.encryption_utility()
+        db = ZODB.DB(self._open('source'))
+        conn = db.open()
+        for i in range(20):
+            conn.root()[i] = PersistentMapping(value=i)
+            transaction.commit()
+        conn.root.blob = ZODB.blob.Blob(b'blob data' * 1000)
+        transaction.commit()
+        del conn.root()[3]
+        transaction.commit()
+        conn.close()
+        db.close()
+
+    def tearDown(self):
+        setupstack.tearDown(self)
+
+    def _open(self, name, encrypt=True):
+        storage = ZODB.FileStorage.FileStorage(
+            name + '.fs', blob_dir=name + '-blobs')
+        if encrypt:
+            storage = cipher.encryptingstorage.EncryptingStorage(
+                storage, utility=self.utility)
+        return storage
+
+    def _records(self, storage):
+        return [(t.tid, t.description,
+                 [(r.oid, r.tid, r.data) for r in t])
+                for t in storage.iterator()]
+
+    def _check(self, name, encrypt=True):
+        source = self._open('source')
+        destination = self._open(name, encrypt)
+        self.assertEqual(self._records(source), self._records(destination))
+        source.close()
+        destination.close()
+        db = ZODB.DB(self._open(name, encrypt))
+        conn = db.open()
+        self.assertEqual(conn.root()[19]['value'], 19)
+        self.assertNotIn(3, conn.root())
+        with conn.root.blob.open() as f:
+            self.assertEqual(f.read(), b'blob data' * 1000)
+        conn.close()
+        db.close()
+
+    def _convert(self, name, encrypt=True, **kw):
+        source = self._open('source')
+        destination = self._open(name, encrypt)
+        try:
+            return convert.Converter(source, destination, **kw).run()
+        finally:
+            source.close()
+            destination.close()
+
+    def test_convert(self):
+        self.utility.record_format = 'cbc'
+        stats = self._convert('copy', workers=2, batch_size=5)
+        self.assertEqual(stats['transactions'], 23)
+        self.assertEqual(stats['blobs'], 1)
+        self._check('copy')
+        # The records were encrypted again, in the current format.
+        self.utility.record_format = 'gcm'
+        self._convert('gcm', workers=2, batch_size=5)
+        self._check('gcm')
+        storage = self._open('gcm', False)
+        data = storage.load(b'\0' * 8)[0]
+        self.assertTrue(encrypt_util.is_sealed(memoryview(data)[2:]))
+        storage.close()
+
+    def test_decrypt(self):
+        self._convert('plain', False, workers=2)
+        self._check('plain', False)
+        storage = self._open('plain', False)
+        self.assertNotEqual(storage.load(b'\0' * 8)[0][:2], b'.e')
+        storage.close()
+
+    def test_raw(self):
+        self._convert('raw', raw=True)
+        source = self._open('source', False)
+        destination = self._open('raw', False)
+        self.assertEqual(self._records(source), self._records(destination))
+        source.close()
+        destination.close()
+        self._check('raw')
+        self.assertRaises(
+            ValueError, self._convert, 'raw-plain', False, raw=True)
+
+    def test_incremental(self):
+        self._convert('copy', workers=1)
+        self.assertRaises(ValueError, self._convert, 'copy', workers=1)
+        db = ZODB.DB(self._open('source'))
+        conn = db.open()
+        conn.root()[19]['value'] = 'changed'
+        transaction.commit()
+        conn.close()
+        db.close()
+        stats = self._convert('copy', workers=1, incremental=True)
+        self.assertEqual(stats['transactions'], 1)
+        source = self._open('source')
+        destination = self._open('copy')
+        self.assertEqual(self._records(source), self._records(destination))
+        source.close()
+        destination.close()
+
+    def test_main(self):
+        with open('convert.conf', 'w') as f:
+            f.write('''
+            %import cipher.encryptingstorage
+            <encryptingstorage source>
+              <filestorage>
+                path source.fs
+                blob-dir source-blobs
+              </filestorage>
+            </encryptingstorage>
+            <encryptingstorage destination>
+              <filestorage>
+                path copy.fs
+                blob-dir copy-blobs
+              </filestorage>
+            </encryptingstorage>
+            ''')
+        out = io.StringIO()
+        # The storages of the configuration use the global utility.
+        with mock.patch('sys.stdout', out), mock.patch.object(
+                encrypt_util, 'ENCRYPTION_UTILITY', self.utility):
+            self.assertEqual(
+                convert.main(['--workers', '2', 'convert.conf']), 0)
+        self.assertIn('23 transactions, ', out.getvalue())
+        self.assertIn(' MB/s', out.getvalue())
+        self._check('copy')
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestConverter),
+    ))
@@ -16,11 +16,14 @@ import doctest
 import os
 import shutil
 import tempfile
+import time
 
 from keas.kmi import facility
+from keas.kmi import testing
 from zope.app.testing import setup
 
 from cipher.encryptingstorage import encrypt_util
+from cipher.encryptingstorage.testing import FakeKMIServer
 
 
 def doctest_EncryptionUtility():
@@ -38,11 +41,12 @@ def doctest_EncryptionUtility():
 
       >>> util = encrypt_util.EncryptionUtility(kek_path, kmf)
 
-    Encrypt text:
+    Encrypt text, in the authenticated format: a version byte, the 4 byte
+    key ID, the 12 byte nonce, the ciphertext and the 16 byte tag:
 
       >>> data = util.encrypt(u'test')
       >>> len(data)
-      16
+      37
 
     Decrypt text:
 
@@ -55,6 +59,391 @@ def doctest_EncryptionUtility():
     """
 
 
+def doctest_EncryptionUtility_context():
+    r"""Cached cipher context
+
+    The data encryption key is resolved once per key encrypting key and
+    then reused for every record:
+
+      >>> storage_dir = tempfile.mkdtemp()
+      >>> kek_path = os.path.join(storage_dir, 'key.kek')
+      >>> kmf = facility.KeyManagementFacility(storage_dir)
+      >>> util = encrypt_util.EncryptionUtility(kek_path, kmf)
+
+      >>> lookups = []
+      >>> getEncryptionKey = kmf.getEncryptionKey
+      >>> kmf.getEncryptionKey = lambda key: (
+      ...     lookups.append(key) or getEncryptionKey(key))
+
+      >>> data = [util.encryptBytes(b'record %d' % i) for i in range(10)]
+      >>> [util.decryptBytes(d) for d in data][:2]
+      [b'record 0', b'record 1']
+      >>> len(lookups)
+      1
+
+    The ciphertext of the legacy format is the same ``keas.kmi``
+    produces:
+
+      >>> util.context().encrypt(b'record 0') == kmf.encrypt(
+      ...     util.key, b'record 0')
+      True
+      >>> util.context()
+      <CipherContext ...>
+      >>> util.context().hash == encrypt_util.kek_hash(util.key)
+      True
+      >>> del lookups[:]
+
+    Invalidating drops the cached context, so the key is resolved again:
+
+      >>> util.invalidate()
+      >>> util.decryptBytes(data[0])
+      b'record 0'
+      >>> len(lookups)
+      1
+
+    Rotating switches to a new key encrypting key; the context of the old
+    key stays available until it is invalidated:
+
+      >>> old_key = util.key
+      >>> util.rotate(kmf.generate())
+      >>> util.encryptBytes(b'record 0') == data[0]
+      False
+
+    Records written with the old key are still read:
+
+      >>> util.previous == [old_key]
+      True
+      >>> util.decryptBytes(data[0])
+      b'record 0'
+      >>> util.context(old_key).decrypt(data[0])
+      b'record 0'
+      >>> len(lookups)
+      2
+      >>> util.invalidate(old_key)
+      >>> util.context(old_key).decrypt(data[0])
+      b'record 0'
+      >>> len(lookups)
+      3
+
+      >>> shutil.rmtree(storage_dir)
+    """
+
+
+def doctest_EncryptionUtility_decryptMany():
+    r"""Decrypting many records at once
+
+      >>> storage_dir = tempfile.mkdtemp()
+      >>> kek_path = os.path.join(storage_dir, 'key.kek')
+      >>> kmf = facility.KeyManagementFacility(storage_dir)
+      >>> util = encrypt_util.EncryptionUtility(kek_path, kmf)
+
+    The result is the same as decrypting record by record, including
+    records that can't be decrypted:
+
+      >>> records = [util.encryptBytes(b'x' * i) for i in range(40)]
+      >>> records[3:3] = [b'', b'bad', b'0123456789abcdef']
+      >>> util.decryptMany(records) == [
+      ...     util.decryptBytes(r) for r in records]
+      True
+      >>> util.decryptMany(records)[3:5]
+      [b'', b'bad']
+      >>> util.decryptMany([])
+      []
+
+      >>> trivial = encrypt_util.TrivialEncryptionUtility()
+      >>> trivial.decryptMany(iter(records)) == records
+      True
+
+      >>> shutil.rmtree(storage_dir)
+    """
+
+
+def doctest_EncryptionUtility_record_format():
+    r"""Authenticated records
+
+      >>> storage_dir = tempfile.mkdtemp()
+      >>> kek_path = os.path.join(storage_dir, 'key.kek')
+      >>> kmf = facility.KeyManagementFacility(storage_dir)
+      >>> util = encrypt_util.EncryptionUtility(kek_path, kmf)
+      >>> util.record_format == encrypt_util.DEFAULT_RECORD_FORMAT
+      True
+
+    The authenticated format is the default:
+
+      >>> util.record_format
+      'gcm'
+
+    Records are encrypted with AES-GCM and a random nonce:
+
+      >>> data = util.encryptBytes(b'record')
+      >>> data[:1], len(data)
+      (b'\x01', 39)
+      >>> data[1:5] == encrypt_util.key_id(util.key) == util.keyId()
+      True
+      >>> data == util.encryptBytes(b'record')
+      False
+      >>> util.decryptBytes(data)
+      b'record'
+
+    Tampering is detected instead of returning garbage:
+
+      >>> tampered = data[:-1] + bytes((data[-1] ^ 1,))
+      >>> util.decryptBytes(tampered)
+      Traceback (most recent call last):
+      ...
+      cipher.encryptingstorage.encrypt_util.DecryptionError: Record failed authentication
+      >>> util.decryptMany([data, tampered])
+      Traceback (most recent call last):
+      ...
+      cipher.encryptingstorage.encrypt_util.DecryptionError: Record failed authentication
+
+    Also when the record could be a legacy one, a multiple of 16 bytes
+    long, and records naming an unknown key aren't tried in the legacy
+    format.
+
+      >>> short = util.encryptBytes(b'x' * 15)
+      >>> len(short)
+      48
+      >>> for i in range(1, 256):
+      ...     tampered = short[:-1] + bytes((short[-1] ^ i,))
+      ...     try:
+      ...         util.decryptBytes(tampered)
+      ...     except encrypt_util.DecryptionError:
+      ...         continue
+      ...     print('not detected')
+      >>> util.decryptBytes(short[:1] + b'\0' * 4 + short[5:])
+      Traceback (most recent call last):
+      ...
+      cipher.encryptingstorage.encrypt_util.DecryptionError: Unknown key ID 00000000
+
+    Records in the legacy format stay readable.  Those that happen to
+    start like authenticated records, with the version byte, are taken for
+    records of an unknown key, though, unless the utility reads legacy
+    records, as it does by default if it writes them:
+
+      >>> legacy = encrypt_util.EncryptionUtility(kek_path, kmf, 'cbc')
+      >>> legacy.legacy_records, util.legacy_records
+      (True, False)
+      >>> texts = [b'%d: legacy record ' % i * 3 for i in range(2000)]
+      >>> old = [legacy.encryptBytes(text) for text in texts]
+      >>> old[0] == kmf.encrypt(util.key, texts[0])
+      True
+      >>> like_sealed = [d for d in old if encrypt_util.is_sealed(d)]
+      >>> len(like_sealed) > 0
+      True
+      >>> util.decryptBytes(like_sealed[0])
+      Traceback (most recent call last):
+      ...
+      cipher.encryptingstorage.encrypt_util.DecryptionError: Unknown key ID ...
+      >>> [util.decryptBytes(d) for d in old if d not in like_sealed] == [
+      ...     text for text, d in zip(texts, old) if d not in like_sealed]
+      True
+
+      >>> util = encrypt_util.EncryptionUtility(
+      ...     kek_path, kmf, legacy_records=True)
+      >>> [util.decryptBytes(d) for d in old] == texts
+      True
+      >>> [bytes(d) for d in util.decryptMany(old + [data])] == (
+      ...     texts + [b'record'])
+      True
+
+    A cipher context reads what it encrypted, like ``keas.kmi``:
+
+      >>> [util.context().decrypt(d) for d in old] == texts
+      True
+
+      >>> encrypt_util.EncryptionUtility(kek_path, kmf, 'des')
+      Traceback (most recent call last):
+      ...
+      ValueError: Unknown record format 'des'
+
+      >>> shutil.rmtree(storage_dir)
+    """  # noqa: E501 line too long
+
+
+def doctest_AESGCM():
+    r"""AES-GCM implementations
+
+    ``cryptography``'s AES-GCM, used when it's installed, and the one of
+    ``pycryptodome`` compute the same records:
+
+      >>> key = b'k' * 32
+      >>> native = encrypt_util.aesgcm(key)
+      >>> native
+      <cipher.encryptingstorage.encrypt_util.NativeAESGCM object at ...>
+      >>> fallback = encrypt_util.AESGCM(key)
+      >>> nonce = b'n' * 12
+      >>> for parts in [(b'',), (b'data',), (b'\0', b'x' * 100),
+      ...               (b'\0', memoryview(b'y' * 100000), b'z')]:
+      ...     sealed = native.seal(nonce, parts, b'aad', b'.e')
+      ...     assert sealed == fallback.seal(nonce, parts, b'aad', b'.e')
+      ...     assert sealed[:14] == b'.e' + nonce
+      ...     text = native.decrypt(nonce, sealed[14:], b'aad')
+      ...     assert text == b''.join(parts)
+      ...     assert fallback.decrypt(nonce, sealed[14:], b'aad') == text
+      >>> native.decrypt(nonce, sealed[14:], b'other')
+      Traceback (most recent call last):
+      ...
+      ValueError: MAC check failed
+    """
+
+
+def doctest_Keyring():
+    r"""Reading data of several keys
+
+      >>> storage_dir = tempfile.mkdtemp()
+      >>> kmf = facility.KeyManagementFacility(storage_dir)
+      >>> tenants = [
+      ...     encrypt_util.EncryptionUtility(
+      ...         os.path.join(storage_dir, 'key%d.kek' % i), kmf)
+      ...     for i in range(3)]
+      >>> data = [util.encryptBytes(b'tenant %d' % i)
+      ...         for i, util in enumerate(tenants)]
+
+    A utility reads the records of all keys in its keyring:
+
+      >>> util = encrypt_util.EncryptionUtility(
+      ...     os.path.join(storage_dir, 'key0.kek'), kmf,
+      ...     previous_keys=[tenants[2].key, tenants[1].key])
+      >>> len(util.keyring), util.previous == [tenants[2].key, tenants[1].key]
+      (3, True)
+      >>> [util.decryptBytes(d) for d in data]
+      [b'tenant 0', b'tenant 1', b'tenant 2']
+      >>> util.decryptMany(data)
+      [b'tenant 0', b'tenant 1', b'tenant 2']
+
+    The key is looked up by the ID in the record, other keys of the
+    keyring aren't tried and not even resolved:
+
+      >>> util.invalidate()
+      >>> lookups = []
+      >>> getEncryptionKey = kmf.getEncryptionKey
+      >>> kmf.getEncryptionKey = lambda key: (
+      ...     lookups.append(key) or getEncryptionKey(key))
+      >>> util.decryptBytes(data[2])
+      b'tenant 2'
+      >>> tenants[2].key in lookups, tenants[1].key in lookups
+      (True, False)
+
+    Records of keys that aren't in the keyring fail:
+
+      >>> util.keyring.remove(tenants[2].key)
+      >>> util.decryptBytes(data[2])
+      Traceback (most recent call last):
+      ...
+      cipher.encryptingstorage.encrypt_util.DecryptionError: Unknown key ID ...
+      >>> util.aead(encrypt_util.key_id(tenants[2].key))
+      Traceback (most recent call last):
+      ...
+      cipher.encryptingstorage.encrypt_util.DecryptionError: Unknown key ID ...
+
+      >>> keys = [kmf.generate() for i in range(2)]
+
+    Keys are added to the keyring, but can't share an ID with another key:
+
+      >>> util.keyring.add(tenants[2].key) == data[2][1:5]
+      True
+      >>> util.decryptBytes(data[2])
+      b'tenant 2'
+      >>> key_id = encrypt_util.key_id
+      >>> encrypt_util.key_id = lambda key: b'same'
+      >>> keyring = encrypt_util.Keyring(kmf, [keys[0]])
+      >>> keyring.add(keys[0])
+      b'same'
+      >>> keyring.add(keys[1])
+      Traceback (most recent call last):
+      ...
+      ValueError: Key ... has the same ID as a key in the keyring
+      >>> encrypt_util.key_id = key_id
+
+      >>> shutil.rmtree(storage_dir)
+    """  # noqa: E501 line too long
+
+
+def doctest_KeyCache():
+    r"""Caching remote key lookups
+
+    We use a local fake KMI server backed by a master facility:
+
+      >>> storage_dir = tempfile.mkdtemp()
+      >>> master = testing.TestingKeyManagementFacility(storage_dir)
+      >>> server = FakeKMIServer(master).start()
+
+      >>> kmf = encrypt_util.CachingKeyManagementFacility(server.url)
+      >>> kmf.getEncryptionKey(testing.KeyEncyptingKey) == (
+      ...     master.getEncryptionKey(testing.KeyEncyptingKey))
+      True
+      >>> server.requests
+      ['/key']
+
+    Steady-state reads don't touch the network:
+
+      >>> kek_path = os.path.join(storage_dir, 'key.kek')
+      >>> with open(kek_path, 'wb') as f:
+      ...     _ = f.write(testing.KeyEncyptingKey)
+      >>> util = encrypt_util.EncryptionUtility(kek_path, kmf)
+      >>> data = [util.encryptBytes(b'x' * i) for i in range(100)]
+      >>> util.invalidate()
+      >>> [len(util.decryptBytes(d)) for d in data][-1]
+      99
+      >>> len(server.requests), kmf.cache.hits, kmf.cache.misses
+      (1, 2, 1)
+
+    Unknown keys are cached as failures for `negative_ttl` seconds:
+
+      >>> kmf.getEncryptionKey(b'unknown')
+      Traceback (most recent call last):
+      ...
+      KeyError: '...'
+      >>> kmf.getEncryptionKey(b'unknown')
+      Traceback (most recent call last):
+      ...
+      KeyError: '...'
+      >>> len(server.requests)
+      2
+
+    The cache is bounded:
+
+      >>> kmf.cache.size = 1
+      >>> kmf.getEncryptionKey(b'other')
+      Traceback (most recent call last):
+      ...
+      KeyError: '...'
+      >>> len(kmf.cache)
+      1
+      >>> kmf.cache.size = 100
+
+    Expired keys are looked up again.  If the server is unavailable then,
+    the stale key is used instead of failing every load:
+
+      >>> _ = kmf.getEncryptionKey(testing.KeyEncyptingKey)
+      >>> kmf.cache.ttl = 0
+      >>> server.fail = True
+      >>> kmf.getEncryptionKey(testing.KeyEncyptingKey) == (
+      ...     master.getEncryptionKey(testing.KeyEncyptingKey))
+      True
+      >>> server.fail = False
+
+    Keys about to expire are refreshed in the background while the cached
+    key keeps being served:
+
+      >>> kmf.cache.ttl = 3600
+      >>> kmf.cache.refresh_ahead = 0
+      >>> _ = kmf.getEncryptionKey(testing.KeyEncyptingKey)
+      >>> while kmf.cache._refreshing:
+      ...     time.sleep(0.01)
+      >>> del server.requests[:]
+      >>> _ = kmf.getEncryptionKey(testing.KeyEncyptingKey)
+      >>> while kmf.cache._refreshing:
+      ...     time.sleep(0.01)
+      >>> server.requests
+      ['/key']
+
+      >>> server.stop()
+      >>> shutil.rmtree(storage_dir)
+    """
+
+
 def doctest_init_local_facility():
     r"""Initialize Local Facility
 
@@ -71,6 +460,14 @@ def doctest_init_local_facility():
       >>> encrypt_util.ENCRYPTION_UTILITY
       <cipher.encryptingstorage.encrypt_util.TrivialEncryptionUtility object at ...>
 
+    ``load_utility`` returns the utility without setting the global one:
+
+      >>> utility = encrypt_util.load_utility({'__file__': conf_path})
+      >>> utility
+      <cipher.encryptingstorage.encrypt_util.TrivialEncryptionUtility object at ...>
+      >>> utility is encrypt_util.ENCRYPTION_UTILITY
+      False
+
     Local Encryption:
 
       >>> storage_dir = tempfile.mkdtemp()
@@ -110,7 +507,40 @@ def doctest_init_local_facility():
       >>> encrypt_util.ENCRYPTION_UTILITY
       <cipher.encryptingstorage.encrypt_util.EncryptionUtility object at ...>
       >>> encrypt_util.ENCRYPTION_UTILITY.facility
-      <LocalKeyManagementFacility 'http://localhost:8001/'>
+      <CachingKeyManagementFacility 'http://localhost:8001/'>
+
+    The format of new records can be configured:
+
+      >>> with open(conf_path, 'a') as f:
+      ...     pos = f.write('record-format = cbc')
+      >>> encrypt_util.init_local_facility({'__file__': conf_path, 'here': '.'})
+      >>> encrypt_util.ENCRYPTION_UTILITY.record_format
+      'cbc'
+
+    Records of the legacy format are then read even if they start like
+    authenticated ones, unless configured otherwise:
+
+      >>> encrypt_util.ENCRYPTION_UTILITY.legacy_records
+      True
+      >>> with open(conf_path, 'a') as f:
+      ...     pos = f.write('\nlegacy-records = false')
+      >>> encrypt_util.init_local_facility({'__file__': conf_path, 'here': '.'})
+      >>> encrypt_util.ENCRYPTION_UTILITY.legacy_records
+      False
+
+    The key cache can be configured:
+
+      >>> with open(conf_path, 'a') as f:
+      ...     pos = f.write('''
+      ... key-cache-size = 10
+      ... key-cache-ttl = 600
+      ... key-cache-negative-ttl = 5
+      ... key-cache-refresh-ahead = 0.5
+      ... ''')
+      >>> encrypt_util.init_local_facility({'__file__': conf_path, 'here': '.'})
+      >>> cache = encrypt_util.ENCRYPTION_UTILITY.facility.cache
+      >>> cache.size, cache.ttl, cache.negative_ttl, cache.refresh_ahead
+      (10, 600.0, 5.0, 0.5)
 
       >>> shutil.rmtree(storage_dir)
       >>> os.remove(kek_path)
@@ -0,0 +1,167 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Instrumentation tests"""
+import unittest
+
+import transaction
+import ZODB.MappingStorage
+import ZODB.utils
+from keas.kmi import testing
+from zope.testing import setupstack
+
+import cipher.encryptingstorage
+from cipher.encryptingstorage import encrypt_util
+from cipher.encryptingstorage import metrics
+from cipher.encryptingstorage.testing import FakeKMIServer
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = metrics.Histogram()
+        self.assertEqual(histogram.percentile(99), 0)
+        for value in [0] + [1.5] * 97 + [3, 100]:
+            histogram.add(value)
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual((histogram.min, histogram.max), (0, 100))
+        self.assertAlmostEqual(histogram.mean, (1.5 * 97 + 103) / 100)
+        # Percentiles are the upper bound of the bucket they fall in.
+        self.assertEqual(histogram.percentile(0), 0)
+        self.assertEqual(histogram.percentile(50), 2)
+        self.assertEqual(histogram.percentile(99), 4)
+        self.assertEqual(histogram.percentile(100), 100)
+
+    def test_sink(self):
+        sink = metrics.InMemorySink()
+        sink('a', 1)
+        sink('a', 3)
+        sink('b', 2)
+        snapshot = sink.snapshot()
+        self.assertEqual(sorted(snapshot), ['a', 'b'])
+        self.assertEqual(snapshot['a']['count'], 2)
+        self.assertEqual(snapshot['a']['total'], 4)
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        self.sink = metrics.InMemorySink()
+        metrics.setSink(self.sink)
+
+    def tearDown(self):
+        metrics.setSink(None)
+
+    def _counts(self):
+        prefix = len(metrics.PREFIX)
+        return {name[prefix:]: histogram.count
+                for name, histogram in self.sink.histograms.items()}
+
+    def test_storage(self):
+        store = cipher.encryptingstorage.EncryptingStorage(
+            ZODB.MappingStorage.MappingStorage())
+        db = ZODB.DB(store)
+        conn = db.open()
+        conn.root.a = conn.root().__class__(a=b'x' * 1000)
+        transaction.commit()
+        oid = conn.root.a._p_oid
+        conn.close()
+        self.sink.histograms.clear()
+
+        data, serial = store.load(oid)
+        store.loadBefore(oid, ZODB.utils.maxtid)
+        store.loadSerial(oid, serial)
+        store.loadBeforeMany([oid], ZODB.utils.maxtid)
+        counts = self._counts()
+        self.assertEqual(counts['base_load.ms'], 3)
+        self.assertEqual(counts['decrypt.ms'], 4)
+        self.assertEqual(counts['decompress.bytes'], 4)
+        # The stored record is compressed.
+        self.assertLess(
+            self.sink.histograms[metrics.PREFIX + 'base_load.bytes'].max,
+            200)
+
+        self.sink.histograms.clear()
+        conn = db.open()
+        conn.root.a['b'] = 1
+        transaction.commit()
+        conn.close()
+        self.assertGreater(
+            self.sink.histograms[metrics.PREFIX + 'compress.bytes'].max,
+            1000)
+        counts = self._counts()
+        self.assertEqual(
+            sorted(counts),
+            ['base_store.bytes', 'base_store.ms', 'compress.bytes',
+             'compress.ms', 'encrypt.bytes', 'encrypt.ms'])
+        db.close()
+
+    def test_decrypt_many(self):
+        datas = [b'x' * 1000, b'y' * 3000]
+        encrypted = [cipher.encryptingstorage.encrypt(data) for data in datas]
+        self.sink.histograms.clear()
+        self.assertEqual(
+            cipher.encryptingstorage.decrypt_many(encrypted), datas)
+        histograms = self.sink.histograms
+        self.assertEqual(
+            histograms[metrics.PREFIX + 'decrypt.bytes'].total,
+            sum(len(data) - 2 for data in encrypted))
+        self.assertEqual(
+            histograms[metrics.PREFIX + 'decompress.bytes'].count, 1)
+        # The records are compressed.
+        self.assertLess(
+            histograms[metrics.PREFIX + 'decompress.bytes'].total, 1000)
+
+    def test_refs_index(self):
+        setupstack.setUpDirectory(self)
+        self.addCleanup(setupstack.tearDown, self)
+        store = cipher.encryptingstorage.EncryptingStorage(
+            ZODB.MappingStorage.MappingStorage(), refs_index='data.refs')
+        db = ZODB.DB(store)
+        self.sink.histograms.clear()
+        conn = db.open()
+        conn.root.a = conn.root().__class__(a=1)
+        transaction.commit()
+        conn.close()
+        counts = self._counts()
+        self.assertEqual(counts['base_store.ms'], 2)
+        self.assertEqual(counts['base_store.bytes'], 2)
+        db.close()
+
+    def test_off(self):
+        metrics.setSink(None)
+        store = cipher.encryptingstorage.EncryptingStorage(
+            ZODB.MappingStorage.MappingStorage())
+        db = ZODB.DB(store)
+        store.load(ZODB.utils.z64)
+        db.close()
+        self.assertEqual(self.sink.histograms, {})
+
+    def test_kmi_fetch(self):
+        setupstack.setUpDirectory(self)
+        self.addCleanup(setupstack.tearDown, self)
+        server = FakeKMIServer(
+            testing.TestingKeyManagementFacility('.')).start()
+        self.addCleanup(server.stop)
+        kmf = encrypt_util.CachingKeyManagementFacility(server.url)
+        kmf.getEncryptionKey(testing.KeyEncyptingKey)
+        kmf.getEncryptionKey(testing.KeyEncyptingKey)
+        self.assertEqual(self._counts(), {'kmi_fetch.ms': 1,
+                                          'kmi_fetch.bytes': 1})
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestHistogram),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestInstrumentation),
+    ))
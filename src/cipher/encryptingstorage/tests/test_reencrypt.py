@@ -0,0 +1,222 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Online re-encryption tests"""
+import unittest
+
+import mock
+import transaction
+import ZODB.blob
+import ZODB.FileStorage
+import ZODB.utils
+from keas.kmi import facility
+from persistent.mapping import PersistentMapping
+from zope.testing import setupstack
+
+import cipher.encryptingstorage
+from cipher.encryptingstorage import testing
+from cipher.encryptingstorage.reencrypt import Checkpoint
+from cipher.encryptingstorage.reencrypt import Reencryption
+from cipher.encryptingstorage.reencrypt import Throttle
+
+
+class TestThrottle(unittest.TestCase):
+
+    def test_rate(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        throttle = Throttle(100, clock=lambda: now[0], sleep=sleep)
+        throttle(50)
+        throttle(50)
+        self.assertEqual(sleeps, [0.5, 0.5])
+        # Idle time isn't saved up.
+        now[0] += 10
+        throttle(200)
+        self.assertEqual(sleeps, [0.5, 0.5, 2.0])
+
+
+class TestReencryption(unittest.TestCase):
+
+    def setUp(self):
+        setupstack.setUpDirectory(self)
+        self.utility = testing.encryption_utility()
+
+    def tearDown(self):
+        setupstack.tearDown(self)
+
+    def _open(self):
+        return ZODB.DB(cipher.encryptingstorage.EncryptingStorage(
+            ZODB.FileStorage.FileStorage('data.fs', blob_dir='blobs'),
+            utility=self.utility))
+
+    def _populate(self, db):
+        conn = db.open()
+        for i in range(25):
+            conn.root()[i] = PersistentMapping(value=i)
+        conn.root.blob = ZODB.blob.Blob(b'blob data' * 1000)
+        transaction.commit()
+        conn.close()
+
+    def _rotate(self):
+        self.utility.rotate(
+            facility.KeyManagementFacility.generate(self.utility.facility))
+
+    def _check_current_key(self, db):
+        # Every current record decrypts with the current key alone.
+        context = self.utility.context()
+        storage = db.storage.base
+        next = None
+        while True:
+            oid, tid, data, next = storage.record_iternext(next)
+            context.unseal(memoryview(data)[2:])
+            if next is None:
+                break
+
+    def test_rotation(self):
+        db = self._open()
+        self._populate(db)
+        conn = db.open()
+        self.assertEqual(conn.root()[3]['value'], 3)
+        self._rotate()
+
+        job = Reencryption(db.storage, 'job.json', batch_size=10)
+        self.assertFalse(job.run(batches=1))
+        self.assertEqual(job.stats['records'], 10)
+        # Continue from the checkpoint.
+        job = Reencryption(db.storage, 'job.json', batch_size=10)
+        self.assertTrue(job.run())
+        self.assertEqual(job.stats['records'], len(db.storage))
+        self.assertEqual(job.stats['blobs'], 1)
+        self.assertEqual(job.stats['transactions'], 3)
+        self.assertEqual(job.stats['skipped'], 0)
+        self.assertTrue(Reencryption(db.storage, 'job.json').run())
+        self._check_current_key(db)
+
+        # The open connection got the new serials and can still commit.
+        transaction.begin()
+        conn.root()[3]['value'] = 'three'
+        transaction.commit()
+        conn.close()
+        db.close()
+
+        # Everything reads without the old key.
+        for key in self.utility.previous:
+            self.utility.keyring.remove(key)
+        db = self._open()
+        conn = db.open()
+        self.assertEqual(
+            [conn.root()[i]['value'] for i in range(5)], [0, 1, 2, 'three', 4])
+        with conn.root.blob.open() as f:
+            self.assertEqual(f.read(), b'blob data' * 1000)
+        conn.close()
+        db.close()
+
+    def test_current_key(self):
+        db = self._open()
+        self._populate(db)
+        # Records written with the current key aren't rewritten.
+        job = Reencryption(db.storage, batch_size=10)
+        self.assertTrue(job.run())
+        self.assertEqual(job.stats['skipped'], len(db.storage))
+        self.assertEqual(job.stats['records'], 0)
+        self.assertEqual(job.stats['transactions'], 0)
+
+        self._rotate()
+        conn = db.open()
+        conn.root()[3]['value'] = 'three'
+        transaction.commit()
+        conn.close()
+        job = Reencryption(db.storage, batch_size=10)
+        self.assertTrue(job.run())
+        self.assertEqual(job.stats['skipped'], 1)
+        self.assertEqual(job.stats['records'], len(db.storage) - 1)
+        self.assertEqual(job.stats['blobs'], 1)
+        self._check_current_key(db)
+
+        # A blob file not written with the current key is rewritten, with
+        # its record.
+        conn = db.open()
+        oid = conn.root.blob._p_oid
+        conn.close()
+        tid = ZODB.utils.load_current(db.storage.base, oid)[1]
+        job = Reencryption(db.storage)
+        self.assertTrue(job._blob_sealed_with(self.utility.keyId(), oid, tid))
+        self.assertFalse(job._blob_sealed_with(b'\0' * 4, oid, tid))
+        with mock.patch.object(
+                Reencryption, '_blob_sealed_with', return_value=False):
+            self.assertTrue(job.run())
+        self.assertEqual(job.stats['skipped'], len(db.storage) - 1)
+        self.assertEqual(job.stats['blobs'], 1)
+        db.close()
+
+    def test_concurrent_change(self):
+        db = self._open()
+        self._populate(db)
+        self._rotate()
+        job = Reencryption(db.storage)
+        oid = db.open().root()[3]._p_oid
+        records = [(oid, ZODB.utils.load_current(db.storage.base, oid)[1],
+                    cipher.encryptingstorage.decrypt(
+                        db.storage.base.load(oid)[0], self.utility))]
+        conn = db.open()
+        conn.root()[3]['value'] = 'changed'
+        transaction.commit()
+        # The changed object is skipped, it was written with the new key.
+        self.assertEqual(job._commit(records), 0)
+        self.assertEqual(job.stats['conflicts'], 1)
+        self.assertEqual(job.stats['records'], 0)
+        conn.close()
+        db.close()
+
+    def test_legacy_records(self):
+        self.utility.record_format = 'cbc'
+        db = self._open()
+        self._populate(db)
+        self.utility.record_format = 'gcm'
+        # Legacy records are re-encrypted in the authenticated format
+        # before rotating the key.
+        self.assertTrue(Reencryption(db.storage).run())
+        self._rotate()
+        self.assertTrue(Reencryption(db.storage).run())
+        self._check_current_key(db)
+        db.close()
+
+    def test_legacy_records_after_rotation(self):
+        self.utility.record_format = 'cbc'
+        db = self._open()
+        self._populate(db)
+        self._rotate()
+        self.assertRaises(ValueError, Reencryption(db.storage).run)
+        db.close()
+
+    def test_checkpoint(self):
+        checkpoint = Checkpoint('job.json')
+        checkpoint.next = b'\0' * 7 + b'\1'
+        checkpoint.stats['records'] = 5
+        checkpoint.save()
+        checkpoint = Checkpoint('job.json')
+        self.assertEqual(checkpoint.next, b'\0' * 7 + b'\1')
+        self.assertFalse(checkpoint.done)
+        self.assertEqual(checkpoint.stats['records'], 5)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestThrottle),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestReencryption),
+    ))
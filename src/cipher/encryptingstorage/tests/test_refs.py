@@ -0,0 +1,198 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Reference index tests"""
+import os
+import time
+import unittest
+
+import mock
+import transaction
+import ZODB.FileStorage
+import ZODB.utils
+from keas.kmi import facility
+from persistent.mapping import PersistentMapping
+from ZODB.serialize import referencesf
+from zope.testing import setupstack
+
+import cipher.encryptingstorage
+from cipher.encryptingstorage import refs
+from cipher.encryptingstorage import testing
+
+
+class TestRefsIndex(unittest.TestCase):
+
+    def setUp(self):
+        setupstack.setUpDirectory(self)
+        self.utility = testing.encryption_utility()
+
+    def tearDown(self):
+        setupstack.tearDown(self)
+
+    def _open(self, name='data', **kw):
+        return cipher.encryptingstorage.EncryptingStorage(
+            ZODB.FileStorage.FileStorage(name + '.fs'), utility=self.utility,
+            **kw)
+
+    def _load(self):
+        return refs.RefsIndex('data.refs', self.utility).load()
+
+    def _decrypt(self, data):
+        return cipher.encryptingstorage.decrypt(data, self.utility)
+
+    def _populate(self, storage):
+        db = ZODB.DB(storage)
+        conn = db.open()
+        for i in range(10):
+            conn.root()[i] = PersistentMapping(
+                child=PersistentMapping(value=i))
+            transaction.commit()
+        for i in range(5):
+            del conn.root()[i]
+            transaction.commit()
+        # An aborted transaction isn't indexed.
+        conn.root()['aborted'] = PersistentMapping()
+        transaction.abort()
+        conn.close()
+        db.close()
+
+    def _current(self, name):
+        storage = self._open(name)
+        result = {}
+        next = None
+        while True:
+            oid, tid, data, next = storage.record_iternext(next)
+            result[oid] = data
+            if next is None:
+                break
+        storage.close()
+        return result
+
+    def _pack(self, storage):
+        storage.pack(time.time() + 1, referencesf)
+        storage.close()
+
+    def test_index(self):
+        storage = self._open(refs_index='data.refs')
+        self._populate(storage)
+        index = self._load()
+        storage = self._open()
+        records = 0
+        for trans in storage.base.iterator():
+            for record in trans:
+                records += 1
+                self.assertEqual(
+                    refs.split_oids(index[refs.record_key(record.data)]),
+                    referencesf(self._decrypt(record.data)))
+        storage.close()
+        self.assertEqual(len(index), records)
+        # The index doesn't contain the oids in the clear.
+        with open('data.refs', 'rb') as f:
+            self.assertNotIn(ZODB.utils.p64(3), f.read())
+
+    def _check_pack(self, **kw):
+        # Pack like the serial pack without options, return the mock of
+        # the serial decryption.
+        self._populate(self._open('serial'))
+        self._pack(self._open('serial'))
+        expected = self._current('serial')
+        self.assertEqual(len(expected), 11)
+
+        self._populate(self._open(**kw))
+        storage = self._open(**kw)
+        with mock.patch.object(
+                storage, '_untransform',
+                side_effect=self._decrypt) as untransform:
+            self._pack(storage)
+        self.assertEqual(self._current('data'), expected)
+        return untransform
+
+    def test_pack(self):
+        untransform = self._check_pack(refs_index='data.refs')
+        # The references were all read from the index.
+        self.assertFalse(untransform.called)
+
+    def test_pack_decrypt_workers(self):
+        untransform = self._check_pack(decrypt_workers=2)
+        self.assertFalse(untransform.called)
+
+    def test_pack_workers(self):
+        untransform = self._check_pack(pack_workers=2)
+        self.assertFalse(untransform.called)
+
+    def test_pack_without_gc(self):
+        # The references aren't decrypted up front when pack doesn't
+        # collect garbage.
+        self._populate(self._open(pack_workers=2))
+        for kw in (dict(gc=False), dict()):
+            storage = self._open(pack_workers=2)
+            storage.base._pack_gc = 'gc' in kw
+            with mock.patch.object(
+                    storage, '_known_references') as known:
+                storage.pack(time.time() + 1, referencesf, **kw)
+            storage.close()
+            self.assertFalse(known.called)
+        # Nothing was collected.
+        self.assertEqual(len(self._current('data')), 21)
+
+    def test_pack_memory(self):
+        with mock.patch.object(cipher.encryptingstorage, '_BATCH_SIZE', 4):
+            untransform = self._check_pack(pack_workers=1, pack_memory=1000)
+        # The records beyond the limit were decrypted while packing.
+        self.assertTrue(untransform.called)
+
+    def test_unreadable_entries(self):
+        storage = self._open(refs_index='data.refs')
+        self._populate(storage)
+        size = os.path.getsize('data.refs')
+        self.assertEqual(len(self._load()), 36)
+        # Entries written with another key are skipped.
+        self.utility.rotate(
+            facility.KeyManagementFacility.generate(self.utility.facility))
+        db = ZODB.DB(self._open(refs_index='data.refs'))
+        conn = db.open()
+        conn.root()['new'] = PersistentMapping()
+        transaction.commit()
+        conn.close()
+        db.close()
+        for key in self.utility.previous:
+            self.utility.keyring.remove(key)
+        with mock.patch.object(refs.logger, 'warning') as warning:
+            self.assertEqual(len(self._load()), 2)
+        self.assertEqual(warning.call_count, 16)
+        # A truncated entry is the end of the index.
+        with open('data.refs', 'r+b') as f:
+            f.truncate(size + 10)
+        with mock.patch.object(refs.logger, 'warning') as warning:
+            self.assertEqual(len(self._load()), 0)
+        self.assertIn('Truncated', warning.call_args_list[-1][0][0])
+
+    def test_unwritable(self):
+        # The transactions are committed anyway, and packing decrypts
+        # their records.
+        with mock.patch.object(
+                cipher.encryptingstorage.logger, 'exception') as exception:
+            untransform = self._check_pack(refs_index='missing/data.refs')
+        self.assertEqual(exception.call_count, 16)
+        self.assertTrue(untransform.called)
+
+    def test_unencrypted(self):
+        storage = self._open(refs_index='data.refs', encrypt=False)
+        self._populate(storage)
+        self.assertFalse(os.path.exists('data.refs'))
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestRefsIndex),
+    ))
@@ -0,0 +1,86 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Worker pool tests"""
+import os
+import threading
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+
+import mock
+
+from cipher.encryptingstorage import workers
+
+
+_state = threading.local()
+
+
+def _init(value):
+    _state.value = value
+
+
+def _task(n):
+    return _state.value, n * n, os.getpid()
+
+
+class TestWorkers(unittest.TestCase):
+
+    def test_processes(self):
+        with workers.executor(2, _init, ('a',)) as executor:
+            self.assertIsInstance(executor, ProcessPoolExecutor)
+            results = list(workers.imap(
+                executor, _task, (((n,), n) for n in range(20)), 2))
+        self.assertEqual([(n, r[:2]) for n, r in results],
+                         [(n, ('a', n * n)) for n in range(20)])
+        self.assertNotIn(os.getpid(), [r[2] for n, r in results])
+
+    def test_threads(self):
+        # Without fork, the initializer runs in every thread.
+        with mock.patch('multiprocessing.get_all_start_methods',
+                        return_value=['spawn']):
+            executor = workers.executor(2, _init, ('b',))
+        with executor:
+            self.assertIsInstance(executor, ThreadPoolExecutor)
+            results = list(workers.imap(
+                executor, _task, (((n,), n) for n in range(20)), 2))
+        self.assertEqual([(n, r[:2]) for n, r in results],
+                         [(n, ('b', n * n)) for n in range(20)])
+        self.assertFalse(hasattr(_state, 'value'))
+
+    def test_bounded(self):
+        submitted = []
+        closed = []
+
+        def tasks():
+            try:
+                for n in range(100):
+                    submitted.append(n)
+                    yield (n,), n
+            finally:
+                closed.append(True)
+
+        with ThreadPoolExecutor(2, initializer=_init,
+                                initargs=('c',)) as executor:
+            results = workers.imap(executor, _task, tasks(), 2)
+            self.assertEqual(next(results)[0], 0)
+            self.assertEqual(len(submitted), 2 * workers.TASKS_AHEAD + 1)
+            results.close()
+        self.assertEqual(closed, [True])
+        self.assertEqual(len(submitted), 2 * workers.TASKS_AHEAD + 1)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestWorkers),
+    ))
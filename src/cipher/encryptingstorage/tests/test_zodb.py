@@ -19,8 +19,10 @@ import unittest
 from binascii import hexlify
 from binascii import unhexlify
 
+import mock
 import transaction
 import ZEO.tests.testZEO
+import ZODB.blob
 import ZODB.config
 import ZODB.FileStorage
 import ZODB.interfaces
@@ -30,9 +32,14 @@ import ZODB.tests.testFileStorage
 import ZODB.tests.util
 import ZODB.utils
 import zope.interface.verify
+from keas.kmi import facility
+from ZODB.POSException import POSKeyError
 from zope.testing import setupstack
 
 import cipher.encryptingstorage
+from cipher.encryptingstorage import encrypt_util
+from cipher.encryptingstorage import testing
+from cipher.encryptingstorage.cache import RecordCache
 
 
 class TestIterator(unittest.TestCase):
@@ -246,10 +253,10 @@ Create a sample config:
     ... enabled = false
     ... ''')
 
-Ditch the default utility:
+Keep the default utility around:
 
     >>> from cipher.encryptingstorage import encrypt_util
-    >>> encrypt_util.ENCRYPTION_UTILITY = None
+    >>> old_utility = encrypt_util.ENCRYPTION_UTILITY
 
 Use the config tag to pass the filename:
 
@@ -270,10 +277,15 @@ Use the config tag to pass the filename:
 
     >>> db = ZODB.config.databaseFromString(config)
 
-It's enough for now that the utility gets replaced:
+The storage gets its own utility, the global one stays as it was:
 
-    >>> encrypt_util.ENCRYPTION_UTILITY # doctest: +ELLIPSIS
+    >>> db.storage.utility # doctest: +ELLIPSIS
     <cipher.encryptingstorage.encrypt_util.TrivialEncryptionUtility object at ...>
+    >>> db.storage.utility is old_utility
+    False
+    >>> encrypt_util.ENCRYPTION_UTILITY is old_utility
+    True
+    >>> db.close()
 
     """  # noqa: E501 line too long
 
@@ -401,8 +413,270 @@ class TestServerEncryptingStorage(unittest.TestCase):
         server_root_data, _ = server_store.load(ZODB.utils.z64)
         self.assertEqual(server_root_data[:2], b'.e')
 
+        # Nor does loadBeforeMany.
+        tid = ZODB.utils.p64(ZODB.utils.u64(store.lastTransaction()) + 1)
+        self.assertEqual(
+            server_store.loadBeforeMany([ZODB.utils.z64], tid),
+            {ZODB.utils.z64: server_store.loadBefore(ZODB.utils.z64, tid)})
+        self.assertEqual(
+            server_store.loadBefore(ZODB.utils.z64, tid)[0], server_root_data)
+
+        db.close()
+
+
+class TestLoadBeforeMany(unittest.TestCase):
+
+    def test_loadBeforeMany(self):
+        store = cipher.encryptingstorage.EncryptingStorage(
+            ZODB.MappingStorage.MappingStorage())
+        db = ZODB.DB(store)
+        conn = db.open()
+        for i in range(10):
+            conn.root()[i] = conn.root().__class__(a=b'x' * (i * 10))
+        transaction.commit()
+        oids = [conn.root()[i]._p_oid for i in range(10)]
+        oids.append(ZODB.utils.z64)
+        tid = ZODB.utils.p64(ZODB.utils.u64(store.lastTransaction()) + 1)
+
+        result = store.loadBeforeMany(iter(oids), tid)
+        self.assertEqual(sorted(result), sorted(oids))
+        for oid in oids:
+            self.assertEqual(result[oid], store.loadBefore(oid, tid))
+        self.assertEqual(
+            store.loadBeforeMany(oids, store.lastTransaction())[oids[0]],
+            None)
+        self.assertEqual(store.loadBeforeMany([], tid), {})
+        conn.close()
+        db.close()
+
+    def test_prefetch(self):
+        store = cipher.encryptingstorage.EncryptingStorage(
+            ZODB.MappingStorage.MappingStorage())
+        # The base storage can't prefetch; that's ok.
+        store.prefetch([ZODB.utils.z64], ZODB.utils.maxtid)
+
+        prefetched = []
+        store.base.prefetch = lambda oids, tid: prefetched.append(
+            (list(oids), tid))
+        # Missing objects raise like loadBefore does.
+        self.assertRaises(
+            POSKeyError,
+            store.loadBeforeMany, [ZODB.utils.z64], ZODB.utils.maxtid)
+        self.assertEqual(prefetched, [([ZODB.utils.z64], ZODB.utils.maxtid)])
+
+
+class TestRecordCache(unittest.TestCase):
+
+    def test_cache(self):
+        cache = RecordCache(100)
+        cache.set(b'a', b'1', b'x' * 40)
+        cache.set(b'a', b'2', b'y' * 40)
+        cache.set(b'b', b'1', b'z' * 40)
+        # The least recently used record was evicted.
+        self.assertIsNone(cache.get(b'a', b'1'))
+        self.assertEqual(cache.get(b'a', b'2'), b'y' * 40)
+        self.assertEqual(cache.bytes, 80)
+        self.assertEqual(
+            cache.stats, dict(hits=1, misses=1, evictions=1))
+
+        # Records bigger than the cache aren't cached.
+        cache.set(b'c', b'1', b'x' * 101)
+        self.assertEqual(len(cache), 2)
+
+        cache.invalidate([b'a', b'd'])
+        self.assertIsNone(cache.get(b'a', b'2'))
+        self.assertEqual(cache.get(b'b', b'1'), b'z' * 40)
+        self.assertEqual(cache.bytes, 40)
+        cache.clear()
+        self.assertEqual((len(cache), cache.bytes), (0, 0))
+
+    def test_storage(self):
+        store = cipher.encryptingstorage.EncryptingStorage(
+            ZODB.MappingStorage.MappingStorage(), record_cache_size=1 << 20)
+        db = ZODB.DB(store)
+        conn = db.open()
+        conn.root.a = conn.root().__class__(a=b'x' * 100)
+        transaction.commit()
+        oid = conn.root.a._p_oid
+        conn.close()
+
+        decrypted = []
+        decrypt = store._untransform
+        store._untransform = lambda data: decrypted.append(data) or decrypt(
+            data)
+        data, serial = store.load(oid)
+        self.assertEqual(store.load(oid), (data, serial))
+        self.assertEqual(store.loadSerial(oid, serial), data)
+        self.assertEqual(
+            store.loadBefore(oid, ZODB.utils.maxtid), (data, serial, None))
+        self.assertEqual(
+            store.loadBeforeMany([oid], ZODB.utils.maxtid),
+            {oid: (data, serial, None)})
+        self.assertEqual(len(decrypted), 1)
+
+        store.invalidate(serial, [oid])
+        store.load(oid)
+        self.assertEqual(len(decrypted), 2)
+        store.invalidateCache()
+        self.assertEqual(len(store.record_cache), 0)
         db.close()
 
+    def test_config(self):
+        store = ZODB.config.storageFromString("""
+            %import cipher.encryptingstorage
+            <encryptingstorage>
+                record-cache-size 10MB
+                <mappingstorage>
+                </mappingstorage>
+            </encryptingstorage>
+            """)
+        self.assertEqual(store.record_cache.size, 10 << 20)
+        store.close()
+        store = cipher.encryptingstorage.EncryptingStorage(
+            ZODB.MappingStorage.MappingStorage())
+        self.assertIsNone(store.record_cache)
+
+
+class TestParallelDecryption(unittest.TestCase):
+
+    def setUp(self):
+        setupstack.setUpDirectory(self)
+        store = cipher.encryptingstorage.EncryptingStorage(
+            ZODB.FileStorage.FileStorage('data.fs'))
+        db = ZODB.DB(store)
+        conn = db.open()
+        for i in range(20):
+            conn.root()[i] = conn.root().__class__(
+                (j, b'x' * j) for j in range(i * 10))
+            transaction.commit()
+        self.oids = [conn.root()[i]._p_oid for i in range(20)]
+        conn.close()
+        db.close()
+
+    def tearDown(self):
+        setupstack.tearDown(self)
+
+    def _records(self, store):
+        it = store.iterator()
+        try:
+            return [(t.tid, r.oid, r.data) for t in it for r in t]
+        finally:
+            it.close()
+
+    def test_iterator(self):
+        store = cipher.encryptingstorage.EncryptingStorage(
+            ZODB.FileStorage.FileStorage('data.fs'))
+        expected = self._records(store)
+        store.close()
+        self.assertTrue(all(data[:2] != b'.e' for _, _, data in expected))
+
+        store = cipher.encryptingstorage.EncryptingStorage(
+            ZODB.FileStorage.FileStorage('data.fs'), decrypt_workers=3)
+        self.assertEqual(self._records(store), expected)
+
+        # Closing an iterator with transactions in flight is fine.
+        it = store.iterator()
+        next(it)
+        it.close()
+        self.assertRaises(StopIteration, next, it)
+        store.close()
+
+    def test_loadBeforeMany(self):
+        store = cipher.encryptingstorage.EncryptingStorage(
+            ZODB.FileStorage.FileStorage('data.fs'), decrypt_workers=2)
+        result = store.loadBeforeMany(self.oids, ZODB.utils.maxtid)
+        for oid in self.oids:
+            self.assertEqual(
+                result[oid], store.loadBefore(oid, ZODB.utils.maxtid))
+        store.close()
+
+    def test_config(self):
+        store = ZODB.config.storageFromString("""
+            %import cipher.encryptingstorage
+            <encryptingstorage>
+                decrypt-workers 4
+                <filestorage>
+                    path data.fs
+                </filestorage>
+            </encryptingstorage>
+            """)
+        self.assertEqual(store._executor._max_workers, 4)
+        store.close()
+
+
+class TestRawCopy(unittest.TestCase):
+
+    def setUp(self):
+        setupstack.setUpDirectory(self)
+        self.utility = testing.encryption_utility()
+        db = ZODB.DB(self._open('source'))
+        conn = db.open()
+        for i in range(10):
+            conn.root()[i] = conn.root().__class__(value=i)
+            transaction.commit()
+        conn.root.blob = ZODB.blob.Blob(b'blob data' * 1000)
+        transaction.commit()
+        self.blob_oid = conn.root.blob._p_oid
+        conn.close()
+        db.close()
+
+    def tearDown(self):
+        setupstack.tearDown(self)
+
+    def _open(self, name):
+        return cipher.encryptingstorage.EncryptingStorage(
+            ZODB.FileStorage.FileStorage(
+                name + '.fs', blob_dir=name + '-blobs'),
+            utility=self.utility)
+
+    def _stored(self, store):
+        it = store.iterator(raw=True)
+        try:
+            return [(t.tid, r.oid, r.data) for t in it for r in t]
+        finally:
+            it.close()
+
+    def test_iterator(self):
+        store = self._open('source')
+        stored = self._stored(store)
+        self.assertTrue(all(data[:2] == b'.e' for _, _, data in stored))
+        self.assertEqual(
+            [(tid, oid, cipher.encryptingstorage.decrypt(
+                data, self.utility))
+             for tid, oid, data in stored],
+            [(t.tid, r.oid, r.data) for t in store.iterator() for r in t])
+        store.close()
+
+    def test_copy(self):
+        source = self._open('source')
+        copy = self._open('copy')
+        with mock.patch.object(self.utility, 'decryptBuffer') as decrypt:
+            with mock.patch.object(
+                    cipher.encryptingstorage, 'encrypt_file') as encrypt_file:
+                copy.copyTransactionsFrom(source, raw=True)
+        self.assertFalse(decrypt.called)
+        self.assertFalse(encrypt_file.called)
+        self.assertEqual(self._stored(copy), self._stored(source))
+        oid, serial = self.blob_oid, source.lastTransaction()
+        with open(source.loadBlobRaw(oid, serial), 'rb') as f:
+            with open(copy.loadBlobRaw(oid, serial), 'rb') as g:
+                self.assertEqual(f.read(), g.read())
+        source.close()
+
+        db = ZODB.DB(copy)
+        conn = db.open()
+        self.assertEqual(conn.root()[9]['value'], 9)
+        with conn.root.blob.open() as f:
+            self.assertEqual(f.read(), b'blob data' * 1000)
+        db.close()
+
+    def test_copy_unencrypted(self):
+        copy = self._open('copy')
+        source = ZODB.MappingStorage.MappingStorage()
+        self.assertRaises(
+            ValueError, copy.copyTransactionsFrom, source, raw=True)
+        copy.close()
+
 
 def test_wrapping():
     r"""
@@ -465,6 +739,158 @@ def record_iter(store):
             break
 
 
+class OriginalUtility:
+    """Encryption utility with only the original methods of the interface"""
+
+    def __init__(self):
+        self.facility = facility.KeyManagementFacility('main-keys')
+        with open('main.kek', 'rb') as f:
+            self.key = f.read()
+
+    def encryptBytes(self, data):
+        return self.facility.encrypt(self.key, data)
+
+    def decryptBytes(self, data):
+        return self.facility.decrypt(self.key, data)
+
+    def encrypt_file(self, fsrc, fdst):
+        fdst.write(self.encryptBytes(fsrc.read()))
+
+    def decrypt_file(self, fsrc, fdst):
+        fdst.write(self.decryptBytes(fsrc.read()))
+
+
+class TestStorageUtilities(unittest.TestCase):
+
+    def setUp(self):
+        setupstack.setUpDirectory(self)
+        for name in 'main', 'catalog':
+            os.mkdir(name + '-keys')
+            kmf = facility.KeyManagementFacility(name + '-keys')
+            with open(name + '.kek', 'wb') as f:
+                f.write(kmf.generate())
+            with open(name + '.conf', 'w') as f:
+                f.write(
+                    '[encryptingstorage:encryption]\n'
+                    'enabled = true\n'
+                    'kek-path = %s.kek\n'
+                    'dek-storage-path = %s-keys\n' % (name, name))
+        self.old_utility = encrypt_util.ENCRYPTION_UTILITY
+
+    def tearDown(self):
+        encrypt_util.ENCRYPTION_UTILITY = self.old_utility
+        setupstack.tearDown(self)
+
+    def _open(self, name):
+        return ZODB.config.databaseFromString("""
+            %%import cipher.encryptingstorage
+            <zodb>
+              <encryptingstorage>
+                config %s.conf
+                <filestorage>
+                  path %s.fs
+                  blob-dir %s-blobs
+                </filestorage>
+              </encryptingstorage>
+            </zodb>
+            """ % (name, name, name))
+
+    def test_separate_keys(self):
+        main = self._open('main')
+        catalog = self._open('catalog')
+        self.assertIs(encrypt_util.ENCRYPTION_UTILITY, self.old_utility)
+        self.assertIsNot(main.storage.utility, catalog.storage.utility)
+        for db in main, catalog:
+            conn = db.open()
+            conn.root.name = db.storage.getName()
+            conn.root.blob = ZODB.blob.Blob(b'blob data' * 1000)
+            transaction.commit()
+            conn.close()
+        # Records are encrypted with the key of their storage.
+        data = main.storage.base.load(b'\0' * 8)[0]
+        self.assertEqual(
+            main.storage.utility.keyId(),
+            bytes(data[3:3 + encrypt_util.KEY_ID_SIZE]))
+        self.assertRaises(
+            encrypt_util.DecryptionError, cipher.encryptingstorage.decrypt,
+            data, catalog.storage.utility)
+        main.close()
+        catalog.close()
+
+        for name in 'main', 'catalog':
+            db = self._open(name)
+            conn = db.open()
+            self.assertEqual(conn.root.name, '%s.fs' % name)
+            with conn.root.blob.open() as f:
+                self.assertEqual(f.read(), b'blob data' * 1000)
+            conn.close()
+            db.close()
+
+    def test_global_utility_set_later(self):
+        # Storages without a utility of their own use the global utility
+        # current when they store and load records.
+        storage = cipher.encryptingstorage.EncryptingStorage(
+            ZODB.MappingStorage.MappingStorage())
+        encrypt_util.init_local_facility({'__file__': 'main.conf',
+                                          'here': '.'})
+        db = ZODB.DB(storage)
+        conn = db.open()
+        conn.root.name = 'main'
+        transaction.commit()
+        conn.close()
+        data = storage.base.load(b'\0' * 8)[0]
+        self.assertEqual(
+            encrypt_util.ENCRYPTION_UTILITY.keyId(),
+            bytes(data[3:3 + encrypt_util.KEY_ID_SIZE]))
+        self.assertNotIn(b'main', data)
+        conn = db.open()
+        self.assertEqual(conn.root.name, 'main')
+        conn.close()
+        db.close()
+
+    def test_original_interface(self):
+        # Utilities implementing only the original methods of
+        # IEncryptionUtility write the legacy formats.
+        self._check_original_interface(utility=OriginalUtility())
+
+    def test_original_interface_global(self):
+        # So does the global utility.
+        with mock.patch.object(
+                encrypt_util, 'ENCRYPTION_UTILITY', OriginalUtility()):
+            self._check_original_interface()
+
+    def _check_original_interface(self, **kw):
+        db = ZODB.DB(cipher.encryptingstorage.EncryptingStorage(
+            ZODB.FileStorage.FileStorage('main.fs', blob_dir='main-blobs'),
+            refs_index='main.refs', **kw))
+        conn = db.open()
+        conn.root.name = 'main'
+        conn.root.blob = ZODB.blob.Blob(b'blob data' * 1000)
+        transaction.commit()
+        blob = conn.root.blob._p_oid, db.storage.lastTransaction()
+        conn.close()
+        data = db.storage.base.load(b'\0' * 8)[0]
+        self.assertNotIn(b'main', data)
+        # The record is in the legacy format.
+        self.assertEqual(
+            bytes(cipher.encryptingstorage.decompress(
+                OriginalUtility().decryptBytes(data[2:]))),
+            db.storage.load(b'\0' * 8)[0])
+        with open(db.storage.loadBlobRaw(*blob), 'rb') as f:
+            self.assertEqual(f.read(2), b'.e')
+        self.assertEqual(
+            cipher.encryptingstorage.decrypt_many(
+                [data], db.storage.utility)[0],
+            db.storage.load(b'\0' * 8)[0])
+        conn = db.open()
+        self.assertEqual(conn.root.name, 'main')
+        with conn.root.blob.open() as f:
+            self.assertEqual(f.read(), b'blob data' * 1000)
+        conn.close()
+        db.close()
+        self.assertFalse(os.path.exists('main.refs'))
+
+
 class FileStorageZlibTests(ZODB.tests.testFileStorage.FileStorageTests):
 
     def open(self, **kwargs):
@@ -564,6 +990,16 @@ def test_suite():
         TestIterator))
     suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(
         TestServerEncryptingStorage))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestLoadBeforeMany))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestRecordCache))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestParallelDecryption))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestRawCopy))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestStorageUtilities))
     suite.addTest(doctest.DocTestSuite(
         setUp=setupstack.setUpDirectory, tearDown=ZODB.tests.util.tearDown
     ))
@@ -0,0 +1,117 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Worker processes decrypting batches of records
+
+Packing with ``pack-workers`` and ``encryptingstorage-convert`` decrypt
+records in forked processes.  The encryption utilities and transforms
+they need can't be pickled, so the workers are forked with them, and
+where processes can't be forked, threads are used instead.
+
+Forking copies only the thread that forks.  A lock another thread of the
+process held at that moment (of ``logging``, a metrics sink or a key
+cache, say) stays locked in the workers forever, and using it there
+deadlocks; Python 3.12 warns when forking a process running threads.
+The workers only use the state they were set up with, and the storage's
+``decrypt-workers`` and ``async-workers`` pools only start threads when
+they are first used, but applications starting threads of their own
+(a ZEO client, for one) had better pack from a separate process.
+"""
+import asyncio
+import collections
+import multiprocessing
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Number of tasks in flight per worker.
+TASKS_AHEAD = 4
+
+
+def executor(workers, initializer, initargs=()):
+    """Return an executor running tasks in `workers` worker processes.
+
+    ``initializer(*initargs)`` is called in every worker first; it should
+    keep the state the tasks need in a ``threading.local``.  Where
+    processes can't be forked, threads are used, and the initializer is
+    called in each of them.
+    """
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(
+            workers, multiprocessing.get_context('fork'), initializer,
+            initargs)
+    return ThreadPoolExecutor(
+        workers, initializer=initializer, initargs=initargs)
+
+
+def imap(executor, func, tasks, workers):
+    """Run ``func(*args)`` in `executor` for the ``(args, context)`` pairs
+    of `tasks`, yield ``(context, result)`` pairs in the order of `tasks`.
+
+    At most `workers` times `TASKS_AHEAD` tasks are in flight, so that the
+    results waiting to be consumed are bounded.  When the consumer stops
+    early, the tasks that didn't start yet are cancelled and `tasks` is
+    closed.
+    """
+    pending = collections.deque()
+    try:
+        for args, context in tasks:
+            pending.append((executor.submit(func, *args), context))
+            while len(pending) > workers * TASKS_AHEAD:
+                future, context = pending.popleft()
+                yield context, future.result()
+        while pending:
+            future, context = pending.popleft()
+            yield context, future.result()
+    finally:
+        for future, _ in pending:
+            future.cancel()
+        close = getattr(tasks, 'close', None)
+        if close is not None:
+            close()
+
+
+class AsyncPool:
+    """Run functions in a pool of `workers` threads from coroutines.
+
+    At most as many calls as there are threads are submitted to the pool
+    at a time from an event loop; further callers wait in the loop for one
+    of them to finish, instead of queueing up in the executor without
+    bound.  ``asyncio`` semaphores belong to one event loop, so each loop
+    gets its own.
+    """
+
+    def __init__(self, workers=None, thread_name_prefix=''):
+        self.executor = ThreadPoolExecutor(
+            workers, thread_name_prefix=thread_name_prefix)
+        self.workers = self.executor._max_workers
+        self._slots = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _loop_slots(self, loop):
+        with self._lock:
+            slots = self._slots.get(loop)
+            if slots is None:
+                slots = self._slots[loop] = asyncio.Semaphore(self.workers)
+            return slots
+
+    async def run(self, func, *args):
+        """Return ``func(*args)``, called in a thread of the pool."""
+        loop = asyncio.get_running_loop()
+        async with self._loop_slots(loop):
+            return await loop.run_in_executor(self.executor, func, *args)
+
+    def shutdown(self):
+        self.executor.shutdown()